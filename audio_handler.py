@@ -1,41 +1,320 @@
-import pyaudio
+try:
+    import pyaudio
+except ImportError:  # На headless-сервере PyAudio может отсутствовать, он нужен только для мониторинга
+    pyaudio = None
 import wave
 import io
 import asyncio
 from typing import Dict, Optional
+from collections import deque
 import subprocess
-import tempfile
-import os
+import threading
+import queue
 import base64
+import time
+
+import config
+from voice_protocol import WEBM_SIGNATURES
+
+class StreamDecoder:
+    """Долгоживущий декодер одного аудиопотока.
+
+    WebM/Opus чанки передаются в один процесс ffmpeg через stdin, PCM читается из stdout.
+    Если первый чанк не похож на WebM, поток считается сырым PCM и передается как есть.
+    """
+
+    def __init__(self, rate: int, channels: int, max_pending: int = config.AUDIO_DECODER_QUEUE_SIZE):
+        self.rate = rate
+        self.channels = channels
+        self.process = None
+        self.passthrough = None  # Определяется по первому чанку
+        self.dropped = 0
+        self._pending = queue.Queue(maxsize=max_pending)
+        self._pcm = bytearray()
+        self._pcm_lock = threading.Lock()
+        self._max_pcm = rate * channels * 2 * config.AUDIO_DECODER_BUFFER_SECONDS
+        self._closed = False
+        self.started_at = time.monotonic()
+        # Выход отдается целыми сэмплами s16le
+        self.read_alignment = 2 * channels
+
+    def _command(self):
+        return [
+            'ffmpeg', '-loglevel', 'quiet',
+            '-f', 'matroska', '-i', 'pipe:0',
+            '-f', 's16le',  # 16-bit PCM
+            '-ar', str(self.rate),  # Sample rate
+            '-ac', str(self.channels),  # Channels
+            'pipe:1'
+        ]
+
+    def _is_passthrough(self, data: bytes) -> bool:
+        return not data.startswith(WEBM_SIGNATURES)
+
+    def _start_process(self):
+        self.process = subprocess.Popen(
+            self._command(),
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, bufsize=0
+        )
+        threading.Thread(target=self._write_loop, daemon=True).start()
+        threading.Thread(target=self._read_loop, daemon=True).start()
+
+    def _write_loop(self):
+        while True:
+            data = self._pending.get()
+            if data is None:
+                break
+            try:
+                self.process.stdin.write(data)
+            except (BrokenPipeError, OSError, ValueError):
+                break
+
+    def _read_loop(self):
+        read_size = 4096 * self.channels
+        while True:
+            try:
+                data = self.process.stdout.read(read_size)
+            except (OSError, ValueError):
+                break
+            if not data:
+                break
+            self._append_pcm(data)
+
+    def _append_pcm(self, data: bytes):
+        with self._pcm_lock:
+            self._pcm.extend(data)
+            # Не даем буферу расти бесконечно, если никто не читает
+            overflow = len(self._pcm) - self._max_pcm
+            if overflow > 0:
+                del self._pcm[:overflow + (-overflow % self.read_alignment)]
+
+    def feed(self, data: bytes):
+        """Передает чанк в декодер, не блокируя вызывающего"""
+        if self._closed or not data:
+            return
+        if self.passthrough is None:
+            self.passthrough = self._is_passthrough(data)
+            if not self.passthrough:
+                try:
+                    self._start_process()
+                except Exception:
+                    self._closed = True
+                    raise
+        if self.passthrough:
+            self._append_pcm(data)
+            return
+        try:
+            self._pending.put_nowait(data)
+        except queue.Full:
+            # Отбрасываем самый старый чанк, чтобы не копить задержку
+            try:
+                self._pending.get_nowait()
+                self.dropped += 1
+            except queue.Empty:
+                pass
+            self._pending.put_nowait(data)
+
+    @property
+    def alive(self) -> bool:
+        """False, если декодер закрыт или его процесс ffmpeg завершился"""
+        return not self._closed and (self.process is None or self.process.poll() is None)
+
+    def read(self) -> bytes:
+        """Забирает накопленный PCM целыми сэмплами"""
+        frame_size = self.read_alignment
+        with self._pcm_lock:
+            size = len(self._pcm) - len(self._pcm) % frame_size
+            data = bytes(self._pcm[:size])
+            del self._pcm[:size]
+        return data
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self.process:
+            try:
+                self._pending.put_nowait(None)
+            except queue.Full:
+                pass
+            try:
+                self.process.stdin.close()
+            except Exception:
+                pass
+            try:
+                self.process.terminate()
+                self.process.wait(timeout=1)
+            except Exception:
+                self.process.kill()
+
+class StreamEncoder(StreamDecoder):
+    """Долгоживущий кодировщик PCM s16le -> Opus в WebM (например, для сведенного потока)"""
+
+    def __init__(self, rate: int, channels: int, max_pending: int = config.AUDIO_DECODER_QUEUE_SIZE):
+        super().__init__(rate, channels, max_pending)
+        self.read_alignment = 1
+
+    def _command(self):
+        return [
+            'ffmpeg', '-loglevel', 'quiet',
+            '-f', 's16le', '-ar', str(self.rate), '-ac', str(self.channels), '-i', 'pipe:0',
+            '-c:a', 'libopus', '-b:a', config.VOICE_MIX_OPUS_BITRATE,
+            '-f', 'webm', '-live', '1', '-cluster_time_limit', '100',
+            'pipe:1'
+        ]
+
+    def _is_passthrough(self, data: bytes) -> bool:
+        return False
+
+class AudioWorkerPool:
+    """Пул потоков для декодирования и воспроизведения аудио вне event loop.
+
+    Каждый stream_id закреплен за одним воркером, поэтому чанки потока обрабатываются по порядку.
+    У каждого потока своя ограниченная очередь: при переполнении отбрасывается самый старый чанк.
+    """
+
+    def __init__(self, process, workers: int = config.AUDIO_WORKERS,
+                 queue_size: int = config.AUDIO_WORKER_QUEUE_SIZE):
+        self._process = process
+        self._queue_size = queue_size
+        self._workers = [
+            {'cond': threading.Condition(), 'pending': {}, 'ready': deque()}
+            for _ in range(max(1, workers))
+        ]
+        self._threads = []
+        self._running = True
+        self.processed = 0
+        self.dropped = 0
+        self.dropped_by_stream = {}  # stream_id -> количество отброшенных чанков
+
+    def _start(self):
+        for worker in self._workers:
+            thread = threading.Thread(target=self._run, args=(worker,), daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _worker_for(self, stream_id):
+        return self._workers[hash(stream_id) % len(self._workers)]
+
+    def submit(self, stream_id, data):
+        """Ставит чанк в очередь потока и сразу возвращает управление"""
+        if not self._threads:
+            self._start()
+        worker = self._worker_for(stream_id)
+        with worker['cond']:
+            pending = worker['pending'].get(stream_id)
+            if pending is None:
+                pending = deque()
+                worker['pending'][stream_id] = pending
+                worker['ready'].append(stream_id)
+            if len(pending) >= self._queue_size:
+                pending.popleft()
+                self.dropped += 1
+                self.dropped_by_stream[stream_id] = self.dropped_by_stream.get(stream_id, 0) + 1
+            pending.append(data)
+            worker['cond'].notify()
+
+    def discard(self, stream_id):
+        """Удаляет необработанные чанки потока"""
+        worker = self._worker_for(stream_id)
+        with worker['cond']:
+            if worker['pending'].pop(stream_id, None) is not None:
+                worker['ready'].remove(stream_id)
+            self.dropped_by_stream.pop(stream_id, None)
+
+    def _run(self, worker):
+        cond = worker['cond']
+        while True:
+            with cond:
+                while self._running and not worker['ready']:
+                    cond.wait()
+                if not self._running:
+                    return
+                stream_id = worker['ready'].popleft()
+                pending = worker['pending'][stream_id]
+                data = pending.popleft()
+                if pending:
+                    # Потоки обслуживаются по кругу, чтобы один говорящий не занимал воркер
+                    worker['ready'].append(stream_id)
+                else:
+                    del worker['pending'][stream_id]
+            try:
+                self._process(stream_id, data)
+            except Exception as e:
+                print(f"Error in audio worker: {e}")
+            self.processed += 1
+
+    def queue_depth(self) -> int:
+        depth = 0
+        for worker in self._workers:
+            with worker['cond']:
+                depth += sum(len(pending) for pending in worker['pending'].values())
+        return depth
+
+    def get_stats(self) -> dict:
+        return {
+            'workers': len(self._workers),
+            'queue_depth': self.queue_depth(),
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'dropped_by_stream': {f"{k[0]}:{k[1]}": v for k, v in self.dropped_by_stream.items()}
+        }
+
+    def shutdown(self):
+        self._running = False
+        for worker in self._workers:
+            with worker['cond']:
+                worker['cond'].notify_all()
 
 class AudioHandler:
-    def __init__(self):
-        self.p = pyaudio.PyAudio()
+    def __init__(self, monitoring_enabled: bool = config.AUDIO_LOCAL_MONITORING):
+        # PyAudio открывается лениво и только при включенном локальном мониторинге;
+        # в режиме relay сервер не трогает звуковые устройства
+        self.monitoring_enabled = monitoring_enabled
+        self._p = None
         self.streams = {}  # (channel_id, user_id) -> stream
-        self.audio_format = pyaudio.paInt16
+        self.decoders = {}  # (channel_id, user_id) -> StreamDecoder
+        self._decoders_lock = threading.Lock()
+        # Потоки, для которых можно создавать декодеры; close_stream убирает поток отсюда,
+        # и воркер, еще воспроизводящий его чанк, уже не создаст новый декодер
+        self._open_streams = set()
+        self.decoder_restarts = 0
+        self.workers = AudioWorkerPool(self.play_audio)
+        self.audio_format = None
         self.channels = 1  # Mono
         self.rate = 48000  # Совпадает с фронтом
         self.chunk = 1024
-        self._check_audio_devices()
+
+    @property
+    def p(self):
+        if self._p is None:
+            if not self.monitoring_enabled:
+                raise RuntimeError("Local audio monitoring is disabled (VOICE_SERVER_MODE=relay)")
+            if pyaudio is None:
+                raise RuntimeError("PyAudio is not installed")
+            self._p = pyaudio.PyAudio()
+            self.audio_format = pyaudio.paInt16
+            self._check_audio_devices()
+        return self._p
 
     def _check_audio_devices(self):
         """Проверка наличия аудио устройств"""
         input_devices = []
         output_devices = []
         
-        for i in range(self.p.get_device_count()):
-            device_info = self.p.get_device_info_by_index(i)
+        for i in range(self._p.get_device_count()):
+            device_info = self._p.get_device_info_by_index(i)
             if device_info.get('maxInputChannels') > 0:
                 input_devices.append(device_info)
             if device_info.get('maxOutputChannels') > 0:
                 output_devices.append(device_info)
         
         if not input_devices:
-            raise RuntimeError("No input devices found")
+            print("No input devices found")
         if not output_devices:
             raise RuntimeError("No output devices found")
 
-    def create_input_stream(self, stream_id) -> Optional[pyaudio.Stream]:
+    def create_input_stream(self, stream_id) -> Optional["pyaudio.Stream"]:
         try:
             # Проверяем, не существует ли уже поток
             if stream_id in self.streams:
@@ -50,12 +329,14 @@ class AudioHandler:
                 input_device_index=None  # Используем устройство по умолчанию
             )
             self.streams[stream_id] = stream
+            with self._decoders_lock:
+                self._open_streams.add(stream_id)
             return stream
         except Exception as e:
             print(f"Error creating input stream: {e}")
             return None
 
-    def create_output_stream(self, stream_id) -> Optional[pyaudio.Stream]:
+    def create_output_stream(self, stream_id) -> Optional["pyaudio.Stream"]:
         try:
             # Проверяем, не существует ли уже поток
             if stream_id in self.streams:
@@ -70,12 +351,14 @@ class AudioHandler:
                 output_device_index=None  # Используем устройство по умолчанию
             )
             self.streams[stream_id] = stream
+            with self._decoders_lock:
+                self._open_streams.add(stream_id)
             return stream
         except Exception as e:
             print(f"Error creating output stream: {e}")
             return None
 
-    def process_audio(self, audio_data: bytes) -> bytes:
+    def process_audio(self, stream_id, audio_data: bytes) -> bytes:
         try:
             # Если данные уже в формате base64, декодируем их
             if isinstance(audio_data, str):
@@ -84,37 +367,24 @@ class AudioHandler:
                 except:
                     pass
 
-            # Создаем временный файл для WebM
-            with tempfile.NamedTemporaryFile(suffix='.webm', delete=False) as webm_file:
-                webm_file.write(audio_data)
-                webm_path = webm_file.name
-
-            # Создаем временный файл для PCM
-            pcm_path = webm_path + '.pcm'
+            with self._decoders_lock:
+                if stream_id not in self._open_streams:
+                    return b''
+                decoder = self.decoders.get(stream_id)
+                if decoder is not None and not decoder.alive and \
+                        time.monotonic() - decoder.started_at >= config.AUDIO_DECODER_RESTART_DELAY:
+                    # ffmpeg упал — без перезапуска поток замолчал бы до переподключения
+                    print(f"Decoder for stream {stream_id} died, restarting")
+                    decoder.close()
+                    decoder = None
+                    self.decoder_restarts += 1
+                if decoder is None:
+                    decoder = StreamDecoder(self.rate, self.channels)
+                    self.decoders[stream_id] = decoder
 
-            try:
-                # Конвертируем WebM в PCM используя ffmpeg
-                subprocess.run([
-                    'ffmpeg', '-i', webm_path,
-                    '-f', 's16le',  # 16-bit PCM
-                    '-ar', str(self.rate),  # Sample rate
-                    '-ac', str(self.channels),  # Channels
-                    pcm_path
-                ], check=True, capture_output=True)
-
-                # Читаем PCM данные
-                with open(pcm_path, 'rb') as pcm_file:
-                    pcm_data = pcm_file.read()
-
-                return pcm_data
-
-            finally:
-                # Удаляем временные файлы
-                try:
-                    os.unlink(webm_path)
-                    os.unlink(pcm_path)
-                except:
-                    pass
+            # Декодер работает в фоне, возвращаем уже готовый PCM
+            decoder.feed(audio_data)
+            return decoder.read()
 
         except Exception as e:
             print(f"Error processing audio: {e}")
@@ -124,7 +394,7 @@ class AudioHandler:
         try:
             if stream_id in self.streams:
                 stream = self.streams[stream_id]
-                processed_data = self.process_audio(audio_data)
+                processed_data = self.process_audio(stream_id, audio_data)
                 if processed_data:
                     # Проверяем, что поток активен
                     if not stream.is_active():
@@ -133,7 +403,25 @@ class AudioHandler:
         except Exception as e:
             print(f"Error playing audio: {e}")
 
+    def submit_playback(self, stream_id, audio_data):
+        """Передает чанк в пул воркеров; декодирование и stream.write выполняются вне event loop"""
+        if stream_id in self.streams:
+            self.workers.submit(stream_id, audio_data)
+
+    def get_stats(self) -> dict:
+        stats = self.workers.get_stats()
+        stats['decoders'] = len(self.decoders)
+        stats['decoder_dropped'] = sum(decoder.dropped for decoder in list(self.decoders.values()))
+        stats['decoder_restarts'] = self.decoder_restarts
+        return stats
+
     def close_stream(self, stream_id):
+        self.workers.discard(stream_id)
+        with self._decoders_lock:
+            self._open_streams.discard(stream_id)
+            decoder = self.decoders.pop(stream_id, None)
+        if decoder:
+            decoder.close()
         if stream_id in self.streams:
             try:
                 stream = self.streams[stream_id]
@@ -145,9 +433,12 @@ class AudioHandler:
                 print(f"Error closing stream: {e}")
 
     def cleanup(self):
-        for stream_id in list(self.streams.keys()):
+        for stream_id in set(self.streams) | set(self.decoders):
             self.close_stream(stream_id)
-        self.p.terminate()
+        self.workers.shutdown()
+        if self._p is not None:
+            self._p.terminate()
+            self._p = None
 
 # Create a global instance
 audio_handler = AudioHandler()
\ No newline at end of file
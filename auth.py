@@ -1,10 +1,16 @@
 from datetime import datetime, timedelta
 from typing import Optional
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+import asyncio
+import threading
+import time
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from sqlalchemy import inspect
+from sqlalchemy.orm import Session, make_transient_to_detached
 import config
 import re
 
@@ -22,41 +28,114 @@ ALGORITHM = config.ALGORITHM  # Use the same algorithm as config.py
 ACCESS_TOKEN_EXPIRE_MINUTES = config.ACCESS_TOKEN_EXPIRE_MINUTES
 
 # Настройки паролей
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Хэши с другим числом раундов считаются устаревшими и пересчитываются при входе
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=config.PASSWORD_BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
+class PasswordHasher:
     """
-    Verify a password against its hash.
+    Dedicated bounded pool for bcrypt.
+
+    bcrypt takes hundreds of milliseconds per call, so it must never run on the
+    event loop. The pool caps how many hashes run at once; when more than
+    max_pending calls are waiting, new ones are rejected with 503 instead of
+    queueing without bound.
     """
+
+    def __init__(self, workers: int = config.PASSWORD_HASH_WORKERS, max_pending: int = config.PASSWORD_HASH_MAX_PENDING):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="bcrypt")
+        self._lock = threading.Lock()
+        self.pending = 0
+        self.completed = 0
+        self.rejected = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        self.run_time_total = 0.0
+
+    def _submit(self, func, *args) -> Future:
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many password operations in progress, try again later",
+                    headers={"Retry-After": "1"}
+                )
+            self.pending += 1
+        submitted = time.perf_counter()
+
+        def run():
+            started = time.perf_counter()
+            try:
+                return func(*args)
+            finally:
+                finished = time.perf_counter()
+                with self._lock:
+                    self.pending -= 1
+                    self.completed += 1
+                    self.queue_time_total += started - submitted
+                    self.queue_time_max = max(self.queue_time_max, started - submitted)
+                    self.run_time_total += finished - started
+
+        return self._executor.submit(run)
+
+    async def run(self, func, *args):
+        """Run func in the pool without blocking the event loop."""
+        return await asyncio.wrap_future(self._submit(func, *args))
+
+    def run_sync(self, func, *args):
+        """Run func in the pool and wait; for sync endpoints already running in the threadpool."""
+        return self._submit(func, *args).result()
+
+    def get_stats(self) -> dict:
+        completed = self.completed or 1
+        return {
+            'workers': self.workers,
+            'pending': self.pending,
+            'completed': self.completed,
+            'rejected': self.rejected,
+            'queue_ms_avg': round(self.queue_time_total * 1000 / completed, 2),
+            'queue_ms_max': round(self.queue_time_max * 1000, 2),
+            'run_ms_avg': round(self.run_time_total * 1000 / completed, 2)
+        }
+
+password_hasher = PasswordHasher()
+
+def _verify(plain_password: str, hashed_password: str) -> bool:
     try:
-        print(f"Verifying password:")
-        print(f"Plain password: {plain_password}")
-        print(f"Plain password length: {len(plain_password)}")
-        print(f"Plain password bytes: {[ord(c) for c in plain_password]}")
-        print(f"Hashed password: {hashed_password}")
-        
-        result = pwd_context.verify(plain_password, hashed_password)
-        print(f"Password verification result: {result}")
-        return result
+        return pwd_context.verify(plain_password, hashed_password)
     except Exception as e:
         print(f"Error verifying password: {str(e)}")
         return False
 
+def _verify_and_update(plain_password: str, hashed_password: str):
+    try:
+        return pwd_context.verify_and_update(plain_password, hashed_password)
+    except Exception as e:
+        print(f"Error verifying password: {str(e)}")
+        return False, None
+
+def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """
+    Verify a password against its hash.
+    """
+    return password_hasher.run_sync(_verify, plain_password, hashed_password)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """
+    Verify a password without blocking the event loop.
+    Returns (valid, new_hash); new_hash is set when the stored hash uses
+    outdated parameters and should be replaced.
+    """
+    return await password_hasher.run(_verify_and_update, plain_password, hashed_password)
+
 def get_password_hash(password: str) -> str:
     """
     Hash a password.
     """
-    try:
-        print(f"Hashing password:")
-        print(f"Password length: {len(password)}")
-        
-        hashed = pwd_context.hash(password)
-        print(f"Hashed password: {hashed}")
-        return hashed
-    except Exception as e:
-        print(f"Error hashing password: {str(e)}")
-        raise
+    return password_hasher.run_sync(pwd_context.hash, password)
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -> str:
     """
@@ -79,6 +158,94 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
             detail="Could not create access token"
         )
 
+class TokenCache:
+    """
+    Bounded LRU cache of verified tokens.
+
+    Stores a snapshot of the user's columns until the token expires (but no longer
+    than ttl), so repeated requests with the same token skip jwt.decode and the
+    user lookup. Entries are dropped explicitly when the user changes.
+
+    Columns written without going through the user's profile (presence flushes,
+    logins) are left out of the snapshot and load from the database on access.
+    """
+
+    VOLATILE_COLUMNS = frozenset(('is_online', 'last_seen', 'last_login'))
+
+    def __init__(self, maxsize: int = config.AUTH_CACHE_SIZE, ttl: float = config.AUTH_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # token -> (expires_at, user_id, snapshot)
+        self._user_tokens = {}  # user_id -> set of tokens
+        self._lock = threading.Lock()  # sync dependencies run in the threadpool
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, token: str) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None:
+                self.misses += 1
+                return None
+            if entry[0] <= time.time():
+                self._remove(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, token: str, user: models.User, token_expires: Optional[float]):
+        snapshot = {
+            attr.key: getattr(user, attr.key)
+            for attr in inspect(models.User).column_attrs
+            if attr.key not in self.VOLATILE_COLUMNS
+        }
+        expires_at = time.time() + self.ttl
+        if token_expires is not None:
+            expires_at = min(expires_at, token_expires)
+        with self._lock:
+            if token in self._entries:
+                self._remove(token)
+            self._entries[token] = (expires_at, user.id, snapshot)
+            self._user_tokens.setdefault(user.id, set()).add(token)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, token: str):
+        _, user_id, _ = self._entries.pop(token)
+        tokens = self._user_tokens.get(user_id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._user_tokens[user_id]
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for token in list(self._user_tokens.get(user_id, ())):
+                self._remove(token)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._user_tokens.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'size': len(self._entries),
+            'hits': self.hits,
+            'misses': self.misses
+        }
+
+token_cache = TokenCache()
+
+def invalidate_user(user_id: int):
+    """
+    Drop cached tokens of a user. Call after changing the user's profile,
+    credentials or active status.
+    """
+    token_cache.invalidate_user(user_id)
+
 def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
     """
     Get the current user from the JWT token.
@@ -89,6 +256,14 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
+    snapshot = token_cache.get(token)
+    if snapshot is not None:
+        # Attach the cached row to this request's session without a SELECT,
+        # so relationships still lazy-load as usual
+        user = models.User(**snapshot)
+        make_transient_to_detached(user)
+        return db.merge(user, load=False)
+    
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         email: str = payload.get("sub")
@@ -102,6 +277,7 @@ def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(
     if user is None:
         raise credentials_exception
     
+    token_cache.put(token, user, payload.get("exp"))
     return user
 
 def get_db():
@@ -0,0 +1,267 @@
+"""
+Нагрузочный тест голосового WebSocket /ws/voice/{channel_id}.
+
+Приложение запускается в этом же процессе (uvicorn в отдельном потоке) на временной базе SQLite.
+Создаются синтетические пользователи и токены, в каждый из M каналов подключается N клиентов,
+все клиенты с фиксированной частотой шлют кадры PCM 48 кГц. В отчете — задержка доставки
+(перцентили), пропускная способность, потерянные кадры и процессорное время сервера на участника.
+Сеть не нужна, все работает через 127.0.0.1.
+
+    python benchmarks/voice_load.py --clients 8 --channels 4 --seconds 10 --json report.json
+
+Клиенты и сервер делят один интерпретатор, поэтому абсолютные значения задержки завышены;
+отчет предназначен для сравнения версий на одной машине.
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import math
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FRAME_MS = 20
+RATE = 48000
+
+def find_free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, math.ceil(q / 100 * len(values)) - 1))
+    return values[index]
+
+def make_payload(frame_ms: int) -> bytes:
+    # Громкий тон, чтобы детектор речи не подавлял кадры
+    from array import array
+    samples = RATE * frame_ms // 1000
+    tone = array('h', (int(3000 * math.sin(2 * math.pi * 440 * i / RATE)) for i in range(samples)))
+    return tone.tobytes()
+
+def create_fixtures(clients: int, channels: int):
+    """Создает пользователей, сервер и голосовые каналы; возвращает [(channel_id, [token, ...]), ...]"""
+    import auth
+    import models
+    from database import SessionLocal
+
+    db = SessionLocal()
+    try:
+        owner = None
+        users = []
+        for i in range(clients * channels):
+            user = models.User(email=f"load{i}@bench.local", username=f"load{i}", hashed_password="-", is_active=True)
+            db.add(user)
+            users.append(user)
+        db.commit()
+        owner = users[0]
+        server = models.Server(name="voice-load", owner_id=owner.id)
+        db.add(server)
+        db.commit()
+        channel_rows = []
+        for c in range(channels):
+            channel = models.Channel(name=f"voice-{c}", server_id=server.id, type=models.ChannelType.VOICE, position=c)
+            db.add(channel)
+            channel_rows.append(channel)
+        for user in users:
+            db.add(models.ServerMember(server_id=server.id, user_id=user.id))
+        db.commit()
+        layout = []
+        for c, channel in enumerate(channel_rows):
+            members = users[c * clients:(c + 1) * clients]
+            layout.append((channel.id, [auth.create_access_token({"sub": user.email}) for user in members]))
+        return layout
+    finally:
+        db.close()
+
+class ServerThread:
+    """uvicorn в фоновом потоке; CPU считается по часам этого потока"""
+
+    def __init__(self, app, port: int):
+        import uvicorn
+        import config
+        self.server = uvicorn.Server(uvicorn.Config(
+            app, host="127.0.0.1", port=port, log_level="warning",
+            ws_per_message_deflate=config.WS_PER_MESSAGE_DEFLATE
+        ))
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+        self._clock = None
+
+    def start(self, timeout: float = 10):
+        self.thread.start()
+        deadline = time.time() + timeout
+        while not self.server.started:
+            if time.time() > deadline:
+                raise RuntimeError("Server did not start")
+            time.sleep(0.05)
+        if hasattr(time, "pthread_getcpuclockid"):
+            self._clock = time.pthread_getcpuclockid(self.thread.ident)
+
+    def cpu_time(self) -> float:
+        if self._clock is not None:
+            return time.clock_gettime(self._clock)
+        # Без часов потока (не Linux) — время всего процесса, вместе с клиентами
+        return time.process_time()
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=5)
+
+class Client:
+    def __init__(self, url: str, index: int):
+        self.url = url
+        self.index = index
+        self.sent = 0
+        self.received = 0
+        self.bytes_received = 0
+        self.latencies = []
+        self.joined = asyncio.Event()
+        self.ws = None
+
+    async def connect(self):
+        import websockets
+        self.ws = await websockets.connect(self.url, max_size=None)
+        await self.ws.recv()  # connection_status
+        await self.ws.send(json.dumps({"type": "join"}))
+
+    async def receive(self):
+        from voice_protocol import decode_frame
+        try:
+            async for message in self.ws:
+                if isinstance(message, bytes):
+                    frame = decode_frame(message)
+                    if frame is None:
+                        continue
+                    self.received += 1
+                    self.bytes_received += len(message)
+                    self.latencies.append(time.time() * 1000 - frame.timestamp)
+                else:
+                    data = json.loads(message)
+                    if data.get("type") == "participants":
+                        self.joined.set()
+                    elif data.get("type") == "ping":
+                        await self.ws.send(json.dumps({"type": "pong"}))
+        except Exception:
+            pass
+
+    async def stream(self, payload: bytes, frames: int, frame_ms: int):
+        from voice_protocol import encode_frame, CODEC_PCM16
+        loop = asyncio.get_running_loop()
+        next_send = loop.time()
+        for sequence in range(frames):
+            await self.ws.send(encode_frame(0, sequence, int(time.time() * 1000), payload, CODEC_PCM16))
+            self.sent += 1
+            next_send += frame_ms / 1000
+            await asyncio.sleep(max(0, next_send - loop.time()))
+
+async def run_load(port: int, layout, seconds: float, frame_ms: int, server: ServerThread):
+    payload = make_payload(frame_ms)
+    channels = []
+    for channel_id, tokens in layout:
+        channels.append([
+            Client(f"ws://127.0.0.1:{port}/ws/voice/{channel_id}?token={token}", i)
+            for i, token in enumerate(tokens)
+        ])
+    clients = [client for channel in channels for client in channel]
+    for client in clients:
+        await client.connect()
+    receivers = [asyncio.create_task(client.receive()) for client in clients]
+    await asyncio.wait_for(asyncio.gather(*(client.joined.wait() for client in clients)), timeout=30)
+
+    frames = int(seconds * 1000 / frame_ms)
+    cpu_start = server.cpu_time()
+    wall_start = time.perf_counter()
+    await asyncio.gather(*(client.stream(payload, frames, frame_ms) for client in clients))
+    await asyncio.sleep(1)  # Догоняем кадры, еще лежащие в очередях
+    wall = time.perf_counter() - wall_start
+    cpu = server.cpu_time() - cpu_start
+
+    for client in clients:
+        await client.ws.close()
+    for task in receivers:
+        task.cancel()
+    return channels, frames, wall, cpu
+
+def build_report(args, channels, frames: int, wall: float, cpu: float) -> dict:
+    clients = [client for channel in channels for client in channel]
+    participants = len(clients)
+    sent = sum(client.sent for client in clients)
+    # Каждый кадр должен дойти до всех остальных участников своего канала
+    expected = sum(client.sent * (len(channel) - 1) for channel in channels for client in channel)
+    received = sum(client.received for client in clients)
+    latencies = [value for client in clients for value in client.latencies]
+    return {
+        "clients_per_channel": args.clients,
+        "channels": args.channels,
+        "participants": participants,
+        "seconds": args.seconds,
+        "frame_ms": args.frame_ms,
+        "jitter_buffer": not args.no_jitter,
+        "frames_sent": sent,
+        "frames_expected": expected,
+        "frames_received": received,
+        "frames_dropped": max(0, expected - received),
+        "drop_rate": round(max(0, expected - received) / expected, 4) if expected else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50), 2),
+            "p90": round(percentile(latencies, 90), 2),
+            "p99": round(percentile(latencies, 99), 2),
+            "max": round(max(latencies), 2) if latencies else 0.0
+        },
+        "throughput": {
+            "frames_in_per_second": round(sent / wall, 1),
+            "frames_out_per_second": round(received / wall, 1),
+            "mbit_out_per_second": round(sum(client.bytes_received for client in clients) * 8 / 1e6 / wall, 3)
+        },
+        "server_cpu_seconds": round(cpu, 3),
+        "server_cpu_ms_per_second_per_participant": round(cpu * 1000 / wall / participants, 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for /ws/voice/{channel_id}")
+    parser.add_argument("--clients", type=int, default=4, help="Clients per channel")
+    parser.add_argument("--channels", type=int, default=2)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--frame-ms", type=int, default=FRAME_MS)
+    parser.add_argument("--no-jitter", action="store_true", help="Disable the server jitter buffer")
+    parser.add_argument("--verbose", action="store_true", help="Show server log output")
+    parser.add_argument("--json", help="Path to write a machine-readable report")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="meow-voice-load-")
+    os.environ["MEOW_DATABASE_URL"] = f"sqlite:///{os.path.join(workdir, 'load.db')}"
+    os.environ.setdefault("MEOW_VOICE_MODE", "relay")
+
+    log = None if args.verbose else io.StringIO()
+    with contextlib.redirect_stdout(log) if log else contextlib.nullcontext():
+        import config
+        if args.no_jitter:
+            config.VOICE_JITTER_ENABLED = False
+        import main as app_main
+        layout = create_fixtures(args.clients, args.channels)
+        port = find_free_port()
+        server = ServerThread(app_main.app, port)
+        server.start()
+        try:
+            channels, frames, wall, cpu = asyncio.run(run_load(port, layout, args.seconds, args.frame_ms, server))
+        finally:
+            server.stop()
+
+    report = build_report(args, channels, frames, wall, cpu)
+    print(json.dumps(report, indent=2))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Сравнение режимов relay и mix (MCU) для голосового канала.
+
+Для каждого размера канала прогоняется одинаковая синтетическая нагрузка (PCM 48 кГц, кадры по 20 мс)
+и считаются исходящий трафик и процессорное время сервера в пересчете на одного участника.
+
+    python benchmarks/voice_mix_benchmark.py --participants 4,8,16,32 --speakers 3 --seconds 5
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np
+
+from voice_mixer import ChannelMixer
+from voice_protocol import VoiceFrame, KIND_AUDIO, CODEC_PCM16, FLAG_MIXED, encode_frame
+
+RATE = 48000
+FRAME_MS = 20
+
+def make_frames(speakers: int, ticks: int):
+    samples = RATE * FRAME_MS // 1000
+    t = np.arange(samples * ticks) / RATE
+    frames = []
+    for i in range(speakers):
+        tone = 3000 * (i + 1) / speakers * np.sin(2 * np.pi * (220 + 110 * i) * t)
+        pcm = tone.astype(np.int16).tobytes()
+        frames.append([pcm[j * samples * 2:(j + 1) * samples * 2] for j in range(ticks)])
+    return frames
+
+def run_relay(participants: int, frames, ticks: int):
+    bytes_out = 0
+    start = time.process_time()
+    for tick in range(ticks):
+        for sender_id, speaker_frames in enumerate(frames):
+            packet = encode_frame(sender_id + 1, tick, tick * FRAME_MS, speaker_frames[tick], CODEC_PCM16)
+            # Кадр уходит всем, кроме отправителя
+            bytes_out += len(packet) * (participants - 1)
+    cpu = time.process_time() - start
+    return bytes_out, cpu
+
+def run_mix(participants: int, frames, ticks: int, top_k: int):
+    mixer = ChannelMixer(rate=RATE, frame_ms=FRAME_MS, top_k=top_k, codec="pcm16")
+    listeners = list(range(1, participants + 1))
+    bytes_out = 0
+    start = time.process_time()
+    for tick in range(ticks):
+        for sender_id, speaker_frames in enumerate(frames):
+            mixer.push(sender_id + 1, VoiceFrame(KIND_AUDIO, CODEC_PCM16, sender_id + 1, tick,
+                                                 tick * FRAME_MS, speaker_frames[tick]))
+        mixes = mixer.mix(listeners)
+        packets = {}
+        for payload in mixes.values():
+            packet = packets.get(id(payload))
+            if packet is None:
+                packet = encode_frame(0, mixer.sequence, tick * FRAME_MS, payload, CODEC_PCM16 | FLAG_MIXED)
+                packets[id(payload)] = packet
+            bytes_out += len(packet)
+    cpu = time.process_time() - start
+    mixer.close()
+    return bytes_out, cpu
+
+def main():
+    parser = argparse.ArgumentParser(description="Relay vs mix benchmark for voice channels")
+    parser.add_argument("--participants", default="4,8,16,32,64")
+    parser.add_argument("--speakers", type=int, default=3)
+    parser.add_argument("--seconds", type=float, default=5)
+    parser.add_argument("--top-k", type=int, default=3)
+    parser.add_argument("--json", help="Path to write a machine-readable report")
+    args = parser.parse_args()
+
+    ticks = int(args.seconds * 1000 / FRAME_MS)
+    frames = make_frames(args.speakers, ticks)
+    results = []
+    print(f"{'mode':<6} {'N':>4} {'kbit/s per participant':>24} {'CPU ms/s per participant':>26}")
+    for participants in [int(n) for n in args.participants.split(",")]:
+        speakers = frames[:min(args.speakers, participants)]
+        for mode in ("relay", "mix"):
+            if mode == "relay":
+                bytes_out, cpu = run_relay(participants, speakers, ticks)
+            else:
+                bytes_out, cpu = run_mix(participants, speakers, ticks, args.top_k)
+            kbps = bytes_out * 8 / 1000 / args.seconds / participants
+            cpu_ms = cpu * 1000 / args.seconds / participants
+            results.append({
+                "mode": mode,
+                "participants": participants,
+                "speakers": len(speakers),
+                "kbps_per_participant": round(kbps, 1),
+                "cpu_ms_per_second_per_participant": round(cpu_ms, 3)
+            })
+            print(f"{mode:<6} {participants:>4} {kbps:>24.1f} {cpu_ms:>26.3f}")
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"codec": "pcm16", "frame_ms": FRAME_MS, "results": results}, f, indent=2)
+
+if __name__ == "__main__":
+    main()
@@ -4,9 +4,10 @@ SERVER_PORT = 8000
 
 # Database configuration
 import os
+import socket
 DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "data")
 os.makedirs(DB_DIR, exist_ok=True)
-DATABASE_URL = f"sqlite:///{os.path.join(DB_DIR, 'dump.db')}"
+DATABASE_URL = os.environ.get("MEOW_DATABASE_URL", f"sqlite:///{os.path.join(DB_DIR, 'dump.db')}")
 
 # JWT Configuration
 SECRET_KEY = "hui228"  # Match with main.py and auth.py
@@ -42,4 +43,92 @@ CORS_ORIGINS = [
     f"http://{SERVER_IP}:8000",  # Network API server
     f"ws://{SERVER_IP}:8000",    # Network WebSocket
     f"wss://{SERVER_IP}:8000"    # Network Secure WebSocket
-] 
\ No newline at end of file
+] 
+
+# Voice configuration
+# Режим голосового сервера: "relay" — только пересылка кадров, звуковые устройства не открываются;
+# "monitor" — дополнительно локальное воспроизведение участников через PyAudio
+VOICE_SERVER_MODE = os.environ.get("MEOW_VOICE_MODE", "relay")
+AUDIO_LOCAL_MONITORING = VOICE_SERVER_MODE == "monitor"
+AUDIO_DECODER_QUEUE_SIZE = 50  # Максимум чанков, ожидающих декодирования в одном потоке
+AUDIO_DECODER_BUFFER_SECONDS = 2  # Максимум PCM, накопленного декодером (секунды)
+AUDIO_DECODER_RESTART_DELAY = 1.0  # Не чаще раза в столько секунд декодер потока перезапускается после падения ffmpeg
+AUDIO_WORKERS = 4  # Потоки для декодирования и воспроизведения аудио
+AUDIO_WORKER_QUEUE_SIZE = 25  # Максимум чанков в очереди одного потока
+VOICE_SEND_HIGH_WATER_MARK = 50  # Максимум медиа-кадров в исходящей очереди клиента
+VOICE_SEND_CONTROL_LIMIT = 500  # Максимум управляющих сообщений, после которого клиент отключается
+VOICE_AUDIO_MAX_AGE = 0.5  # Аудиокадры старше этого (секунды) не отправляются
+# Сведение голосов на сервере (MCU) для больших каналов; требует NumPy
+VOICE_MIX_ENABLED = os.environ.get("MEOW_VOICE_MIX", "0") == "1"
+VOICE_MIX_THRESHOLD = 8  # Канал переключается на сведение с этого числа участников
+VOICE_MIX_FRAME_MS = 20  # Длительность одного сводимого кадра
+VOICE_MIX_TOP_K = 3  # Сколько самых громких говорящих попадает в микс
+VOICE_MIX_MAX_BUFFER_MS = 200  # Максимальная задержка PCM участника перед сведением
+VOICE_MIX_CODEC = "pcm16"  # "pcm16" или "webm" (Opus через ffmpeg, по кодировщику на слушателя)
+VOICE_MIX_OPUS_BITRATE = "32k"
+# Джиттер-буфер на пути пересылки
+VOICE_JITTER_ENABLED = True
+VOICE_JITTER_MIN_DELAY = 0.02  # секунды
+VOICE_JITTER_MAX_DELAY = 0.2  # секунды
+VOICE_JITTER_MAX_FRAMES = 50  # При переполнении кадры выдаются без ожидания
+VOICE_JITTER_TICK = 0.01  # Период выдачи кадров из буферов, секунды
+# Детектор речи и подавление тишины на пути пересылки
+VOICE_VAD_ENABLED = True
+VOICE_VAD_ENERGY_THRESHOLD = 300  # RMS для PCM s16le (около -40 dBFS)
+VOICE_VAD_ZCR_MAX = 0.5  # Большая доля пересечений нуля при низкой энергии — шум
+VOICE_VAD_HANGOVER_FRAMES = 15  # Сколько тихих кадров пересылать после окончания речи
+VOICE_VAD_OPUS_DTX_BYTES = 3  # Пакеты Opus не длиннее этого — DTX/comfort noise
+# Шина между воркерами: "memory" (один процесс), "unix:///tmp/meow-voice.sock" или "redis://localhost:6379/0"
+VOICE_BACKPLANE_URL = os.environ.get("MEOW_VOICE_BACKPLANE", "memory")
+VOICE_WORKER_ID = os.environ.get("MEOW_VOICE_WORKER_ID", f"{socket.gethostname()}-{os.getpid()}")
+# Воркеры для привязки каналов: "w1=wss://host:8001,w2=wss://host:8002"; пусто — привязка выключена
+VOICE_WORKER_URLS = dict(
+    item.split("=", 1) for item in os.environ.get("MEOW_VOICE_WORKERS", "").split(",") if "=" in item
+)
+VOICE_BACKPLANE_QUEUE_SIZE = 1000  # Сообщений в очереди публикации Redis
+VOICE_BACKPLANE_MAX_BUFFER = 1024 * 1024  # Байт в буфере сокета брокера, после которых сообщения теряются
+VOICE_BACKPLANE_HEARTBEAT_INTERVAL = 5  # Раз в столько секунд воркер сообщает о себе в каждом своем канале
+VOICE_BACKPLANE_WORKER_TIMEOUT = 15  # Участники воркера, молчащего столько секунд, считаются отключившимися
+VOICE_BACKPLANE_RECONNECT_MAX_DELAY = 10  # Максимальная пауза между попытками переподключиться к брокеру, секунды
+# Видео и демонстрация экрана
+VOICE_VIDEO_MAX_FPS = 30  # Максимум кадров в секунду одного потока для одного получателя
+VOICE_VIDEO_SLOW_QUEUE_DEPTH = 10  # При такой очереди получателя промежуточные кадры пропускаются
+VOICE_STATE_COALESCE_WINDOW = 0.05  # Изменения состояния участника за это время (секунды) рассылаются одной дельтой
+# Проверка живости соединений
+VOICE_HEARTBEAT_INTERVAL = 5  # Молчащему клиенту через столько секунд отправляется ping
+VOICE_HEARTBEAT_TIMEOUT = 10  # Если после ping клиент молчит столько секунд, соединение закрывается
+VOICE_HEARTBEAT_TICK = 0.5  # Шаг колеса таймеров, секунды
+# Запись голосовых каналов
+VOICE_RECORDING_DIR = os.path.join("media", "recordings")  # Готовые записи, раздаются через /media
+VOICE_RECORDING_TRACKS_DIR = os.path.join(DB_DIR, "recordings")  # Дорожки участников во время записи
+VOICE_RECORDING_QUEUE_SIZE = 500  # Кадров в очереди записи, после этого кадры теряются
+VOICE_RECORDING_MAX_GAP = 10  # Паузы короче этого (секунды) заполняются тишиной, длиннее — новый сегмент
+VOICE_RECORDING_BITRATE = "48k"
+# Шлюз событий чата (/ws/gateway)
+GATEWAY_SEND_QUEUE_LIMIT = 1000  # Неотправленных событий, после которых медленный клиент отключается
+GATEWAY_REPLAY_BUFFER = 500  # Последних событий сессии, которые можно дослать после переподключения
+GATEWAY_RESUME_TIMEOUT = 60  # Сколько секунд сессия с подписками ждет переподключения клиента
+# Присутствие пользователей
+PRESENCE_FLUSH_INTERVAL = 30  # Раз в столько секунд is_online/last_seen записываются в базу одним пакетом
+PRESENCE_OFFLINE_DELAY = 5  # Столько секунд после закрытия последнего соединения пользователь еще считается в сети
+# Индикатор набора текста
+TYPING_BROADCAST_INTERVAL = 1.0  # Не чаще одной рассылки списка печатающих на канал за столько секунд
+TYPING_TIMEOUT = 8  # Через столько секунд без typing_start пользователь убирается из списка
+# Общий WebSocket /ws
+WS_SEND_QUEUE_LIMIT = 256  # Неотправленных сообщений, после которых медленный клиент отключается
+WS_PER_MESSAGE_DEFLATE = os.environ.get("MEOW_WS_DEFLATE", "1") != "0"  # Сжатие permessage-deflate, если его предлагает клиент
+# Кэш проверенных токенов в get_current_user
+AUTH_CACHE_SIZE = 10000  # Максимум токенов в кэше
+AUTH_CACHE_TTL = 300  # Секунд, после которых пользователь перечитывается из базы, даже если токен еще действует
+# Хэширование паролей
+PASSWORD_BCRYPT_ROUNDS = 12  # Стоимость bcrypt; старые хэши с другой стоимостью пересчитываются при входе
+PASSWORD_HASH_WORKERS = max(1, min(4, os.cpu_count() or 1))  # Потоков bcrypt
+PASSWORD_HASH_MAX_PENDING = 64  # Операций в очереди, после которых новые отклоняются с 503
+# Ограничение попыток входа (/token)
+LOGIN_RATE_LIMIT_IP = 20  # Попыток входа с одного IP за окно
+LOGIN_RATE_LIMIT_IP_WINDOW = 60  # Секунд
+LOGIN_RATE_LIMIT_ACCOUNT = 5  # Неудачных попыток для учетной записи с одного IP за окно; успешный вход с этого IP сбрасывает счетчик
+LOGIN_RATE_LIMIT_ACCOUNT_WINDOW = 900  # Секунд
+LOGIN_RATE_LIMIT_ACCOUNT_GLOBAL = 100  # Неудачных попыток для учетной записи со всех IP за то же окно (перебор с множества адресов)
+LOGIN_RATE_LIMIT_BACKEND = os.environ.get("MEOW_RATE_LIMIT_BACKEND", "memory")  # memory или redis://host:port/db для нескольких воркеров
+RATE_LIMIT_MAX_KEYS = 100000  # Ключей в памяти, после этого вытесняются самые давние
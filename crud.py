@@ -1,5 +1,5 @@
 from sqlalchemy.orm import Session
-from sqlalchemy import and_, or_
+from sqlalchemy import and_, or_, bindparam
 from datetime import datetime, timedelta
 import models, schemas
 from typing import List, Optional, Dict, Any
@@ -28,17 +28,8 @@ def create_user(db: Session, user: schemas.UserCreate):
     from auth import get_password_hash  # import inside function to avoid circular dependency
     
     print(f"Creating user with email: {user.email}")
-    print(f"Password: {user.password}")
-    print(f"Password length: {len(user.password)}")
-    print(f"Password bytes: {[ord(c) for c in user.password]}")
     
     hashed_password = get_password_hash(user.password)
-    print(f"Generated hash: {hashed_password}")
-    
-    # Verify the hash immediately
-    from auth import verify_password
-    verification_result = verify_password(user.password, hashed_password)
-    print(f"Immediate verification of generated hash: {verification_result}")
     
     db_user = models.User(
         email=user.email,
@@ -512,6 +503,20 @@ def is_user_server_member(db: Session, user_id: int, server_id: int) -> bool:
         models.ServerMember.server_id == server_id
     ).first() is not None
 
+def get_user_server_ids(db: Session, user_id: int) -> List[int]:
+    return [row[0] for row in db.query(models.ServerMember.server_id).filter(models.ServerMember.user_id == user_id)]
+
+def update_users_presence(db: Session, rows: List[Dict[str, Any]]):
+    """Пакетное обновление is_online/last_seen: один executemany и один коммит на все строки"""
+    users = models.User.__table__
+    db.execute(
+        users.update()
+        .where(users.c.id == bindparam('user_id'))
+        .values(is_online=bindparam('is_online'), last_seen=bindparam('last_seen')),
+        rows
+    )
+    db.commit()
+
 def add_user_to_server(db: Session, user_id: int, server_id: int) -> models.ServerMember:
     # Check if user is already a member
     if is_user_server_member(db, user_id, server_id):
@@ -539,7 +544,6 @@ def update_user_credentials(db: Session, user_id: int, new_username: str, new_pa
     
     print(f"Updating credentials for user {user_id}")
     print(f"New username: {new_username}")
-    print(f"New password: {new_password}")
     
     db_user = get_user(db, user_id)
     if not db_user:
@@ -550,12 +554,6 @@ def update_user_credentials(db: Session, user_id: int, new_username: str, new_pa
     
     # Update password
     hashed_password = get_password_hash(new_password)
-    print(f"Generated new hash: {hashed_password}")
-    
-    # Verify the new hash immediately
-    from auth import verify_password
-    verification_result = verify_password(new_password, hashed_password)
-    print(f"Verification of new hash: {verification_result}")
     
     db_user.hashed_password = hashed_password
     
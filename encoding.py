@@ -0,0 +1,52 @@
+import json
+
+try:
+    import orjson
+except ImportError:  # orjson необязателен, без него используется стандартный json
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # без msgpack клиенты получают JSON
+    msgpack = None
+
+ENCODING_JSON = 'json'
+ENCODING_MSGPACK = 'msgpack'
+
+def dumps_json(message) -> str:
+    """Сериализует сообщение в JSON-строку один раз для отправки через send_text"""
+    if orjson is not None:
+        return orjson.dumps(message, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(message, separators=(',', ':'), ensure_ascii=False)
+
+def negotiate_encoding(requested) -> str:
+    """Кодировка, запрошенная клиентом при подключении, если сервер ее поддерживает"""
+    if requested == ENCODING_MSGPACK and msgpack is not None:
+        return ENCODING_MSGPACK
+    return ENCODING_JSON
+
+def encode_message(message, encoding: str = ENCODING_JSON):
+    """JSON — строка для send_text, MessagePack — байты для send_bytes"""
+    if encoding == ENCODING_MSGPACK:
+        return msgpack.packb(message, use_bin_type=True)
+    return dumps_json(message)
+
+def decode_message(data):
+    """Сообщение клиента: текст — JSON, байты — MessagePack"""
+    if isinstance(data, (bytes, bytearray)):
+        if msgpack is None:
+            raise ValueError("MessagePack is not available")
+        return msgpack.unpackb(data, raw=False)
+    return json.loads(data)
+
+def prepend_field(encoded, key: str, value: int, encoding: str = ENCODING_JSON):
+    """Добавляет поле в начало уже сериализованного объекта, не кодируя его заново.
+
+    Объект должен быть непустым, а для MessagePack — содержать меньше 15 полей (fixmap).
+    """
+    if encoding == ENCODING_MSGPACK:
+        header = encoded[0]
+        if header & 0xF0 != 0x80 or header == 0x8F:
+            raise ValueError("Only small MessagePack maps are supported")
+        return bytes((header + 1,)) + msgpack.packb(key) + msgpack.packb(value) + encoded[1:]
+    return f'{{"{key}":{value},{encoded[1:]}'
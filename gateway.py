@@ -0,0 +1,261 @@
+"""
+Шлюз событий чата.
+
+Клиент держит одно соединение /ws/gateway и подписывается на серверы и каналы; события
+(новые и измененные сообщения, реакции, участники сервера) рассылаются только подписчикам
+соответствующей темы. Тема — кортеж ('server', server_id) или ('channel', channel_id).
+Событие сериализуется один раз на каждую кодировку подписчиков (JSON или MessagePack,
+выбирается клиентом при подключении) и ставится в очередь WebSocketSender каждого подписчика.
+
+Каждое событие получает номер seq, возрастающий в пределах сессии, и попадает в ограниченный
+кольцевой буфер сессии. После обрыва сессия с подписками живет еще GATEWAY_RESUME_TIMEOUT
+секунд: клиент переподключается с session_id и последним seq и получает только пропущенные
+события. Если их больше, чем помещается в буфер, клиент получает invalid_session
+и загружает состояние заново.
+"""
+import asyncio
+import time
+import uuid
+from collections import deque
+from typing import Dict, Optional, Set, Tuple
+
+import config
+from encoding import ENCODING_JSON, encode_message, prepend_field
+from websocket_sender import WebSocketSender
+
+Topic = Tuple[str, int]
+
+def server_topic(server_id: int) -> Topic:
+    return ('server', server_id)
+
+def channel_topic(channel_id: int) -> Topic:
+    return ('channel', channel_id)
+
+async def _close_quietly(websocket):
+    try:
+        await websocket.close()
+    except Exception:
+        pass
+
+class GatewaySession:
+    """Сессия шлюза; переживает обрыв соединения на время ожидания resume"""
+
+    def __init__(self, user_id: int, encoding: str = ENCODING_JSON, replay_size: int = config.GATEWAY_REPLAY_BUFFER):
+        self.session_id = uuid.uuid4().hex
+        self.user_id = user_id
+        self.encoding = encoding
+        self.sender: Optional[WebSocketSender] = None
+        self.topics: Set[Topic] = set()
+        self.seq = 0
+        self.replay = deque(maxlen=replay_size)  # (seq, сообщение)
+        self.detached_at = None
+        self._expire_handle = None
+
+    def push(self, body) -> bool:
+        """Нумерует событие, сохраняет для повтора и отправляет, если клиент подключен.
+
+        body — событие, уже сериализованное в кодировке сессии; номер дописывается в начало,
+        чтобы не сериализовать событие заново для каждого подписчика.
+        """
+        self.seq += 1
+        message = prepend_field(body, 'seq', self.seq, self.encoding)
+        self.replay.append((self.seq, message))
+        if self.sender is None:
+            return False
+        return self.sender.send(message)
+
+    def send(self, message) -> bool:
+        """Служебное сообщение без номера, уже сериализованное в кодировке сессии"""
+        if self.sender is None:
+            return False
+        return self.sender.send(message)
+
+    def send_message(self, message: dict) -> bool:
+        """Ответ на команду клиента"""
+        return self.send(encode_message(message, self.encoding))
+
+    def missed(self, seq: int):
+        """События после seq или None, если часть из них уже вытеснена из буфера"""
+        if seq < 0 or seq > self.seq:
+            return None
+        count = self.seq - seq
+        if count > len(self.replay):
+            return None
+        return [message for _, message in list(self.replay)[len(self.replay) - count:]]
+
+class EventGateway:
+    def __init__(self, resume_timeout: float = config.GATEWAY_RESUME_TIMEOUT):
+        self.resume_timeout = resume_timeout
+        self.sessions: Dict[str, GatewaySession] = {}
+        self.topics: Dict[Topic, Set[GatewaySession]] = {}
+        self.channel_servers: Dict[int, int] = {}  # channel_id -> server_id, для отзыва подписок
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.dispatched = 0
+        self.delivered = 0
+        self.resumed = 0
+        self.replayed = 0
+        self.resume_failed = 0
+
+    def _attach(self, session: GatewaySession, websocket) -> WebSocketSender:
+        async def on_error():
+            self.detach(session, sender)
+            await _close_quietly(websocket)
+
+        sender = WebSocketSender(websocket, on_error=on_error, control_limit=config.GATEWAY_SEND_QUEUE_LIMIT,
+                                 log_tag="GATEWAY")
+        if session.sender is not None:
+            # Старое соединение могло еще не заметить обрыв
+            session.sender.close()
+            asyncio.create_task(_close_quietly(session.sender.websocket))
+        if session._expire_handle is not None:
+            session._expire_handle.cancel()
+            session._expire_handle = None
+        session.sender = sender
+        session.detached_at = None
+        sender.start()
+        return sender
+
+    def connect(self, websocket, user_id: int, encoding: str = ENCODING_JSON) -> GatewaySession:
+        """Новая сессия для уже принятого WebSocket"""
+        self.loop = asyncio.get_running_loop()
+        session = GatewaySession(user_id, encoding)
+        self.sessions[session.session_id] = session
+        self._attach(session, websocket)
+        return session
+
+    def resume(self, websocket, user_id: int, session_id: str, seq: int,
+               encoding: str = ENCODING_JSON) -> Optional[GatewaySession]:
+        """Возобновляет сессию и досылает пропущенные события; None — нужна полная синхронизация"""
+        self.loop = asyncio.get_running_loop()
+        session = self.sessions.get(session_id)
+        missed = None
+        if session is not None and session.user_id == user_id and session.encoding == encoding:
+            # Буфер повтора хранит события в кодировке сессии
+            missed = session.missed(seq)
+        if missed is None:
+            self.resume_failed += 1
+            if session is not None and session.user_id == user_id:
+                # Пропуск слишком большой: сессия больше не нужна
+                self.close(session)
+            return None
+        sender = self._attach(session, websocket)
+        session.send_message({'type': 'resumed', 'session_id': session.session_id, 'replayed': len(missed)})
+        for message in missed:
+            sender.send(message)
+        self.resumed += 1
+        self.replayed += len(missed)
+        return session
+
+    def detach(self, session: GatewaySession, sender: WebSocketSender):
+        """Соединение сессии закрылось; подписки сохраняются до истечения resume_timeout"""
+        if session.sender is not sender or session.session_id not in self.sessions:
+            return  # Сессия уже возобновлена другим соединением или закрыта
+        sender.close()
+        session.sender = None
+        session.detached_at = time.monotonic()
+        session._expire_handle = asyncio.get_running_loop().call_later(self.resume_timeout, self._expire, session)
+
+    def _expire(self, session: GatewaySession):
+        session._expire_handle = None
+        if session.sender is None:
+            self.close(session)
+
+    def close(self, session: GatewaySession):
+        if self.sessions.pop(session.session_id, None) is None:
+            return
+        for topic in session.topics:
+            self._discard(topic, session)
+        session.topics.clear()
+        session.replay.clear()
+        if session._expire_handle is not None:
+            session._expire_handle.cancel()
+            session._expire_handle = None
+        if session.sender is not None:
+            session.sender.close()
+            session.sender = None
+
+    def _discard(self, topic: Topic, session: GatewaySession):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(session)
+            if not subscribers:
+                del self.topics[topic]
+
+    def subscribe(self, session: GatewaySession, topic: Topic, server_id: int = None):
+        """Подписка; server_id для канала запоминается, чтобы отозвать ее при выходе из сервера"""
+        if topic[0] == 'channel' and server_id is not None:
+            self.channel_servers[topic[1]] = server_id
+        self.topics.setdefault(topic, set()).add(session)
+        session.topics.add(topic)
+
+    def unsubscribe(self, session: GatewaySession, topic: Topic):
+        session.topics.discard(topic)
+        self._discard(topic, session)
+
+    def has_subscribers(self, topic: Topic) -> bool:
+        return topic in self.topics
+
+    def dispatch(self, topic: Topic, event_type: str, data, replay: bool = True):
+        """Рассылает событие подписчикам темы.
+
+        Можно вызывать и из event loop, и из потоков пула, в которых выполняются
+        синхронные эндпоинты: во втором случае рассылка передается в loop.
+        replay=False — для мгновенных событий (набор текста), которые после переподключения
+        уже не нужны: они уходят без seq и не занимают буфер повтора.
+        """
+        loop = self.loop
+        if loop is None or loop.is_closed():
+            return  # Ни одного подключения еще не было
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            self._dispatch(topic, event_type, data, replay)
+        else:
+            loop.call_soon_threadsafe(self._dispatch, topic, event_type, data, replay)
+
+    def _dispatch(self, topic: Topic, event_type: str, data, replay: bool = True):
+        subscribers = self.topics.get(topic)
+        self.dispatched += 1
+        if not subscribers:
+            return
+        event = {'type': event_type, 'data': data}
+        bodies = {}  # кодировка -> сериализованное событие
+        for session in list(subscribers):
+            body = bodies.get(session.encoding)
+            if body is None:
+                body = bodies[session.encoding] = encode_message(event, session.encoding)
+            if session.push(body) if replay else session.send(body):
+                self.delivered += 1
+
+    def revoke(self, user_id: int, server_id: int):
+        """Снимает подписки пользователя на сервер и его каналы (после удаления из сервера)"""
+        if self.loop is None:
+            return
+        self.loop.call_soon_threadsafe(self._revoke, user_id, server_id)
+
+    def _revoke(self, user_id: int, server_id: int):
+        for session in list(self.sessions.values()):
+            if session.user_id != user_id:
+                continue
+            for topic in list(session.topics):
+                kind, topic_id = topic
+                if (kind == 'server' and topic_id == server_id) or \
+                        (kind == 'channel' and self.channel_servers.get(topic_id) == server_id):
+                    self.unsubscribe(session, topic)
+                    session.push(encode_message({'type': 'unsubscribed', kind + '_id': topic_id}, session.encoding))
+
+    def get_stats(self) -> dict:
+        return {
+            'sessions': len(self.sessions),
+            'detached': sum(1 for session in self.sessions.values() if session.sender is None),
+            'topics': len(self.topics),
+            'dispatched': self.dispatched,
+            'delivered': self.delivered,
+            'resumed': self.resumed,
+            'replayed': self.replayed,
+            'resume_failed': self.resume_failed
+        }
+
+gateway = EventGateway()
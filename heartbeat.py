@@ -0,0 +1,101 @@
+import asyncio
+import time
+from typing import Callable, Hashable, List
+
+import config
+
+class TimerWheel:
+    """Хешированное колесо таймеров для дедлайнов соединений.
+
+    schedule и cancel выполняются за O(1). Продление дедлайна (самый частый случай —
+    каждое сообщение клиента) только обновляет время в словаре: ключ переносится
+    в нужную ячейку лениво, когда колесо доходит до его старой ячейки.
+    Таймер срабатывает с опозданием не больше одного tick.
+    """
+
+    def __init__(
+        self,
+        on_timeout: Callable[[Hashable], None],
+        tick: float = config.VOICE_HEARTBEAT_TICK,
+        horizon: float = max(config.VOICE_HEARTBEAT_INTERVAL, config.VOICE_HEARTBEAT_TIMEOUT)
+    ):
+        self.on_timeout = on_timeout
+        self.tick = tick
+        self._slots = [set() for _ in range(int(horizon / tick) + 2)]
+        self._deadlines = {}  # key -> монотонное время срабатывания
+        self._slot_of = {}    # key -> индекс ячейки, где сейчас лежит ключ
+        self._last_tick = None
+        self._task = None
+        self.expired = 0
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def _index(self, deadline: float) -> int:
+        return int(deadline / self.tick) % len(self._slots)
+
+    def _place(self, key, deadline: float):
+        old = self._slot_of.get(key)
+        if old is not None:
+            self._slots[old].discard(key)
+        index = self._index(deadline)
+        self._slots[index].add(key)
+        self._slot_of[key] = index
+
+    def schedule(self, key, delay: float, now: float = None):
+        """Назначает (или переназначает) срабатывание ключа через delay секунд"""
+        deadline = (time.monotonic() if now is None else now) + delay
+        current = self._deadlines.get(key)
+        self._deadlines[key] = deadline
+        if current is None or deadline < current:
+            self._place(key, deadline)
+        # Иначе ключ уже лежит в более ранней ячейке и будет перенесен при ее обработке
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+        index = self._slot_of.pop(key, None)
+        if index is not None:
+            self._slots[index].discard(key)
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Обрабатывает все полностью прошедшие тики и возвращает истекшие ключи"""
+        current = int(now / self.tick)
+        if self._last_tick is None:
+            self._last_tick = current - 1
+        # После долгой паузы достаточно пройти колесо один раз
+        start = max(self._last_tick + 1, current - len(self._slots))
+        expired = []
+        for t in range(start, current):
+            slot = self._slots[t % len(self._slots)]
+            for key in list(slot):
+                deadline = self._deadlines[key]
+                if deadline <= now:
+                    slot.discard(key)
+                    del self._deadlines[key]
+                    del self._slot_of[key]
+                    expired.append(key)
+                else:
+                    # Дедлайн продлили или он на следующем обороте колеса
+                    self._place(key, deadline)
+        self._last_tick = current - 1
+        self.expired += len(expired)
+        return expired
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            for key in self.advance(time.monotonic()):
+                try:
+                    self.on_timeout(key)
+                except Exception as e:
+                    print(f"Error in heartbeat timeout handler for {key}: {e}")
+
+    def get_stats(self) -> dict:
+        return {
+            'tracked': len(self._deadlines),
+            'expired': self.expired
+        }
@@ -0,0 +1,115 @@
+from typing import List
+
+import config
+from voice_protocol import VoiceFrame, SEQUENCE_MODULO, sequence_diff
+
+# Скачок номера больше этого считается перезапуском нумерации у отправителя
+SEQUENCE_RESET_GAP = 1000
+
+class JitterBuffer:
+    """Адаптивный джиттер-буфер одного отправителя.
+
+    Кадры упорядочиваются по sequence и выдаются по их исходным меткам времени со сдвигом
+    target_delay, поэтому пачка кадров, пришедшая разом, уходит получателям равномерно.
+    target_delay подстраивается под измеренный джиттер прибытия (оценка из RFC 3550)
+    в пределах [min_delay, max_delay]. Кадры, пришедшие после своего времени воспроизведения,
+    отбрасываются как опоздавшие; пропуски, которые не пришли вовремя, считаются потерянными.
+    """
+
+    def __init__(
+        self,
+        min_delay: float = config.VOICE_JITTER_MIN_DELAY,
+        max_delay: float = config.VOICE_JITTER_MAX_DELAY,
+        max_frames: int = config.VOICE_JITTER_MAX_FRAMES
+    ):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.max_frames = max_frames
+        self._frames = {}  # sequence -> VoiceFrame
+        self._next_seq = None
+        self._highest_seq = None
+        self._offset = None  # Минимальная наблюдаемая разница (прибытие - метка отправителя), секунды
+        self._last_transit = None
+        self.jitter = 0.0  # секунды
+        self.received = 0
+        self.released = 0
+        self.late = 0
+        self.lost = 0
+        self.reordered = 0
+        self.duplicate = 0
+
+    @property
+    def target_delay(self) -> float:
+        return min(self.max_delay, max(self.min_delay, 3 * self.jitter))
+
+    @property
+    def depth(self) -> int:
+        return len(self._frames)
+
+    def _playout_time(self, frame: VoiceFrame) -> float:
+        return frame.timestamp / 1000 + self._offset + self.target_delay
+
+    def push(self, frame: VoiceFrame, now: float):
+        """Принимает кадр; now — серверное время прибытия (time.time())"""
+        self.received += 1
+        seq = frame.sequence
+
+        transit = now - frame.timestamp / 1000
+        if self._last_transit is not None:
+            self.jitter += (abs(transit - self._last_transit) - self.jitter) / 16
+        self._last_transit = transit
+        if self._offset is None or transit < self._offset or transit - self._offset > self.max_delay * 4:
+            # Первый кадр, более быстрый путь или сбой часов отправителя — пересчитываем базу
+            self._offset = transit
+
+        if self._next_seq is None or abs(sequence_diff(seq, self._next_seq)) > SEQUENCE_RESET_GAP:
+            # Первый кадр или отправитель начал нумерацию заново
+            self._frames.clear()
+            self._next_seq = seq
+            self._highest_seq = None
+        if sequence_diff(seq, self._next_seq) < 0:
+            # Время этого кадра уже прошло, его место в потоке занято
+            self.late += 1
+            return
+        if seq in self._frames:
+            self.duplicate += 1
+            return
+        if self._highest_seq is not None and sequence_diff(seq, self._highest_seq) < 0:
+            self.reordered += 1
+        else:
+            self._highest_seq = seq
+        self._frames[seq] = frame
+
+    def pop_ready(self, now: float) -> List[VoiceFrame]:
+        """Выдает по порядку все кадры, чье время воспроизведения наступило"""
+        ready = []
+        while self._frames:
+            frame = self._frames.get(self._next_seq)
+            if frame is not None:
+                if self._playout_time(frame) > now and len(self._frames) <= self.max_frames:
+                    break
+                del self._frames[self._next_seq]
+                ready.append(frame)
+                self._next_seq = (self._next_seq + 1) % SEQUENCE_MODULO
+                continue
+            # Ожидаемого кадра нет: ждем его, пока не подойдет время следующего из имеющихся
+            earliest = min(self._frames, key=lambda s: sequence_diff(s, self._next_seq))
+            if self._playout_time(self._frames[earliest]) > now and len(self._frames) <= self.max_frames:
+                break
+            self.lost += sequence_diff(earliest, self._next_seq)
+            self._next_seq = earliest
+        self.released += len(ready)
+        return ready
+
+    def get_stats(self) -> dict:
+        return {
+            'received': self.received,
+            'released': self.released,
+            'late': self.late,
+            'lost': self.lost,
+            'reordered': self.reordered,
+            'duplicate': self.duplicate,
+            'depth': self.depth,
+            'jitter_ms': round(self.jitter * 1000, 2),
+            'target_delay_ms': round(self.target_delay * 1000, 2)
+        }
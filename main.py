@@ -14,6 +14,8 @@ import os
 import shutil
 import uuid
 import asyncio
+import time
+import math
 
 from database import *
 import models as models
@@ -22,6 +24,23 @@ import auth as auth
 import crud as crud
 import config
 from audio_handler import audio_handler
+from websocket_sender import WebSocketSender
+from encoding import dumps_json, negotiate_encoding, encode_message, decode_message
+from voice_protocol import VoiceFrame, KIND_AUDIO, FLAG_MIXED, encode_frame, decode_frame, guess_codec
+from voice_mixer import ChannelMixer, mixing_available
+from jitter_buffer import JitterBuffer
+from voice_activity import VoiceActivityDetector
+from voice_backplane import (
+    create_backplane, rendezvous_owner, MESSAGE_AUDIO, MESSAGE_CONTROL, MESSAGE_DROPPABLE,
+    MESSAGE_UPSERT, MESSAGE_LEAVE, MESSAGE_HELLO, MESSAGE_VIDEO, VIDEO_HEADER
+)
+from video_relay import VideoRelay
+from heartbeat import TimerWheel
+from voice_recorder import VoiceRecorder
+from gateway import gateway, server_topic, channel_topic
+from presence import presence
+from typing_indicator import typing_tracker
+from rate_limit import login_limiter
 
 # Import User model explicitly
 from models import User, Channel, ServerMember, Message
@@ -61,19 +80,83 @@ app.add_middleware(
 
 # WebSocket connection manager
 class ConnectionManager:
+    """Соединения /ws, разложенные по темам.
+
+    Подключение и отключение — O(1) операции над множествами. Рассылка только ставит
+    сообщение в ограниченную очередь WebSocketSender каждого получателя, а отправляют
+    их задачи-писатели параллельно; клиент, очередь которого переполнилась, отключается
+    и не задерживает остальных.
+    """
+
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Dict[WebSocket, WebSocketSender] = {}
+        self.topics: Dict[str, set] = {}        # topic -> WebSocketSender подписчиков
+        self.subscriptions: Dict[WebSocket, set] = {}  # websocket -> topics
+        self.broadcasts = 0
+        self.evicted = 0
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, topic: str = "global"):
         await websocket.accept()
-        self.active_connections.append(websocket)
 
-    def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
+        async def on_error():
+            # Медленный или оборванный клиент
+            self.evicted += 1
+            self.disconnect(websocket)
+            try:
+                await websocket.close()
+            except Exception:
+                pass
+
+        sender = WebSocketSender(websocket, on_error=on_error, control_limit=config.WS_SEND_QUEUE_LIMIT, log_tag="WS")
+        sender.start()
+        self.active_connections[websocket] = sender
+        self.subscriptions[websocket] = set()
+        self.subscribe(websocket, topic)
 
-    async def broadcast(self, message: str):
-        for connection in self.active_connections:
-            await connection.send_text(message)
+    def subscribe(self, websocket: WebSocket, topic: str):
+        sender = self.active_connections.get(websocket)
+        if sender is None:
+            return
+        self.topics.setdefault(topic, set()).add(sender)
+        self.subscriptions[websocket].add(topic)
+
+    def _discard(self, topic: str, sender: WebSocketSender):
+        subscribers = self.topics.get(topic)
+        if subscribers is not None:
+            subscribers.discard(sender)
+            if not subscribers:
+                del self.topics[topic]
+
+    def unsubscribe(self, websocket: WebSocket, topic: str):
+        sender = self.active_connections.get(websocket)
+        if sender is None:
+            return
+        self._discard(topic, sender)
+        self.subscriptions[websocket].discard(topic)
+
+    def disconnect(self, websocket: WebSocket):
+        sender = self.active_connections.pop(websocket, None)
+        if sender is None:
+            return
+        for topic in self.subscriptions.pop(websocket, ()):
+            self._discard(topic, sender)
+        sender.close()
+
+    async def broadcast(self, message: str, topic: str = "global"):
+        self.broadcasts += 1
+        # send только ставит в очередь; отключение при переполнении идет отдельной задачей,
+        # поэтому множество не меняется во время обхода
+        for sender in self.topics.get(topic, ()):
+            sender.send(message)
+
+    def get_stats(self) -> dict:
+        return {
+            'connections': len(self.active_connections),
+            'topics': len(self.topics),
+            'broadcasts': self.broadcasts,
+            'evicted': self.evicted,
+            'queued': sum(sender.queue_depth for sender in self.active_connections.values())
+        }
 
 manager = ConnectionManager()
 
@@ -82,37 +165,71 @@ class VoiceChannelManager:
     def __init__(self):
         self.voice_channels = {}  # channel_id -> set of user_ids
         self.user_channels = {}   # user_id -> channel_id
-        self.audio_streams = {}   # (channel_id, user_id) -> {'input': stream, 'output': stream}
+        self.audio_streams = {}   # (channel_id, user_id) -> {'output': stream}, только в режиме мониторинга
         self.user_websockets = {} # user_id -> websocket
+        self.user_senders = {}    # user_id -> WebSocketSender
         self.connection_locks = {} # channel_id -> asyncio.Lock
-        self._cleanup_task = None
+        # Дедлайны активности соединений: молчащему клиенту шлем ping, не ответившего отключаем
+        self.heartbeats = TimerWheel(self._on_heartbeat_timeout)
+        self._heartbeat_probes = set()  # user_ids, которым отправлен ping без ответа
+        self.recordings = {}  # channel_id -> VoiceRecorder активной записи
         self.user_states = {}     # user_id -> {'isMuted': bool, 'isDeafened': bool}
+        self.audio_sequences = {} # user_id -> следующий номер кадра для клиентов без бинарного формата
+        self.mixers = {}          # channel_id -> ChannelMixer, для каналов в режиме сведения
+        self._mix_tasks = {}      # channel_id -> asyncio.Task
+        self.jitter_buffers = {}  # user_id -> JitterBuffer входящего потока
+        self._jitter_task = None
+        self._jitter_wakeup = asyncio.Event()
+        self.voice_activity = {}  # user_id -> VoiceActivityDetector
+        # Маршрутизация аудио пересчитывается при смене состояния, а не на каждом кадре
+        self.channel_speakers = {}   # channel_id -> set of user_ids с включенным микрофоном
+        self.channel_listeners = {}  # channel_id -> set of user_ids, не отключивших звук
+        # Участники тех же каналов на других воркерах, известные через шину
+        self.backplane = None
+        self.remote_participants = {}  # channel_id -> {user_id: participant}
+        self.remote_owners = {}  # (channel_id, user_id) -> воркер участника, чтобы убрать его участников при таймауте
+        self.video_relays = {}  # channel_id -> VideoRelay
+        # Список участников рассылается дельтами с номером версии; полный снимок — при подключении
+        # или по запросу sync, когда клиент заметил пропуск версии
+        self.participant_versions = {}  # channel_id -> версия списка участников
+        self._pending_states = {}       # channel_id -> user_ids с еще не разосланным состоянием
+        self._state_flush = {}          # channel_id -> asyncio.TimerHandle
+
+    def _touch(self, user_id):
+        """Клиент проявил активность: откладываем проверку его соединения"""
+        self._heartbeat_probes.discard(user_id)
+        self.heartbeats.schedule(user_id, config.VOICE_HEARTBEAT_INTERVAL)
+        presence.touch(user_id)
+
+    def _on_heartbeat_timeout(self, user_id):
+        websocket = self.user_websockets.get(user_id)
+        if websocket is None:
+            return
+        if user_id in self._heartbeat_probes:
+            print(f"[VOICE] Heartbeat timeout for user {user_id}, disconnecting")
+            asyncio.create_task(self._drop_connection(user_id, websocket))
+            return
+        # Клиент давно молчит: просим ответить, он отвечает pong
+        self._heartbeat_probes.add(user_id)
+        sender = self.user_senders.get(user_id)
+        if sender:
+            sender.send(dumps_json({'type': 'ping'}))
+        self.heartbeats.schedule(user_id, config.VOICE_HEARTBEAT_TIMEOUT)
+
+    async def _drop_connection(self, user_id, websocket):
+        try:
+            await asyncio.wait_for(websocket.close(code=1001), timeout=1)
+        except Exception:
+            pass
+        await self._on_send_error(user_id, websocket)
 
-    async def _start_cleanup_task(self):
-        """Запускает периодическую очистку неактивных соединений"""
-        if self._cleanup_task is None:
-            self._cleanup_task = asyncio.create_task(self._cleanup_inactive_connections())
-
-    async def _cleanup_inactive_connections(self):
-        """Периодически проверяет и очищает неактивные соединения"""
-        while True:
-            try:
-                await asyncio.sleep(300)  # Проверка каждые 5 минут
-                current_time = datetime.now()
-                
-                # Очистка неактивных WebSocket соединений
-                for user_id, websocket in list(self.user_websockets.items()):
-                    if not websocket.client_state.CONNECTED:
-                        await self.disconnect_user(user_id)
-                
-                # Очистка неиспользуемых аудио потоков
-                for stream_id, streams in list(self.audio_streams.items()):
-                    channel_id, user_id = stream_id
-                    if user_id not in self.user_websockets:
-                        audio_handler.close_stream(stream_id)
-                        del self.audio_streams[stream_id]
-            except Exception as e:
-                print(f"Error in cleanup task: {e}")
+    async def _start_backplane(self):
+        """Подключает менеджер к шине между воркерами"""
+        if self.backplane is None:
+            backplane = create_backplane()
+            await backplane.start(self._on_backplane_message, self._on_backplane_worker_lost)
+            self.backplane = backplane
+            print(f"[VOICE] Backplane {type(backplane).__name__} started, worker {backplane.worker_id}")
 
     async def connect_user(self, websocket, channel_id, user_id):
         try:
@@ -136,8 +253,25 @@ class VoiceChannelManager:
                 # Добавляем пользователя в канал
                 self.voice_channels[channel_id].add(user_id)
                 self.user_channels[user_id] = channel_id
+                if user_id not in self.user_websockets:
+                    # Переподключение к тому же каналу заменяет соединение, а не добавляет его:
+                    # disconnect_user вызовется для пользователя один раз
+                    presence.connect(user_id)
+                old_websocket = self.user_websockets.get(user_id)
+                if old_websocket is not None and old_websocket is not websocket:
+                    # Старое соединение закрывается, иначе его цикл приема продолжал бы
+                    # пересылать кадры от имени пользователя
+                    asyncio.create_task(self._drop_connection(user_id, old_websocket))
                 self.user_websockets[user_id] = websocket
                 
+                # Исходящая очередь пользователя со своей задачей отправки
+                old_sender = self.user_senders.pop(user_id, None)
+                if old_sender:
+                    old_sender.close()
+                sender = WebSocketSender(websocket, on_error=lambda: self._on_send_error(user_id, websocket))
+                sender.start()
+                self.user_senders[user_id] = sender
+                
                 # Инициализируем состояние пользователя
                 self.user_states[user_id] = {
                     'isMuted': False,
@@ -145,71 +279,107 @@ class VoiceChannelManager:
                     'isVideoEnabled': False,
                     'isScreenSharing': False
                 }
+                self._update_routing(channel_id)
                 
-                # Создаем аудио потоки
-                input_stream = audio_handler.create_input_stream((channel_id, user_id))
-                output_stream = audio_handler.create_output_stream((channel_id, user_id))
+                # Локальный поток воспроизведения нужен только в режиме мониторинга;
+                # в режиме relay сервер лишь пересылает кадры
+                if audio_handler.monitoring_enabled:
+                    output_stream = audio_handler.create_output_stream((channel_id, user_id))
+                    if output_stream:
+                        self.audio_streams[(channel_id, user_id)] = {
+                            'output': output_stream
+                        }
+                        print(f"[VOICE] Audio stream created for user {user_id} in channel {channel_id}")
+                    else:
+                        raise RuntimeError("Failed to create audio streams")
                 
-                if input_stream and output_stream:
-                    self.audio_streams[(channel_id, user_id)] = {
-                        'input': input_stream,
-                        'output': output_stream
-                    }
-                    print(f"[VOICE] Audio streams created for user {user_id} in channel {channel_id}")
-                else:
-                    raise RuntimeError("Failed to create audio streams")
+                # Соединение отслеживается по активности клиента
+                self.heartbeats.start()
+                self._touch(user_id)
+                self._update_mix_mode(channel_id)
                 
-                # Запускаем задачу очистки, если она еще не запущена
-                await self._start_cleanup_task()
+                # Сообщаем о подключении воркерам, где есть участники этого канала
+                await self._start_backplane()
+                if channel_id not in self.backplane.channels:
+                    await self.backplane.subscribe(channel_id)
+                    self.backplane.publish(channel_id, MESSAGE_HELLO, b'')
+                self.backplane.publish(channel_id, MESSAGE_UPSERT, dumps_json([self._participant_info(user_id)]).encode())
                 
-                # Уведомляем других участников
+                # Остальные участники получают дельту, новый — полный список
                 await self.broadcast_user_joined(channel_id, user_id)
+                await self.send_participants_snapshot(channel_id, user_id)
                 
-                # Отправляем список участников всем пользователям в канале
-                await self.send_participants_list(channel_id)
+                # Последние ключевые кадры видео, чтобы новый участник сразу видел картинку
+                relay = self.video_relays.get(channel_id)
+                if relay:
+                    for _, _, payload in relay.join(user_id, time.monotonic()):
+                        sender.send(payload, droppable=True)
                 
                 print(f"[VOICE] User {user_id} successfully connected to channel {channel_id}")
                 
-                try:
-                    while True:
+            # Цикл приема выполняется вне блокировки канала, иначе следующий участник
+            # не сможет подключиться, пока в канале есть хотя бы один пользователь
+            try:
+                while True:
+                    try:
+                        data = await websocket.receive()
+                    except WebSocketDisconnect:
+                        print(f"[VOICE] User {user_id} disconnected")
+                        break
+                    except Exception as e:
+                        print(f"[VOICE] Exception in receive: {e}")
+                        break
+                        
+                    if data['type'] == 'websocket.disconnect':
+                        print(f"[VOICE] Disconnect received for user {user_id}")
+                        break
+                    if self.user_websockets.get(user_id) is not websocket:
+                        # Пользователь переподключился другим соединением
+                        break
+                    self._touch(user_id)
+                        
+                    if data.get('bytes') is not None:
+                        # Бинарный голосовой кадр
+                        await self.handle_audio_data(channel_id, user_id, data['bytes'])
+                    elif data.get('text') is not None:
                         try:
-                            data = await websocket.receive()
-                        except WebSocketDisconnect:
-                            print(f"[VOICE] User {user_id} disconnected")
-                            break
-                        except Exception as e:
-                            print(f"[VOICE] Exception in receive: {e}")
-                            break
+                            msg = data['text']
+                            parsed = json.loads(msg)
                             
-                        if data['type'] == 'websocket.disconnect':
-                            print(f"[VOICE] Disconnect received for user {user_id}")
-                            break
-                            
-                        if 'text' in data:
-                            try:
-                                msg = data['text']
-                                parsed = json.loads(msg)
-                                
-                                if parsed['type'] == 'audio':
-                                    print(f"[VOICE] Received audio from user {user_id}")
-                                    await self.handle_audio_data(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'video':
-                                    await self.broadcast_video(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'screen':
-                                    await self.broadcast_screen(channel_id, user_id, parsed['data'])
-                                elif parsed['type'] == 'state_update':
-                                    # Обновляем состояние пользователя
-                                    if user_id in self.user_states:
-                                        self.user_states[user_id].update(parsed.get('state', {}))
-                                        # Уведомляем других участников об изменении состояния
-                                        await self.broadcast_user_state(channel_id, user_id)
-                                elif parsed['type'] == 'join':
-                                    await self.send_participants_list(channel_id)
-                            except json.JSONDecodeError as e:
-                                print(f"Error decoding message from user {user_id}: {e}")
-                            except Exception as e:
-                                print(f"Error processing message from user {user_id}: {e}")
-                finally:
+                            if parsed['type'] == 'audio':
+                                print(f"[VOICE] Received audio from user {user_id}")
+                                await self.handle_audio_data(channel_id, user_id, parsed['data'])
+                            elif parsed['type'] == 'video':
+                                await self.broadcast_video(channel_id, user_id, parsed['data'], parsed.get('keyframe'))
+                            elif parsed['type'] == 'screen':
+                                await self.broadcast_screen(channel_id, user_id, parsed['data'], parsed.get('keyframe'))
+                            elif parsed['type'] == 'state_update':
+                                await self.update_user_state(channel_id, user_id, parsed.get('state', {}))
+                            elif parsed['type'] == 'mute_state':
+                                await self.update_user_state(channel_id, user_id, {'isMuted': bool(parsed.get('isMuted'))})
+                            elif parsed['type'] == 'deafen_state':
+                                await self.update_user_state(channel_id, user_id, {'isDeafened': bool(parsed.get('isDeafened'))})
+                            elif parsed['type'] == 'video_state':
+                                await self.update_user_state(channel_id, user_id, {'isVideoEnabled': bool(parsed.get('isEnabled'))})
+                            elif parsed['type'] == 'screen_share_state':
+                                await self.update_user_state(channel_id, user_id, {'isScreenSharing': bool(parsed.get('isEnabled'))})
+                            elif parsed['type'] == 'sync':
+                                await self.send_participants_snapshot(channel_id, user_id)
+                            elif parsed['type'] == 'join':
+                                # Снимок уже отправлен при подключении; повторный join получает его,
+                                # только если клиент сообщил устаревшую версию списка
+                                version = parsed.get('version')
+                                if isinstance(version, int) and version < self.participant_versions.get(channel_id, 0):
+                                    await self.send_participants_snapshot(channel_id, user_id)
+                            elif parsed['type'] == 'ping':
+                                sender.send(dumps_json({'type': 'pong'}))
+                        except json.JSONDecodeError as e:
+                            print(f"Error decoding message from user {user_id}: {e}")
+                        except Exception as e:
+                            print(f"Error processing message from user {user_id}: {e}")
+            finally:
+                # Пользователь мог уже переподключиться другим соединением — его не трогаем
+                if self.user_websockets.get(user_id) is websocket:
                     await self.disconnect_user(user_id)
         except Exception as e:
             print(f"Error in connect_user: {e}")
@@ -220,12 +390,39 @@ class VoiceChannelManager:
         try:
             if user_id in self.user_channels:
                 channel_id = self.user_channels[user_id]
+                presence.disconnect(user_id)
                 
                 # Удаляем пользователя из канала
                 if channel_id in self.voice_channels:
                     self.voice_channels[channel_id].discard(user_id)
                     if not self.voice_channels[channel_id]:
                         del self.voice_channels[channel_id]
+                self._update_routing(channel_id)
+                self.heartbeats.cancel(user_id)
+                self._heartbeat_probes.discard(user_id)
+                if self.backplane:
+                    self.backplane.publish(channel_id, MESSAGE_LEAVE, dumps_json({'id': user_id}).encode())
+                    if channel_id not in self.voice_channels:
+                        # Локальных участников не осталось — сообщения канала этому воркеру не нужны
+                        await self.backplane.unsubscribe(channel_id)
+                        for remote_id in self.remote_participants.pop(channel_id, {}):
+                            self.remote_owners.pop((channel_id, remote_id), None)
+                relay = self.video_relays.get(channel_id)
+                if relay:
+                    if channel_id in self.voice_channels:
+                        relay.remove_user(user_id)
+                    else:
+                        del self.video_relays[channel_id]
+                if channel_id not in self.voice_channels:
+                    self._reset_participant_versions(channel_id)
+                    # Канал опустел — запись завершается
+                    await self.stop_recording(channel_id)
+                mixer = self.mixers.get(channel_id)
+                if mixer:
+                    mixer.remove(user_id)
+                self._update_mix_mode(channel_id)
+                self.jitter_buffers.pop(user_id, None)
+                self._reset_voice_activity(channel_id, user_id)
                 
                 # Закрываем аудио потоки
                 stream_id = (channel_id, user_id)
@@ -236,62 +433,358 @@ class VoiceChannelManager:
                 # Удаляем WebSocket соединение
                 if user_id in self.user_websockets:
                     del self.user_websockets[user_id]
+                sender = self.user_senders.pop(user_id, None)
+                if sender:
+                    sender.close()
                 
                 # Удаляем информацию о канале пользователя
                 del self.user_channels[user_id]
+                self.audio_sequences.pop(user_id, None)
                 
                 # Уведомляем других участников
                 await self.broadcast_user_left(channel_id, user_id)
-                await self.send_participants_list(channel_id)
         except Exception as e:
             print(f"Error in disconnect_user: {e}")
 
+    async def update_user_state(self, channel_id, user_id, state):
+        """Обновляет состояние пользователя и маршрутизацию аудио канала"""
+        if user_id not in self.user_states:
+            return
+        previous = dict(self.user_states[user_id])
+        self.user_states[user_id].update(state)
+        self._update_routing(channel_id)
+        self._drop_stopped_streams(channel_id, user_id, previous, self.user_states[user_id])
+        if self.backplane:
+            self.backplane.publish(channel_id, MESSAGE_UPSERT, dumps_json([self._participant_info(user_id)]).encode())
+        if self.user_states[user_id].get('isMuted'):
+            # Накопленные до выключения микрофона кадры больше не нужны
+            self.jitter_buffers.pop(user_id, None)
+            # Кадров больше не будет, и детектор сам не заметит конец речи
+            self._reset_voice_activity(channel_id, user_id)
+        # Уведомляем других участников об изменении состояния
+        await self.broadcast_user_state(channel_id, user_id)
+
+    def _drop_stopped_streams(self, channel_id, user_id, previous, current):
+        """Забывает ключевые кадры потоков, которые пользователь выключил"""
+        relay = self.video_relays.get(channel_id)
+        if relay is None:
+            return
+        if previous.get('isVideoEnabled') and not current.get('isVideoEnabled'):
+            relay.remove_stream(user_id, 'video')
+        if previous.get('isScreenSharing') and not current.get('isScreenSharing'):
+            relay.remove_stream(user_id, 'screen')
+
+    def _update_routing(self, channel_id):
+        """Пересчитывает, кто в канале отправляет аудио и кто его получает"""
+        members = self.voice_channels.get(channel_id)
+        if not members:
+            self.channel_speakers.pop(channel_id, None)
+            self.channel_listeners.pop(channel_id, None)
+            return
+        # Множества заменяются целиком, поэтому рассылка может безопасно итерировать старые
+        states = self.user_states
+        self.channel_speakers[channel_id] = {
+            user_id for user_id in members if not states.get(user_id, {}).get('isMuted', False)
+        }
+        self.channel_listeners[channel_id] = {
+            user_id for user_id in members if not states.get(user_id, {}).get('isDeafened', False)
+        }
+
+    async def disconnect_websocket(self, user_id, websocket):
+        """Отключает пользователя, только если это все еще его текущее соединение"""
+        if self.user_websockets.get(user_id) is websocket:
+            await self.disconnect_user(user_id)
+
+    async def _on_send_error(self, user_id, websocket):
+        await self.disconnect_websocket(user_id, websocket)
+
     async def handle_audio_data(self, channel_id, sender_id, audio_data):
-        if channel_id in self.voice_channels:
-            for user_id in self.voice_channels[channel_id]:
-                if user_id != sender_id:
-                    try:
-                        websocket = self.user_websockets.get(user_id)
-                        if websocket and websocket.client_state.CONNECTED:
-                            # Проверяем, что аудио данные не пустые
-                            if not audio_data:
-                                print(f"Empty audio data from user {sender_id}")
-                                continue
-
-                            # Отправляем аудио данные
-                            await websocket.send_json({
-                                'type': 'audio',
-                                'sender_id': sender_id,
-                                'data': audio_data,
-                                'channel_id': channel_id,
-                                'timestamp': datetime.now().timestamp()
-                            })
-                            
-                            # Воспроизводим аудио локально
-                            stream_id = (channel_id, user_id)
-                            if stream_id in self.audio_streams:
-                                audio_handler.play_audio(stream_id, audio_data)
-                    except Exception as e:
-                        print(f"Error sending audio to user {user_id}: {e}")
-                        # Если не удалось отправить аудио, отключаем пользователя
-                        await self.disconnect_user(user_id)
+        """Принимает аудио от клиента: бинарный кадр, сырые байты или base64 из старого JSON-формата"""
+        if isinstance(audio_data, str):
+            try:
+                audio_data = base64.b64decode(audio_data)
+            except Exception as e:
+                print(f"Invalid audio data from user {sender_id}: {e}")
+                return
+        # Проверяем, что аудио данные не пустые
+        if not audio_data:
+            print(f"Empty audio data from user {sender_id}")
+            return
+
+        frame = decode_frame(audio_data)
+        if frame is None:
+            sequence = self.audio_sequences.get(sender_id, 0)
+            self.audio_sequences[sender_id] = sequence + 1
+            frame = VoiceFrame(
+                KIND_AUDIO, guess_codec(audio_data), sender_id, sequence,
+                int(datetime.now().timestamp() * 1000), audio_data
+            )
+        await self.relay_audio_frame(channel_id, sender_id, frame)
+
+    async def relay_audio_frame(self, channel_id, sender_id, frame: VoiceFrame):
+        if sender_id not in self.channel_speakers.get(channel_id, ()):
+            # Канала нет или у отправителя выключен микрофон
+            return
+
+        if config.VOICE_JITTER_ENABLED:
+            # Кадр упорядочивается в джиттер-буфере отправителя и будет выдан в _jitter_loop
+            buffer = self.jitter_buffers.get(sender_id)
+            if buffer is None:
+                buffer = JitterBuffer()
+                self.jitter_buffers[sender_id] = buffer
+            buffer.push(frame, time.time())
+            if self._jitter_task is None:
+                self._jitter_task = asyncio.create_task(self._jitter_loop())
+            self._jitter_wakeup.set()
+            return
+
+        self._forward_audio_frame(channel_id, sender_id, frame)
+
+    async def _jitter_loop(self):
+        """Выдает кадры из джиттер-буферов по их времени воспроизведения"""
+        while True:
+            try:
+                if not any(buffer.depth for buffer in self.jitter_buffers.values()):
+                    self._jitter_wakeup.clear()
+                    await self._jitter_wakeup.wait()
+                await asyncio.sleep(config.VOICE_JITTER_TICK)
+                now = time.time()
+                for sender_id, buffer in list(self.jitter_buffers.items()):
+                    frames = buffer.pop_ready(now)
+                    channel_id = self.user_channels.get(sender_id)
+                    if channel_id is None:
+                        continue
+                    for frame in frames:
+                        self._forward_audio_frame(channel_id, sender_id, frame)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"Error in jitter loop: {e}")
+
+    def _forward_audio_frame(self, channel_id, sender_id, frame: VoiceFrame):
+        if sender_id not in self.channel_speakers.get(channel_id, ()):
+            return
+
+        if config.VOICE_VAD_ENABLED:
+            # Тишина не рассылается; вместо нее участники получают события speaking
+            detector = self.voice_activity.get(sender_id)
+            if detector is None:
+                detector = VoiceActivityDetector()
+                self.voice_activity[sender_id] = detector
+            forward, speaking = detector.update(frame)
+            if speaking is not None:
+                self._broadcast_speaking(channel_id, sender_id, speaking)
+            if not forward:
+                return
+
+        # Кадр кодируется один раз и одинаковыми байтами уходит всем получателям
+        packet = encode_frame(sender_id, frame.sequence, frame.timestamp, frame.payload, frame.flags, frame.kind)
+        if self.remote_participants.get(channel_id):
+            # Участники на других воркерах получат кадр через шину
+            self.backplane.publish(channel_id, MESSAGE_AUDIO, packet)
+        self._deliver_audio(channel_id, sender_id, frame, packet)
+
+    def _broadcast_speaking(self, channel_id, user_id, speaking):
+        self.enqueue_to_channel(channel_id, {
+            'type': 'speaking',
+            'userId': user_id,
+            'speaking': speaking,
+            'channel_id': channel_id
+        })
+
+    def _reset_voice_activity(self, channel_id, user_id):
+        """Забывает детектор речи пользователя; если он говорил, участники узнают, что перестал"""
+        detector = self.voice_activity.pop(user_id, None)
+        if detector is not None and detector.speaking:
+            self._broadcast_speaking(channel_id, user_id, False)
+
+    def _deliver_audio(self, channel_id, sender_id, frame: VoiceFrame, packet: bytes):
+        """Отдает кадр локальным слушателям канала"""
+        recorder = self.recordings.get(channel_id)
+        if recorder:
+            recorder.tap(sender_id, frame)
+
+        mixer = self.mixers.get(channel_id)
+        if mixer:
+            # В режиме сведения кадр уходит в микшер, слушатели получат по одному потоку
+            mixer.push(sender_id, frame)
+            return
+
+        listeners = self.channel_listeners.get(channel_id)
+        if not listeners or listeners == {sender_id}:
+            return
+
+        for user_id in listeners:
+            if user_id == sender_id:
+                continue
+            # Только ставим кадр в очередь получателя; устаревшие кадры отбросит сам отправитель
+            sender = self.user_senders.get(user_id)
+            if sender:
+                sender.send(packet, droppable=True)
+
+            # Воспроизводим аудио локально (в пуле воркеров, не блокируя event loop)
+            stream_id = (channel_id, user_id)
+            if stream_id in self.audio_streams:
+                audio_handler.submit_playback(stream_id, frame.payload)
+
+    async def start_recording(self, channel_id, user_id):
+        recorder = self.recordings.get(channel_id)
+        if recorder is None:
+            recorder = VoiceRecorder(channel_id, user_id)
+            recorder.start()
+            self.recordings[channel_id] = recorder
+            print(f"[VOICE] Recording {recorder.session_id} started in channel {channel_id} by user {user_id}")
+            # Участники должны знать, что их записывают
+            await self.broadcast_to_channel(channel_id, {
+                'type': 'recording',
+                'recording': True,
+                'sessionId': recorder.session_id,
+                'startedBy': user_id,
+                'channel_id': channel_id
+            })
+        return recorder
+
+    async def stop_recording(self, channel_id):
+        recorder = self.recordings.pop(channel_id, None)
+        if recorder is None:
+            return None
+        await self.broadcast_to_channel(channel_id, {
+            'type': 'recording',
+            'recording': False,
+            'sessionId': recorder.session_id,
+            'channel_id': channel_id
+        })
+        # Сведение может занять минуты, выполняется в фоне
+        asyncio.create_task(self._finish_recording(recorder))
+        return recorder
+
+    async def _finish_recording(self, recorder):
+        try:
+            output_path = await asyncio.to_thread(recorder.finish)
+            if output_path:
+                await asyncio.to_thread(register_recording, recorder, output_path)
+                print(f"[VOICE] Recording {recorder.session_id} saved as media {recorder.media_id}")
+        except Exception as e:
+            recorder.status = 'failed'
+            print(f"Error finishing recording {recorder.session_id}: {e}")
+
+    def _update_mix_mode(self, channel_id):
+        """Включает сведение для больших каналов и выключает, когда участников стало мало"""
+        participants = len(self.voice_channels.get(channel_id, ()))
+        should_mix = (
+            config.VOICE_MIX_ENABLED
+            and mixing_available()
+            and participants >= config.VOICE_MIX_THRESHOLD
+        )
+        if should_mix and channel_id not in self.mixers:
+            print(f"[VOICE] Channel {channel_id} switched to mixing mode ({participants} participants)")
+            self.mixers[channel_id] = ChannelMixer()
+            self._mix_tasks[channel_id] = asyncio.create_task(self._mix_loop(channel_id))
+        elif not should_mix and channel_id in self.mixers:
+            print(f"[VOICE] Channel {channel_id} switched to relay mode")
+            task = self._mix_tasks.pop(channel_id, None)
+            if task:
+                task.cancel()
+            self.mixers.pop(channel_id).close()
+
+    async def _mix_loop(self, channel_id):
+        """Раз в кадр сводит голоса канала и рассылает каждому слушателю его микс"""
+        mixer = self.mixers[channel_id]
+        loop = asyncio.get_running_loop()
+        interval = mixer.frame_ms / 1000
+        next_tick = loop.time()
+        while True:
+            next_tick = max(next_tick + interval, loop.time())
+            await asyncio.sleep(next_tick - loop.time())
+            try:
+                # Участники, отключившие звук, микс не получают
+                listeners = list(self.channel_listeners.get(channel_id, ()))
+                # Декодирование и NumPy-сведение выполняются вне event loop
+                mixes = await asyncio.to_thread(mixer.mix, listeners)
+                timestamp = int(datetime.now().timestamp() * 1000)
+                packets = {}  # id(payload) -> пакет: одинаковый микс кодируется один раз
+                for listener, payload in mixes.items():
+                    packet = packets.get(id(payload))
+                    if packet is None:
+                        packet = encode_frame(0, mixer.sequence, timestamp, payload, mixer.codec | FLAG_MIXED)
+                        packets[id(payload)] = packet
+                    sender = self.user_senders.get(listener)
+                    if sender:
+                        sender.send(packet, droppable=True)
+            except Exception as e:
+                print(f"Error in mix loop for channel {channel_id}: {e}")
+
+    def _on_backplane_message(self, channel_id, source, kind, payload):
+        """Обрабатывает сообщение другого воркера для канала, где есть локальные участники"""
+        if kind == MESSAGE_AUDIO:
+            frame = decode_frame(payload)
+            if frame is not None:
+                self._deliver_audio(channel_id, frame.sender_id, frame, payload)
+        elif kind == MESSAGE_VIDEO:
+            sender_id, media_kind, keyframe = VIDEO_HEADER.unpack_from(payload)
+            self.relay_media(
+                channel_id, sender_id, 'screen' if media_kind == b's' else 'video',
+                payload[VIDEO_HEADER.size:].decode(), (None, False, True)[keyframe], local=True
+            )
+        elif kind in (MESSAGE_CONTROL, MESSAGE_DROPPABLE):
+            self.enqueue_to_channel(channel_id, payload.decode(), kind == MESSAGE_DROPPABLE, local=True)
+        elif kind == MESSAGE_UPSERT:
+            # Об изменениях участников других воркеров локальным пользователям сообщает этот воркер
+            remote = self.remote_participants.setdefault(channel_id, {})
+            for participant in json.loads(payload):
+                known = participant['id'] in remote
+                self._drop_stopped_streams(channel_id, participant['id'], remote.get(participant['id'], {}), participant)
+                remote[participant['id']] = participant
+                self.remote_owners[(channel_id, participant['id'])] = source
+                if known:
+                    self._queue_participant_state(channel_id, participant['id'])
+                else:
+                    self._send_participant_delta(channel_id, {
+                        'type': 'participant_joined',
+                        'participant': participant,
+                        'channel_id': channel_id
+                    })
+        elif kind == MESSAGE_LEAVE:
+            self._remove_remote_participant(channel_id, json.loads(payload)['id'])
+        elif kind == MESSAGE_HELLO:
+            # Новый воркер канала: сообщаем ему своих участников
+            members = self.voice_channels.get(channel_id)
+            if members:
+                participants = [self._participant_info(user_id) for user_id in members]
+                self.backplane.publish(channel_id, MESSAGE_UPSERT, dumps_json(participants).encode())
+                # и последние ключевые кадры их видео
+                relay = self.video_relays.get(channel_id)
+                if relay:
+                    for (sender_id, media_kind), (data, keyframe) in list(relay.keyframes.items()):
+                        if sender_id in members:
+                            self._publish_media(channel_id, sender_id, media_kind, data, keyframe)
+
+    def _remove_remote_participant(self, channel_id, user_id):
+        self.remote_owners.pop((channel_id, user_id), None)
+        relay = self.video_relays.get(channel_id)
+        if relay:
+            relay.remove_user(user_id)
+        if self.remote_participants.get(channel_id, {}).pop(user_id, None) is not None:
+            self._send_participant_delta(channel_id, {'type': 'participant_left', 'userId': user_id})
+
+    def _on_backplane_worker_lost(self, worker_id):
+        """Воркер перестал присылать heartbeat: его участники покидают каналы"""
+        lost = [key for key, owner in self.remote_owners.items() if owner == worker_id]
+        if lost:
+            print(f"[VOICE] Worker {worker_id} lost, removing {len(lost)} remote participants")
+        for channel_id, user_id in lost:
+            self._remove_remote_participant(channel_id, user_id)
 
     async def broadcast_user_joined(self, channel_id, user_id):
         if channel_id in self.voice_channels:
-            state = self.user_states.get(user_id, {})
             message = {
                 'type': 'participant_joined',
-                'participant': {
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                },
+                'participant': self._participant_info(user_id),
                 'channel_id': channel_id
             }
             print(f"[VOICE] Broadcasting user {user_id} joined to channel {channel_id}")
-            await self.broadcast_to_channel(channel_id, message)
+            # Другие воркеры оповещают своих участников сами, получив MESSAGE_UPSERT
+            self._send_participant_delta(channel_id, message, exclude=user_id)
 
     async def broadcast_user_left(self, channel_id, user_id):
         if channel_id in self.voice_channels:
@@ -299,53 +792,148 @@ class VoiceChannelManager:
                 'type': 'participant_left',
                 'userId': user_id
             }
-            await self.broadcast_to_channel(channel_id, message)
+            self._send_participant_delta(channel_id, message)
+
+    def _send_participant_delta(self, channel_id, message, exclude=None):
+        """Рассылает локальным участникам изменение списка со следующим номером версии"""
+        version = self.participant_versions.get(channel_id, 0) + 1
+        self.participant_versions[channel_id] = version
+        message['version'] = version
+        payload = dumps_json(message)
+        for user_id in self.voice_channels.get(channel_id, ()):
+            if user_id == exclude:
+                continue
+            sender = self.user_senders.get(user_id)
+            if sender:
+                sender.send(payload)
+
+    def _queue_participant_state(self, channel_id, user_id):
+        """Откладывает рассылку состояния: изменения за VOICE_STATE_COALESCE_WINDOW уходят одной дельтой"""
+        self._pending_states.setdefault(channel_id, set()).add(user_id)
+        if channel_id not in self._state_flush:
+            self._state_flush[channel_id] = asyncio.get_running_loop().call_later(
+                config.VOICE_STATE_COALESCE_WINDOW, self._flush_participant_states, channel_id
+            )
 
-    async def broadcast_to_channel(self, channel_id, message):
-        if channel_id in self.voice_channels:
-            for user_id in self.voice_channels[channel_id]:
-                try:
-                    websocket = self.user_websockets.get(user_id)
-                    if websocket:
-                        await websocket.send_json(message)
-                except Exception as e:
-                    print(f"Error broadcasting to user {user_id}: {e}")
-                    # Если не удалось отправить сообщение, отключаем пользователя
-                    await self.disconnect_user(user_id)
+    def _flush_participant_states(self, channel_id):
+        self._state_flush.pop(channel_id, None)
+        remote = self.remote_participants.get(channel_id, {})
+        for user_id in self._pending_states.pop(channel_id, ()):
+            if user_id in self.voice_channels.get(channel_id, ()):
+                participant = self._participant_info(user_id)
+            elif user_id in remote:
+                participant = remote[user_id]
+            else:
+                # Участник уже покинул канал
+                continue
+            self._send_participant_delta(channel_id, {
+                'type': 'participant_state',
+                'participant': participant,
+                'channel_id': channel_id
+            })
+
+    def _reset_participant_versions(self, channel_id):
+        handle = self._state_flush.pop(channel_id, None)
+        if handle:
+            handle.cancel()
+        self._pending_states.pop(channel_id, None)
+        self.participant_versions.pop(channel_id, None)
 
-    async def broadcast_video(self, channel_id, sender_id, video_data):
+    async def broadcast_to_channel(self, channel_id, message, droppable=False, local=False):
+        self.enqueue_to_channel(channel_id, message, droppable, local)
+
+    def enqueue_to_channel(self, channel_id, message, droppable=False, local=False):
+        """Рассылает сообщение участникам канала; local=True — только участникам этого воркера"""
+        if not self.voice_channels.get(channel_id):
+            return
+        # Сериализуем один раз: всем участникам уходит одна и та же строка
+        payload = message if isinstance(message, (str, bytes)) else dumps_json(message)
+        if not local and self.remote_participants.get(channel_id):
+            data = payload.encode() if isinstance(payload, str) else payload
+            self.backplane.publish(channel_id, MESSAGE_DROPPABLE if droppable else MESSAGE_CONTROL, data)
+        # Сообщение ставится в очереди всех участников без ожидания сокетов;
+        # ошибки отправки обрабатывает WebSocketSender, отключая пользователя
+        for user_id in self.voice_channels[channel_id]:
+            sender = self.user_senders.get(user_id)
+            if sender:
+                sender.send(payload, droppable=droppable)
+
+    async def broadcast_video(self, channel_id, sender_id, video_data, keyframe=None):
         if channel_id in self.voice_channels:
             message = {
                 'type': 'video',
                 'sender_id': sender_id,
                 'data': video_data
             }
-            await self.broadcast_to_channel(channel_id, message)
+            if keyframe is not None:
+                message['keyframe'] = bool(keyframe)
+            self.relay_media(channel_id, sender_id, 'video', dumps_json(message), keyframe)
 
-    async def broadcast_screen(self, channel_id, sender_id, screen_data):
+    async def broadcast_screen(self, channel_id, sender_id, screen_data, keyframe=None):
         if channel_id in self.voice_channels:
             message = {
                 'type': 'screen',
                 'sender_id': sender_id,
                 'data': screen_data
             }
-            await self.broadcast_to_channel(channel_id, message)
+            if keyframe is not None:
+                message['keyframe'] = bool(keyframe)
+            self.relay_media(channel_id, sender_id, 'screen', dumps_json(message), keyframe)
+
+    def _publish_media(self, channel_id, sender_id, kind, payload, keyframe):
+        header = VIDEO_HEADER.pack(sender_id, kind[:1].encode(), (None, False, True).index(keyframe))
+        self.backplane.publish(channel_id, MESSAGE_VIDEO, header + payload.encode())
+
+    def relay_media(self, channel_id, sender_id, kind, payload, keyframe=None, local=False):
+        """Рассылает сериализованный кадр видео или экрана с учетом кэша и частоты кадров получателей"""
+        if not self.voice_channels.get(channel_id):
+            return
+        keyframe = None if keyframe is None else bool(keyframe)
+        relay = self.video_relays.get(channel_id)
+        if relay is None:
+            relay = self.video_relays[channel_id] = VideoRelay()
+        relay.update(sender_id, kind, payload, keyframe)
+        if not local and self.remote_participants.get(channel_id):
+            self._publish_media(channel_id, sender_id, kind, payload, keyframe)
+        now = time.monotonic()
+        for user_id in self.voice_channels[channel_id]:
+            if user_id == sender_id:
+                continue
+            sender = self.user_senders.get(user_id)
+            if sender and relay.should_send(user_id, sender_id, kind, keyframe, sender.queue_depth, now):
+                sender.send(payload, droppable=True)
 
     async def broadcast_user_state(self, channel_id, user_id):
         if channel_id in self.voice_channels:
-            state = self.user_states.get(user_id, {})
-            message = {
-                'type': 'participant_state',
-                'participant': {
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                },
-                'channel_id': channel_id
-            }
-            await self.broadcast_to_channel(channel_id, message)
+            self._queue_participant_state(channel_id, user_id)
+
+    def _participant_info(self, user_id):
+        state = self.user_states.get(user_id, {})
+        return {
+            'id': user_id,
+            'isMuted': state.get('isMuted', False),
+            'isDeafened': state.get('isDeafened', False),
+            'isVideoEnabled': state.get('isVideoEnabled', False),
+            'isScreenSharing': state.get('isScreenSharing', False)
+        }
+
+    def channel_participants(self, channel_id):
+        """Участники канала на этом и на других воркерах"""
+        participants = {
+            user_id: participant
+            for user_id, participant in self.remote_participants.get(channel_id, {}).items()
+        }
+        for user_id in self.voice_channels.get(channel_id, ()):
+            participants[user_id] = self._participant_info(user_id)
+        return list(participants.values())
+
+    def _participants_message(self, channel_id):
+        return {
+            'type': 'participants',
+            'participants': self.channel_participants(channel_id),
+            'channel_id': channel_id,
+            'version': self.participant_versions.get(channel_id, 0)
+        }
 
     def cleanup(self):
         # Clean up all audio streams
@@ -362,41 +950,167 @@ class VoiceChannelManager:
         self.audio_streams.clear()
         audio_handler.cleanup()
 
-    async def send_participants_list(self, channel_id):
-        if channel_id in self.voice_channels:
-            participants = []
-            for user_id in self.voice_channels[channel_id]:
-                state = self.user_states.get(user_id, {})
-                participants.append({
-                    'id': user_id,
-                    'isMuted': state.get('isMuted', False),
-                    'isDeafened': state.get('isDeafened', False),
-                    'isVideoEnabled': state.get('isVideoEnabled', False),
-                    'isScreenSharing': state.get('isScreenSharing', False)
-                })
-            
-            message = {
-                'type': 'participants',
-                'participants': participants,
-                'channel_id': channel_id
-            }
-            
-            print(f"[VOICE] Sending participants list for channel {channel_id}: {participants}")
-            await self.broadcast_to_channel(channel_id, message)
+    async def send_participants_snapshot(self, channel_id, user_id):
+        """Отправляет одному пользователю полный список участников с текущей версией"""
+        sender = self.user_senders.get(user_id)
+        if sender and channel_id in self.voice_channels:
+            message = self._participants_message(channel_id)
+            print(f"[VOICE] Sending participants snapshot v{message['version']} for channel {channel_id} to user {user_id}")
+            sender.send(dumps_json(message))
+
+def register_recording(recorder, output_path):
+    """Регистрирует сведенную запись как медиафайл канала"""
+    db = SessionLocal()
+    try:
+        media = crud.create_media(
+            db,
+            schemas.MediaCreate(
+                url=f"/media/recordings/{os.path.basename(output_path)}",
+                type=models.MediaType.AUDIO,
+                name=f"Voice recording {datetime.fromtimestamp(recorder.started_at):%Y-%m-%d %H:%M}",
+                size=os.path.getsize(output_path),
+                duration=recorder.duration
+            ),
+            uploaded_by_id=recorder.started_by,
+            channel_id=recorder.channel_id
+        )
+        recorder.media_id = media.id
+    finally:
+        db.close()
 
 voice_manager = VoiceChannelManager()
 
 @app.websocket("/ws")
-async def websocket_endpoint(websocket: WebSocket):
-    await manager.connect(websocket)
+async def websocket_endpoint(websocket: WebSocket, topic: str = "global"):
+    await manager.connect(websocket, topic)
     try:
         while True:
             data = await websocket.receive_text()
             # Handle incoming WebSocket messages here
-            await manager.broadcast(f"Message: {data}")
+            await manager.broadcast(f"Message: {data}", topic)
     except WebSocketDisconnect:
         manager.disconnect(websocket)
-        await manager.broadcast("Client disconnected")
+        await manager.broadcast("Client disconnected", topic)
+    except Exception:
+        # Соединение могло быть уже закрыто при отключении медленного клиента
+        manager.disconnect(websocket)
+
+def _gateway_user(token: str):
+    """Пользователь по токену шлюза или None"""
+    try:
+        payload = jwt.decode(token, config.SECRET_KEY, algorithms=[config.ALGORITHM])
+    except JWTError:
+        return None
+    user_email = payload.get("sub")
+    if not user_email:
+        return None
+    db = SessionLocal()
+    try:
+        return db.query(User).filter(User.email == user_email).first()
+    finally:
+        db.close()
+
+def _gateway_topic(user_id: int, key: str, object_id: int):
+    """Тема подписки на канал или сервер и server_id для нее, если пользователь — участник сервера"""
+    db = SessionLocal()
+    try:
+        if key == "channel_id":
+            channel = db.query(Channel).filter(Channel.id == object_id).first()
+            if not channel:
+                return None, None
+            topic, server_id = channel_topic(channel.id), channel.server_id
+        else:
+            topic, server_id = server_topic(object_id), object_id
+        if not crud.is_user_server_member(db, user_id, server_id):
+            return None, None
+        return topic, server_id
+    finally:
+        db.close()
+
+@app.websocket("/ws/gateway")
+async def gateway_endpoint(
+    websocket: WebSocket,
+    token: str,
+    session_id: Optional[str] = None,
+    seq: Optional[int] = None,
+    encoding: Optional[str] = None
+):
+    # Запросы к базе выполняются в пуле потоков, чтобы не задерживать голос и чат в event loop
+    user = await asyncio.to_thread(_gateway_user, token)
+    if user is None:
+        await websocket.close(code=4000, reason="Invalid token")
+        return
+    await websocket.accept()
+    # ?encoding=msgpack — бинарные кадры MessagePack; если msgpack не установлен, остается JSON
+    encoding = negotiate_encoding(encoding)
+    session = None
+    if session_id is not None and seq is not None:
+        session = gateway.resume(websocket, user.id, session_id, seq, encoding)
+        if session is None:
+            # Пропуск не восстановить: клиент загружает данные заново и подписывается снова
+            payload = encode_message({"type": "invalid_session"}, encoding)
+            await (websocket.send_bytes(payload) if isinstance(payload, bytes) else websocket.send_text(payload))
+            print(f"[GATEWAY] Session {session_id} of user {user.id} cannot be resumed from seq {seq}")
+        else:
+            print(f"[GATEWAY] User {user.id} resumed session {session_id} from seq {seq}")
+    if session is None:
+        session = gateway.connect(websocket, user.id, encoding)
+        print(f"[GATEWAY] User {user.id} connected, session {session.session_id}, encoding {encoding}")
+        session.send_message({"type": "ready", "session_id": session.session_id, "user_id": user.id, "encoding": encoding})
+    sender = session.sender
+    presence.connect(user.id)
+    try:
+        while True:
+            message = await websocket.receive()
+            if message["type"] == "websocket.disconnect":
+                break
+            try:
+                data = decode_message(message["bytes"] if message.get("bytes") is not None else message.get("text"))
+            except (ValueError, TypeError) as e:
+                print(f"[GATEWAY] Invalid message in session {session.session_id}: {e}")
+                continue
+            if not isinstance(data, dict):
+                continue
+            presence.touch(user.id)
+            message_type = data.get("type")
+            if message_type in ("subscribe", "unsubscribe"):
+                key = "channel_id" if data.get("channel_id") is not None else "server_id"
+                # Идентификатор попадает в имя темы, поэтому принимается только целое число
+                try:
+                    object_id = int(data.get(key))
+                except (ValueError, TypeError):
+                    session.send_message({"type": "error", "reason": "invalid_id", key: data.get(key)})
+                    continue
+                if message_type == "unsubscribe":
+                    topic = channel_topic(object_id) if key == "channel_id" else server_topic(object_id)
+                    gateway.unsubscribe(session, topic)
+                    session.send_message({"type": "unsubscribed", key: object_id})
+                    continue
+                topic, server_id = await asyncio.to_thread(_gateway_topic, user.id, key, object_id)
+                if topic is None:
+                    session.send_message({"type": "error", "reason": "forbidden", key: object_id})
+                    continue
+                gateway.subscribe(session, topic, server_id)
+                session.send_message({"type": "subscribed", key: object_id})
+            elif message_type in ("typing_start", "typing_stop"):
+                channel_id = data.get("channel_id")
+                # Сигнал принимается только для канала, на который сессия подписана
+                if channel_topic(channel_id) not in session.topics:
+                    continue
+                if message_type == "typing_start":
+                    typing_tracker.start(channel_id, user.id)
+                else:
+                    typing_tracker.stop(channel_id, user.id)
+            elif message_type == "ping":
+                session.send_message({"type": "pong"})
+    except WebSocketDisconnect:
+        pass
+    except Exception as e:
+        print(f"[GATEWAY] Error in session {session.session_id}: {e}")
+    finally:
+        gateway.detach(session, sender)
+        presence.disconnect(user.id)
+        print(f"[GATEWAY] User {user.id} disconnected, session {session.session_id}")
 
 @app.websocket("/ws/voice/{channel_id}")
 async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: str):
@@ -475,6 +1189,11 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
                 await websocket.close(code=4000, reason="Not a member of this server")
                 return
 
+            # Сессия нужна только для проверок выше; если держать ее все время соединения,
+            # пул подключений к базе закончится на первых полутора десятках участников
+            db.close()
+            db = None
+
             # Accept the WebSocket connection
             await websocket.accept()
             print(f"[{datetime.now()}] User {user.username} connected to voice channel {channel_id}")
@@ -515,7 +1234,7 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
                             elif message.get("type") == "leave":
                                 print(f"[{datetime.now()}] User {user.username} leaving voice channel")
                                 # Remove user from voice channel participants
-                                await voice_manager.disconnect_user(user.id)
+                                await voice_manager.disconnect_websocket(user.id, websocket)
                                 break
                             elif message.get("type") == "audio":
                                 # Обработка аудио данных
@@ -575,7 +1294,8 @@ async def voice_channel_endpoint(websocket: WebSocket, channel_id: int, token: s
         # Clean up resources
         if user and channel_id:
             print(f"[{datetime.now()}] Cleaning up resources for user {user.username}")
-            await voice_manager.disconnect_user(user.id)
+            # Более новое соединение того же пользователя не трогаем
+            await voice_manager.disconnect_websocket(user.id, websocket)
         if db:
             db.close()
 
@@ -595,6 +1315,15 @@ async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
     db: Session = Depends(get_db)
 ):
+    # Перебор паролей отсекается до базы и bcrypt; отклоненные попытки не пишутся в историю входов
+    retry_after = await login_limiter.check(request.client.host, form_data.username)
+    if retry_after:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": str(math.ceil(retry_after))}
+        )
+
     try:
         # Get client IP
         client_ip = request.client.host
@@ -602,9 +1331,6 @@ async def login_for_access_token(
 
         # Debug logging
         print(f"Login attempt for email: {form_data.username}")
-        print(f"Password received: {form_data.password}")
-        print(f"Password length: {len(form_data.password)}")
-        print(f"Password bytes: {[ord(c) for c in form_data.password]}")
 
         # Get user and verify password
         user = crud.get_user_by_email(db, form_data.username)
@@ -615,16 +1341,24 @@ async def login_for_access_token(
                 detail="Incorrect email or password"
             )
 
-        if not auth.verify_password(form_data.password, user.hashed_password):
+        # bcrypt выполняется в отдельном пуле и не блокирует голос и чат
+        valid, new_hash = await auth.verify_and_update_password(form_data.password, user.hashed_password)
+        if not valid:
             print(f"Invalid password for user: {form_data.username}")
             raise HTTPException(
                 status_code=status.HTTP_401_UNAUTHORIZED,
                 detail="Incorrect email or password"
             )
+        if new_hash:
+            # Хэш со старыми параметрами заменяется, пока пароль известен
+            user.hashed_password = new_hash
+            db.commit()
+            auth.invalidate_user(user.id)
 
         # Create access token
         access_token = auth.create_access_token(data={"sub": user.email})
         print(f"Login successful for user: {form_data.username}")
+        await login_limiter.record_success(client_ip, form_data.username)
 
         # Log successful attempt
         crud.log_login_attempt(db, client_ip, True)
@@ -641,6 +1375,8 @@ async def login_for_access_token(
         }
     except HTTPException as he:
         # Log failed attempt
+        if he.status_code == status.HTTP_401_UNAUTHORIZED:
+            await login_limiter.record_failure(request.client.host, form_data.username)
         crud.log_login_attempt(db, request.client.host, False)
         raise he
     except Exception as e:
@@ -680,7 +1416,6 @@ async def refresh_token(
 def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
     print(f"Registration attempt for email: {user.email}")
     print(f"Username: {user.username}")
-    print(f"Password length: {len(user.password)}")
     
     # Check if email is already registered
     db_user = crud.get_user_by_email(db, email=user.email)
@@ -709,7 +1444,9 @@ def update_user_me(
     current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    return crud.update_user(db=db, user_id=current_user.id, user=user)
+    updated_user = crud.update_user(db=db, user_id=current_user.id, user=user)
+    auth.invalidate_user(current_user.id)
+    return updated_user
 
 @app.get("/users/me/login-history/", response_model=List[schemas.LoginHistory])
 def read_login_history(
@@ -972,6 +1709,21 @@ def delete_channel(
     )
     return crud.delete_channel(db=db, channel_id=channel_id)
 
+def dispatch_message_event(event_type: str, db_message: models.Message):
+    """Отправляет сообщение подписчикам его канала в шлюзе"""
+    topic = channel_topic(db_message.channel_id)
+    if gateway.has_subscribers(topic):
+        # Сериализуем, пока сессия базы открыта; без подписчиков работа не нужна
+        gateway.dispatch(topic, event_type, schemas.Message.model_validate(db_message, from_attributes=True).model_dump(mode="json"))
+
+def dispatch_reaction_event(event_type: str, db_message: models.Message, user_id: int, emoji: str):
+    gateway.dispatch(channel_topic(db_message.channel_id), event_type, {
+        "message_id": db_message.id,
+        "channel_id": db_message.channel_id,
+        "user_id": user_id,
+        "emoji": emoji
+    })
+
 @app.post("/channels/{channel_id}/messages", response_model=schemas.Message)
 async def create_message(
     channel_id: int,
@@ -1032,7 +1784,10 @@ async def create_message(
     )
     
     # Get the full message with author information
-    return db.query(models.Message).filter(models.Message.id == db_message.id).first()
+    db_message = db.query(models.Message).filter(models.Message.id == db_message.id).first()
+    typing_tracker.stop(channel_id, current_user.id)
+    dispatch_message_event("MESSAGE_CREATE", db_message)
+    return db_message
 
 @app.get("/channels/{channel_id}/messages/", response_model=List[schemas.Message])
 def read_messages(
@@ -1059,7 +1814,9 @@ def update_message(
         raise HTTPException(status_code=404, detail="Message not found")
     if db_message.author_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.update_message(db=db, message_id=message_id, message=message)
+    db_message = crud.update_message(db=db, message_id=message_id, message=message)
+    dispatch_message_event("MESSAGE_UPDATE", db_message)
+    return db_message
 
 @app.delete("/messages/{message_id}")
 def delete_message(
@@ -1072,7 +1829,10 @@ def delete_message(
         raise HTTPException(status_code=404, detail="Message not found")
     if db_message.author_id != current_user.id:
         raise HTTPException(status_code=403, detail="Not enough permissions")
-    return crud.delete_message(db=db, message_id=message_id)
+    channel_id = db_message.channel_id
+    result = crud.delete_message(db=db, message_id=message_id)
+    gateway.dispatch(channel_topic(channel_id), "MESSAGE_DELETE", {"id": message_id, "channel_id": channel_id})
+    return result
 
 @app.post("/messages/{message_id}/reactions/{emoji}")
 def add_reaction(
@@ -1084,7 +1844,9 @@ def add_reaction(
     db_message = crud.get_message(db=db, message_id=message_id)
     if db_message is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    return crud.add_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    result = crud.add_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    dispatch_reaction_event("MESSAGE_REACTION_ADD", db_message, current_user.id, emoji)
+    return result
 
 @app.delete("/messages/{message_id}/reactions/{emoji}")
 def remove_reaction(
@@ -1096,7 +1858,9 @@ def remove_reaction(
     db_message = crud.get_message(db=db, message_id=message_id)
     if db_message is None:
         raise HTTPException(status_code=404, detail="Message not found")
-    return crud.remove_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    result = crud.remove_message_reaction(db=db, message_id=message_id, user_id=current_user.id, emoji=emoji)
+    dispatch_reaction_event("MESSAGE_REACTION_REMOVE", db_message, current_user.id, emoji)
+    return result
 
 @app.get("/servers/{server_id}/audit-logs/", response_model=List[schemas.AuditLog])
 def read_audit_logs(
@@ -1183,12 +1947,14 @@ async def upload_media(
         media_type=media_type
     )
     
-    return crud.create_message(
+    db_message = crud.create_message(
         db=db,
         message=message_data,
         author_id=current_user.id,
         channel_id=channel_id
     )
+    dispatch_message_event("MESSAGE_CREATE", db_message)
+    return db_message
 
 @app.get("/channels/{channel_id}/media/", response_model=List[schemas.Media])
 def get_channel_media(
@@ -1324,6 +2090,8 @@ async def join_server(
     
     # Add user to server
     member = crud.add_user_to_server(db, current_user.id, server.id)
+    presence.forget_servers(current_user.id)
+    dispatch_member_event("SERVER_MEMBER_ADD", member)
     
     # Log the action
     crud.create_audit_log(
@@ -1352,12 +2120,14 @@ def update_credentials(
             detail="Not enough permissions"
         )
     
-    return crud.update_user_credentials(
+    result = crud.update_user_credentials(
         db=db,
         user_id=user_id,
         new_username=credentials.username,
         new_password=credentials.password
     )
+    auth.invalidate_user(user_id)
+    return result
 
 @app.put("/fix-credentials/{user_id}")
 def fix_swapped_credentials(
@@ -1383,6 +2153,7 @@ def fix_swapped_credentials(
     
     db.commit()
     db.refresh(db_user)
+    auth.invalidate_user(user_id)
     
     return {"message": "Credentials fixed successfully"}
 
@@ -1390,6 +2161,14 @@ def fix_swapped_credentials(
 MEDIA_DIR = "media"
 os.makedirs(MEDIA_DIR, exist_ok=True)
 
+def dispatch_member_event(event_type: str, member: models.ServerMember):
+    gateway.dispatch(server_topic(member.server_id), event_type, {
+        "server_id": member.server_id,
+        "user_id": member.user_id,
+        "role_id": member.role_id,
+        "role_type": member.role_type.value if member.role_type else None
+    })
+
 # Эндпоинты для управления участниками сервера
 @app.post("/servers/{server_id}/members", response_model=schemas.ServerMemberResponse)
 def add_server_member(
@@ -1405,6 +2184,8 @@ def add_server_member(
     db.add(db_member)
     db.commit()
     db.refresh(db_member)
+    presence.forget_servers(db_member.user_id)
+    dispatch_member_event("SERVER_MEMBER_ADD", db_member)
     return db_member
 
 @app.put("/servers/{server_id}/members/{user_id}")
@@ -1423,6 +2204,7 @@ def update_member_role(
     
     member.role = role
     db.commit()
+    dispatch_member_event("SERVER_MEMBER_UPDATE", member)
     return {"status": "success"}
 
 @app.delete("/servers/{server_id}/members/{user_id}")
@@ -1440,6 +2222,9 @@ def remove_server_member(
     
     db.delete(member)
     db.commit()
+    gateway.dispatch(server_topic(server_id), "SERVER_MEMBER_REMOVE", {"server_id": server_id, "user_id": user_id})
+    gateway.revoke(user_id, server_id)
+    presence.forget_servers(user_id)
     return {"status": "success"}
 
 # Эндпоинт для загрузки медиафайлов
@@ -1466,18 +2251,98 @@ app.mount("/media", StaticFiles(directory="media"), name="media")
 
 @app.get("/api/channels/{channel_id}/participants")
 def get_channel_participants(channel_id: int):
-    participants = []
-    if channel_id in voice_manager.voice_channels:
-        for user_id in voice_manager.voice_channels[channel_id]:
-            state = voice_manager.user_states.get(user_id, {})
-            participants.append({
-                "id": user_id,
-                "isMuted": state.get("isMuted", False),
-                "isDeafened": state.get("isDeafened", False),
-                "isVideoEnabled": state.get("isVideoEnabled", False),
-                "isScreenSharing": state.get("isScreenSharing", False)
-            })
-    return {"participants": participants}
+    return {"participants": voice_manager.channel_participants(channel_id)}
+
+def _require_voice_channel_member(db: Session, channel_id: int, user: models.User):
+    channel = db.query(Channel).filter(Channel.id == channel_id).first()
+    if not channel:
+        raise HTTPException(status_code=404, detail="Channel not found")
+    membership = db.query(ServerMember).filter(
+        ServerMember.server_id == channel.server_id,
+        ServerMember.user_id == user.id
+    ).first()
+    if not membership:
+        raise HTTPException(status_code=403, detail="Not a member of this server")
+
+@app.post("/api/voice/channels/{channel_id}/recording")
+async def start_voice_recording(
+    channel_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    _require_voice_channel_member(db, channel_id, current_user)
+    if channel_id not in voice_manager.voice_channels:
+        raise HTTPException(status_code=409, detail="Nobody is in this voice channel")
+    recorder = await voice_manager.start_recording(channel_id, current_user.id)
+    return recorder.get_stats()
+
+@app.delete("/api/voice/channels/{channel_id}/recording")
+async def stop_voice_recording(
+    channel_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    _require_voice_channel_member(db, channel_id, current_user)
+    recorder = await voice_manager.stop_recording(channel_id)
+    if recorder is None:
+        raise HTTPException(status_code=404, detail="Channel is not being recorded")
+    return recorder.get_stats()
+
+@app.get("/api/voice/channels/{channel_id}/recording")
+def get_voice_recording(
+    channel_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    _require_voice_channel_member(db, channel_id, current_user)
+    recorder = voice_manager.recordings.get(channel_id)
+    return recorder.get_stats() if recorder else {"status": "idle"}
+
+@app.get("/api/voice/channels/{channel_id}/worker")
+def get_voice_channel_worker(channel_id: int):
+    """Воркер, за которым закреплен канал: клиенты подключаются к нему, чтобы трафик оставался локальным"""
+    if not config.VOICE_WORKER_URLS:
+        return {"worker": config.VOICE_WORKER_ID, "url": None, "local": True}
+    worker = rendezvous_owner(channel_id, sorted(config.VOICE_WORKER_URLS))
+    return {
+        "worker": worker,
+        "url": config.VOICE_WORKER_URLS[worker],
+        "local": worker == config.VOICE_WORKER_ID
+    }
+
+@app.get("/api/voice/stats")
+async def get_voice_stats(current_user: models.User = Depends(auth.get_current_user)):
+    # async: словари менеджера меняются в event loop, итерировать их из пула потоков нельзя
+    return {
+        "audio": audio_handler.get_stats(),
+        "senders": {user_id: sender.get_stats() for user_id, sender in voice_manager.user_senders.items()},
+        "jitter": {user_id: buffer.get_stats() for user_id, buffer in voice_manager.jitter_buffers.items()},
+        "voice_activity": {user_id: detector.get_stats() for user_id, detector in voice_manager.voice_activity.items()},
+        "backplane": voice_manager.backplane.get_stats() if voice_manager.backplane else None,
+        "video": {channel_id: relay.get_stats() for channel_id, relay in voice_manager.video_relays.items()},
+        "heartbeats": voice_manager.heartbeats.get_stats()
+    }
+
+@app.get("/api/gateway/stats")
+async def get_gateway_stats(current_user: models.User = Depends(auth.get_current_user)):
+    return {**gateway.get_stats(), "ws": manager.get_stats()}
+
+@app.get("/api/auth/stats")
+async def get_auth_stats(current_user: models.User = Depends(auth.get_current_user)):
+    return {
+        "token_cache": auth.token_cache.get_stats(),
+        "password_hasher": auth.password_hasher.get_stats(),
+        "login_rate_limit": login_limiter.get_stats()
+    }
+
+@app.get("/api/presence/stats")
+async def get_presence_stats(current_user: models.User = Depends(auth.get_current_user)):
+    return {**presence.get_stats(), "typing": typing_tracker.get_stats()}
+
+@app.on_event("shutdown")
+async def flush_presence():
+    # Последние изменения присутствия, не дождавшиеся периодической записи
+    await presence.stop()
 
 if __name__ == "__main__":
     def find_free_port(start_port=8000, max_port=8999):
@@ -1496,4 +2361,4 @@ if __name__ == "__main__":
         exit(1)
         
     print(f"Starting server on port {port}")
-    uvicorn.run(app, host=config.SERVER_IP, port=port) 
\ No newline at end of file
+    uvicorn.run(app, host=config.SERVER_IP, port=port, ws_per_message_deflate=config.WS_PER_MESSAGE_DEFLATE) 
\ No newline at end of file
@@ -0,0 +1,173 @@
+"""
+Присутствие пользователей (онлайн/офлайн и время последней активности).
+
+Состояние ведется в памяти по соединениям шлюза и голосовых каналов: пользователь в сети,
+пока у него есть хотя бы одно соединение. Активность клиента (любое сообщение, ping)
+только обновляет время в памяти. Смена статуса рассылается через шлюз подписчикам
+серверов пользователя, а в базу is_online и last_seen попадают раз в PRESENCE_FLUSH_INTERVAL
+одним пакетным UPDATE вместо коммита на каждый heartbeat.
+"""
+import asyncio
+from datetime import datetime
+from typing import Dict, List
+
+import config
+import crud
+from database import SessionLocal
+from gateway import gateway, server_topic
+
+class PresenceTracker:
+    def __init__(
+        self,
+        flush_interval: float = config.PRESENCE_FLUSH_INTERVAL,
+        offline_delay: float = config.PRESENCE_OFFLINE_DELAY
+    ):
+        self.flush_interval = flush_interval
+        self.offline_delay = offline_delay
+        self.connections: Dict[int, int] = {}  # user_id -> число открытых соединений
+        self.online = set()                     # user_ids со статусом online
+        self.last_seen: Dict[int, datetime] = {}
+        self._dirty = set()                     # user_ids с изменениями, еще не записанными в базу
+        self._offline_timers = {}               # user_id -> asyncio.TimerHandle
+        self._user_servers: Dict[int, List[int]] = {}  # кэш серверов пользователя для рассылки
+        self._task = None
+        self.flushes = 0
+        self.rows_written = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def connect(self, user_id: int):
+        """Открыто соединение шлюза или голосового канала"""
+        self.start()
+        self.connections[user_id] = self.connections.get(user_id, 0) + 1
+        timer = self._offline_timers.pop(user_id, None)
+        if timer is not None:
+            # Переподключение в пределах задержки: статус не менялся
+            timer.cancel()
+        self.touch(user_id)
+        if user_id not in self.online:
+            self.online.add(user_id)
+            self._publish(user_id)
+
+    def disconnect(self, user_id: int):
+        count = self.connections.get(user_id, 0) - 1
+        if count > 0:
+            self.connections[user_id] = count
+            return
+        self.connections.pop(user_id, None)
+        self.touch(user_id)
+        if user_id in self.online and user_id not in self._offline_timers:
+            # Короткий обрыв с переподключением не должен мигать статусом у других
+            self._offline_timers[user_id] = asyncio.get_running_loop().call_later(
+                self.offline_delay, self._go_offline, user_id
+            )
+
+    def touch(self, user_id: int):
+        """Активность клиента; вызывается на каждом сообщении, поэтому только обновляет память"""
+        self.last_seen[user_id] = datetime.utcnow()
+        self._dirty.add(user_id)
+
+    def _go_offline(self, user_id: int):
+        self._offline_timers.pop(user_id, None)
+        if self.connections.get(user_id):
+            return
+        self.online.discard(user_id)
+        self._dirty.add(user_id)
+        self._publish(user_id)
+
+    def is_online(self, user_id: int) -> bool:
+        return user_id in self.online
+
+    def forget_servers(self, user_id: int):
+        """Состав серверов пользователя изменился; можно вызывать из потоков пула"""
+        self._user_servers.pop(user_id, None)
+
+    def _publish(self, user_id: int):
+        last_seen = self.last_seen.get(user_id)
+        data = {
+            'user_id': user_id,
+            'status': 'online' if user_id in self.online else 'offline',
+            'last_seen': last_seen.isoformat() if last_seen else None
+        }
+        asyncio.create_task(self._publish_async(user_id, data))
+
+    async def _publish_async(self, user_id: int, data: dict):
+        try:
+            server_ids = self._user_servers.get(user_id)
+            if server_ids is None:
+                server_ids = await asyncio.get_running_loop().run_in_executor(None, self._load_servers, user_id)
+                self._user_servers[user_id] = server_ids
+            for server_id in server_ids:
+                gateway.dispatch(server_topic(server_id), 'PRESENCE_UPDATE', data)
+        except Exception as e:
+            print(f"[PRESENCE] Error publishing presence of user {user_id}: {e}")
+
+    @staticmethod
+    def _load_servers(user_id: int) -> List[int]:
+        db = SessionLocal()
+        try:
+            return crud.get_user_server_ids(db, user_id)
+        finally:
+            db.close()
+
+    def _take_dirty(self) -> List[dict]:
+        rows = []
+        for user_id in self._dirty:
+            online = user_id in self.online
+            rows.append({'user_id': user_id, 'is_online': int(online), 'last_seen': self.last_seen.get(user_id)})
+            if not online and user_id not in self.connections:
+                # Ушедший пользователь больше не нужен в памяти
+                self.last_seen.pop(user_id, None)
+                self._user_servers.pop(user_id, None)
+        self._dirty = set()
+        return rows
+
+    @staticmethod
+    def _write(rows: List[dict]):
+        db = SessionLocal()
+        try:
+            crud.update_users_presence(db, rows)
+        finally:
+            db.close()
+
+    async def flush(self):
+        """Записывает накопленные изменения одним пакетом в потоке пула"""
+        rows = self._take_dirty()
+        if not rows:
+            return
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self._write, rows)
+            self.flushes += 1
+            self.rows_written += len(rows)
+        except Exception as e:
+            # Строки возвращаются в следующий пакет, если их не перекрыли новые изменения
+            for row in rows:
+                if row['user_id'] not in self._dirty:
+                    self._dirty.add(row['user_id'])
+                    self.last_seen.setdefault(row['user_id'], row['last_seen'])
+            print(f"[PRESENCE] Error writing presence batch: {e}")
+
+    async def stop(self):
+        """Останавливает периодическую запись и сохраняет то, что накопилось"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def get_stats(self) -> dict:
+        return {
+            'online': len(self.online),
+            'connections': sum(self.connections.values()),
+            'pending': len(self._dirty),
+            'flushes': self.flushes,
+            'rows_written': self.rows_written
+        }
+
+presence = PresenceTracker()
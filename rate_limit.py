@@ -0,0 +1,187 @@
+"""
+Ограничение частоты попыток входа.
+
+Скользящее окно по журналу отметок времени: ключ хранит не больше limit последних попыток,
+поэтому проверка стоит O(limit) и не обращается к базе. Ограничиваются:
+- все попытки с одного IP (LOGIN_RATE_LIMIT_IP за LOGIN_RATE_LIMIT_IP_WINDOW);
+- неудачные попытки для учетной записи с одного IP (LOGIN_RATE_LIMIT_ACCOUNT
+  за LOGIN_RATE_LIMIT_ACCOUNT_WINDOW). Попытка учитывается сразу при проверке, одной атомарной
+  операцией, поэтому параллельные запросы не проходят лимит, пока проверяется пароль;
+  успешный вход с этого IP сбрасывает счетчик, так что в нем остаются только неудачные попытки.
+  Чужой IP учетную запись не блокирует;
+- неудачные попытки для учетной записи со всех IP (LOGIN_RATE_LIMIT_ACCOUNT_GLOBAL за то же окно) —
+  заметно более высокий порог против перебора с множества адресов.
+Хранилище задается MEOW_RATE_LIMIT_BACKEND:
+- memory — в памяти процесса (по умолчанию);
+- redis://host:port/db — общее для всех воркеров (нужен пакет redis).
+"""
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+
+import config
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis нужен только для хранилища redis://
+    aioredis = None
+
+class MemoryBackend:
+    """Журналы попыток в памяти процесса; самые давние ключи вытесняются при переполнении"""
+
+    def __init__(self, max_keys: int = config.RATE_LIMIT_MAX_KEYS):
+        self.max_keys = max_keys
+        self._logs = OrderedDict()  # key -> deque отметок времени
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _retry_after(log, limit: int, window: float, now: float) -> float:
+        while log and log[0] <= now - window:
+            log.popleft()
+        if len(log) >= limit:
+            return log[0] + window - now
+        return 0.0
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        """Учитывает попытку; если лимит исчерпан, не учитывает и возвращает секунды до следующей"""
+        with self._lock:
+            now = time.monotonic()
+            log = self._logs.get(key)
+            if log is None:
+                log = self._logs[key] = deque(maxlen=limit)
+                while len(self._logs) > self.max_keys:
+                    self._logs.popitem(last=False)
+            else:
+                self._logs.move_to_end(key)
+            retry_after = self._retry_after(log, limit, window, now)
+            if not retry_after:
+                log.append(now)
+            return retry_after
+
+    async def peek(self, key: str, limit: int, window: float) -> float:
+        """Как hit, но без учета попытки"""
+        with self._lock:
+            log = self._logs.get(key)
+            if log is None:
+                return 0.0
+            return self._retry_after(log, limit, window, time.monotonic())
+
+    async def reset(self, key: str):
+        with self._lock:
+            self._logs.pop(key, None)
+
+# Проверка и учет попытки одним скриптом: между ними не вклинится запрос другого воркера.
+# Результат — строка, потому что Redis отбрасывает дробную часть чисел из Lua
+_HIT_SCRIPT = """
+local now = tonumber(ARGV[1])
+local window = tonumber(ARGV[2])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now - window)
+if redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[3]) then
+    local oldest = redis.call('ZRANGE', KEYS[1], 0, 0, 'WITHSCORES')
+    return tostring(tonumber(oldest[2]) + window - now)
+end
+redis.call('ZADD', KEYS[1], now, ARGV[4])
+redis.call('EXPIRE', KEYS[1], math.ceil(window))
+return '0'
+"""
+
+class RedisBackend:
+    """Журналы попыток в sorted set Redis, общие для всех воркеров"""
+
+    def __init__(self, url: str):
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for the redis:// rate limit backend")
+        self._client = aioredis.from_url(url)
+        self._hit = self._client.register_script(_HIT_SCRIPT)
+
+    async def hit(self, key: str, limit: int, window: float) -> float:
+        result = await self._hit(keys=[key], args=[time.time(), window, limit, uuid.uuid4().hex])
+        return max(0.0, float(result))
+
+    async def peek(self, key: str, limit: int, window: float) -> float:
+        now = time.time()
+        async with self._client.pipeline(transaction=True) as pipe:
+            pipe.zremrangebyscore(key, '-inf', now - window)
+            pipe.zcard(key)
+            pipe.zrange(key, 0, 0, withscores=True)
+            _, count, oldest = await pipe.execute()
+        if count >= limit and oldest:
+            return max(0.0, oldest[0][1] + window - now)
+        return 0.0
+
+    async def reset(self, key: str):
+        await self._client.delete(key)
+
+class LoginRateLimiter:
+    def __init__(
+        self,
+        backend,
+        ip_limit: int = config.LOGIN_RATE_LIMIT_IP,
+        ip_window: float = config.LOGIN_RATE_LIMIT_IP_WINDOW,
+        account_limit: int = config.LOGIN_RATE_LIMIT_ACCOUNT,
+        account_window: float = config.LOGIN_RATE_LIMIT_ACCOUNT_WINDOW,
+        account_global_limit: int = config.LOGIN_RATE_LIMIT_ACCOUNT_GLOBAL
+    ):
+        self.backend = backend
+        self.ip_limit = ip_limit
+        self.ip_window = ip_window
+        self.account_limit = account_limit
+        self.account_window = account_window
+        self.account_global_limit = account_global_limit
+        self.allowed = 0
+        self.rejected = 0
+
+    @staticmethod
+    def _account_key(account: str, ip: str = None) -> str:
+        key = "login:account:" + account.strip().lower()
+        return key if ip is None else key + ":ip:" + ip
+
+    async def _call(self, method, *args) -> float:
+        try:
+            return await method(*args)
+        except Exception as e:
+            # Недоступное хранилище не должно блокировать вход
+            print(f"[RATE_LIMIT] Backend error: {e}")
+            return 0.0
+
+    async def check(self, ip: str, account: str) -> float:
+        """Учитывает попытку входа; 0 — попытка разрешена, иначе секунды до следующей"""
+        retry_after = await self._call(
+            self.backend.peek, self._account_key(account), self.account_global_limit, self.account_window
+        )
+        if not retry_after:
+            retry_after = await self._call(self.backend.hit, "login:ip:" + ip, self.ip_limit, self.ip_window)
+        if not retry_after:
+            retry_after = await self._call(
+                self.backend.hit, self._account_key(account, ip), self.account_limit, self.account_window
+            )
+        if retry_after:
+            self.rejected += 1
+        else:
+            self.allowed += 1
+        return retry_after
+
+    async def record_failure(self, ip: str, account: str):
+        """Неверный пароль: учитывается в общем счетчике учетной записи"""
+        await self._call(self.backend.hit, self._account_key(account), self.account_global_limit, self.account_window)
+
+    async def record_success(self, ip: str, account: str):
+        """Вход удался: попытки учетной записи с этого IP, включая эту, больше не считаются"""
+        await self._call(self.backend.reset, self._account_key(account, ip))
+
+    def get_stats(self) -> dict:
+        return {
+            'backend': type(self.backend).__name__,
+            'allowed': self.allowed,
+            'rejected': self.rejected
+        }
+
+def create_backend(url: str):
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBackend(url)
+    if url == "memory":
+        return MemoryBackend()
+    raise ValueError(f"Unknown rate limit backend: {url}")
+
+login_limiter = LoginRateLimiter(create_backend(config.LOGIN_RATE_LIMIT_BACKEND))
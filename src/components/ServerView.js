@@ -80,6 +80,12 @@ const ServerView = () => {
     const [showNewRoleDialog, setShowNewRoleDialog] = useState(false);
     const [newRole, setNewRole] = useState({ name: '', color: '#000000', permissions: {} });
     const messagesEndRef = useRef(null);
+    const gatewayRef = useRef(null);
+    const gatewaySessionRef = useRef(null);
+    const gatewaySeqRef = useRef(0);
+    const gatewayUserRef = useRef(null);
+    const typingSentRef = useRef(0);
+    const [typingUsers, setTypingUsers] = useState([]);
     const [showMediaUpload, setShowMediaUpload] = useState(false);
     const [showGameDialog, setShowGameDialog] = useState(false);
     const [showMusicPlayer, setShowMusicPlayer] = useState(false);
@@ -134,6 +140,86 @@ const ServerView = () => {
         }
     }, [selectedChannel]);
 
+    // Новые сообщения приходят через шлюз событий, без повторных запросов к API.
+    // После обрыва соединение возобновляется с последнего seq, и сервер досылает пропущенное
+    useEffect(() => {
+        if (!selectedChannel || !token) return;
+        const channelId = selectedChannel.id;
+        let closed = false;
+        let reconnectTimer = null;
+
+        const open = () => {
+            const resume = gatewaySessionRef.current
+                ? `&session_id=${gatewaySessionRef.current}&seq=${gatewaySeqRef.current}`
+                : '';
+            const ws = new WebSocket(`${config.WS_BASE_URL}/ws/gateway?token=${token}${resume}`);
+            gatewayRef.current = ws;
+
+            ws.onopen = () => {
+                ws.send(JSON.stringify({ type: 'subscribe', channel_id: channelId }));
+            };
+
+            ws.onmessage = (event) => {
+                const message = JSON.parse(event.data);
+                if (message.seq) {
+                    gatewaySeqRef.current = message.seq;
+                }
+                const data = message.data;
+                switch (message.type) {
+                    case 'ready':
+                        gatewaySessionRef.current = message.session_id;
+                        gatewaySeqRef.current = 0;
+                        gatewayUserRef.current = message.user_id;
+                        break;
+                    case 'TYPING_UPDATE':
+                        if (data.channel_id !== channelId) break;
+                        setTypingUsers(data.user_ids.filter(id => id !== gatewayUserRef.current));
+                        break;
+                    case 'invalid_session':
+                        // Пропущено больше, чем хранит сервер: загружаем историю заново
+                        gatewaySessionRef.current = null;
+                        fetchMessages();
+                        break;
+                    case 'MESSAGE_CREATE':
+                        if (data.channel_id !== channelId) break;
+                        setMessages(prev => prev.some(m => m.id === data.id) ? prev : [...prev, data]);
+                        break;
+                    case 'MESSAGE_UPDATE':
+                        setMessages(prev => prev.map(m => m.id === data.id ? data : m));
+                        break;
+                    case 'MESSAGE_DELETE':
+                        setMessages(prev => prev.filter(m => m.id !== data.id));
+                        break;
+                    default:
+                        break;
+                }
+            };
+
+            ws.onerror = (error) => {
+                console.error('Gateway error:', error);
+            };
+
+            ws.onclose = () => {
+                if (!closed) {
+                    reconnectTimer = setTimeout(open, 1000);
+                }
+            };
+        };
+
+        gatewaySessionRef.current = null;
+        setTypingUsers([]);
+        open();
+
+        return () => {
+            closed = true;
+            clearTimeout(reconnectTimer);
+            if (gatewayRef.current) {
+                gatewayRef.current.close();
+                gatewayRef.current = null;
+            }
+        };
+    }, [selectedChannel, token]);
+
     const fetchMessages = async () => {
         try {
             const response = await axios.get(
@@ -148,6 +234,31 @@ const ServerView = () => {
         }
     };
 
+    // Сервер сам гасит индикатор через несколько секунд, поэтому сигнал достаточно повторять изредка
+    const sendTyping = (type) => {
+        const ws = gatewayRef.current;
+        if (!ws || ws.readyState !== WebSocket.OPEN || !selectedChannel) return;
+        const now = Date.now();
+        if (type === 'typing_start' && now - typingSentRef.current < 3000) return;
+        typingSentRef.current = type === 'typing_start' ? now : 0;
+        ws.send(JSON.stringify({ type, channel_id: selectedChannel.id }));
+    };
+
+    const handleMessageChange = (e) => {
+        setNewMessage(e.target.value);
+        sendTyping(e.target.value ? 'typing_start' : 'typing_stop');
+    };
+
+    const typingLabel = () => {
+        const names = typingUsers.map(id => {
+            const message = messages.find(m => m.author_id === id);
+            return message && message.author ? message.author.username : 'Someone';
+        });
+        if (names.length === 1) return `${names[0]} is typing...`;
+        if (names.length <= 3) return `${names.join(', ')} are typing...`;
+        return 'Several people are typing...';
+    };
+
     const handleSendMessage = async (e) => {
         if (e) {
             e.preventDefault();
@@ -170,8 +281,13 @@ const ServerView = () => {
             );
             
             if (response.data) {
-                setMessages(prevMessages => [...prevMessages, response.data]);
+                // Шлюз может доставить это же сообщение раньше ответа
+                setMessages(prevMessages => prevMessages.some(m => m.id === response.data.id)
+                    ? prevMessages
+                    : [...prevMessages, response.data]);
                 setNewMessage('');
+                // Сервер снимает индикатор при отправке сообщения
+                typingSentRef.current = 0;
             }
         } catch (error) {
             console.error('Error sending message:', error);
@@ -339,7 +455,9 @@ const ServerView = () => {
                 
                 if (response.data) {
                     // Add the new message to the messages list
-                    setMessages(prevMessages => [...prevMessages, response.data]);
+                    setMessages(prevMessages => prevMessages.some(m => m.id === response.data.id)
+                        ? prevMessages
+                        : [...prevMessages, response.data]);
                 }
             } catch (error) {
                 console.error('Error uploading media:', error);
@@ -698,6 +816,12 @@ const ServerView = () => {
                                     <div ref={messagesEndRef} />
                                 </Box>
                                 
+                                {typingUsers.length > 0 && (
+                                    <Typography variant="caption" sx={{ px: 2, color: 'rgba(255,255,255,0.6)' }}>
+                                        {typingLabel()}
+                                    </Typography>
+                                )}
+                                
                                 <Box sx={{ p: 2, borderTop: 1, borderColor: 'divider' }}>
                                     <Grid container spacing={2}>
                                         <Grid item>
@@ -731,7 +855,7 @@ const ServerView = () => {
                                                 variant="outlined"
                                                 placeholder="Type a message..."
                                                 value={newMessage}
-                                                onChange={(e) => setNewMessage(e.target.value)}
+                                                onChange={handleMessageChange}
                                                 onKeyPress={(e) => {
                                                     if (e.key === 'Enter' && !e.shiftKey) {
                                                         e.preventDefault();
@@ -45,6 +45,46 @@ import config from '../config';
 import axios from 'axios';
 import { useNavigate, useLocation } from 'react-router-dom';
 
+// Бинарный формат голосового кадра (см. voice_protocol.py):
+// magic (1) | version (1) | kind (1) | flags (1) | sender_id (4) | sequence (4) | timestamp_ms (8) | payload
+const VOICE_FRAME_MAGIC = 0x4D;
+const VOICE_FRAME_VERSION = 1;
+const VOICE_FRAME_KIND_AUDIO = 1;
+const VOICE_CODEC_PCM16 = 0x01;
+const VOICE_FRAME_HEADER_SIZE = 20;
+
+const encodeVoiceFrame = (sequence, payload) => {
+    const frame = new Uint8Array(VOICE_FRAME_HEADER_SIZE + payload.byteLength);
+    const view = new DataView(frame.buffer);
+    view.setUint8(0, VOICE_FRAME_MAGIC);
+    view.setUint8(1, VOICE_FRAME_VERSION);
+    view.setUint8(2, VOICE_FRAME_KIND_AUDIO);
+    view.setUint8(3, VOICE_CODEC_PCM16);
+    view.setUint32(4, 0); // sender_id подставляет сервер
+    view.setUint32(8, sequence >>> 0);
+    view.setBigUint64(12, BigInt(Date.now()));
+    frame.set(new Uint8Array(payload), VOICE_FRAME_HEADER_SIZE);
+    return frame.buffer;
+};
+
+const decodeVoiceFrame = (buffer) => {
+    if (buffer.byteLength < VOICE_FRAME_HEADER_SIZE) {
+        return null;
+    }
+    const view = new DataView(buffer);
+    if (view.getUint8(0) !== VOICE_FRAME_MAGIC || view.getUint8(1) !== VOICE_FRAME_VERSION) {
+        return null;
+    }
+    return {
+        kind: view.getUint8(2),
+        flags: view.getUint8(3),
+        senderId: view.getUint32(4),
+        sequence: view.getUint32(8),
+        timestamp: Number(view.getBigUint64(12)),
+        payload: buffer.slice(VOICE_FRAME_HEADER_SIZE)
+    };
+};
+
 const VoiceChannel = ({ channelId }) => {
     const { token, setToken } = useAuth();
     const [isConnected, setIsConnected] = useState(false);
@@ -65,6 +105,8 @@ const VoiceChannel = ({ channelId }) => {
     const [audioProcessor, setAudioProcessor] = useState(null);
     
     const wsRef = useRef(null);
+    const audioSequenceRef = useRef(0);
+    const participantsVersionRef = useRef(null);
     const mediaStreamRef = useRef(null);
     const audioContextRef = useRef(null);
     const mediaRecorderRef = useRef(null);
@@ -173,7 +215,19 @@ const VoiceChannel = ({ channelId }) => {
 
             // Get the WebSocket protocol based on the current protocol
             const wsProtocol = window.location.protocol === 'https:' ? 'wss:' : 'ws:';
-            const wsUrl = `${wsProtocol}//${config.SERVER_IP}:${config.SERVER_PORT}/ws/voice/${channelId}?token=${encodeURIComponent(token)}`;
+            let wsBase = `${wsProtocol}//${config.SERVER_IP}:${config.SERVER_PORT}`;
+            // Канал закреплен за одним из воркеров сервера: подключаемся к нему напрямую
+            try {
+                const route = await axios.get(`/api/voice/channels/${channelId}/worker`, {
+                    headers: { Authorization: `Bearer ${token}` }
+                });
+                if (route.data.url) {
+                    wsBase = route.data.url;
+                }
+            } catch (error) {
+                console.warn('Could not resolve voice worker, using default server:', error);
+            }
+            const wsUrl = `${wsBase}/ws/voice/${channelId}?token=${encodeURIComponent(token)}`;
             
             console.log('Connecting to WebSocket:', wsUrl);
             
@@ -183,6 +237,7 @@ const VoiceChannel = ({ channelId }) => {
             }
             
             wsRef.current = new WebSocket(wsUrl);
+            wsRef.current.binaryType = 'arraybuffer';
 
             // Set connection timeout
             const connectionTimeout = setTimeout(() => {
@@ -218,6 +273,7 @@ const VoiceChannel = ({ channelId }) => {
                 clearTimeout(connectionTimeout);
                 setConnectionStatus('connected');
                 setIsConnected(true);
+                participantsVersionRef.current = null;
                 
                 // Send join message to server
                 try {
@@ -282,10 +338,12 @@ const VoiceChannel = ({ channelId }) => {
             };
 
             wsRef.current.onmessage = async (event) => {
-                if (event.data instanceof Blob) {
+                if (event.data instanceof ArrayBuffer) {
                     try {
-                        console.log('Received audio data blob, size:', event.data.size);
-                        await playAudio(event.data);
+                        const frame = decodeVoiceFrame(event.data);
+                        if (frame && frame.kind === VOICE_FRAME_KIND_AUDIO && !isDeafened) {
+                            await playAudio(frame.payload);
+                        }
                     } catch (error) {
                         console.error('Error processing audio data:', error);
                     }
@@ -325,24 +383,61 @@ const VoiceChannel = ({ channelId }) => {
         }
     };
 
+    // Сервер присылает изменения списка участников с номером версии.
+    // Пропуск версии означает потерянное сообщение — тогда запрашиваем полный список.
+    const acceptParticipantsVersion = (version) => {
+        if (version === undefined) {
+            return true;
+        }
+        const current = participantsVersionRef.current;
+        if (current === null) {
+            // Полный список еще не получен, он придет следом
+            return false;
+        }
+        if (version <= current) {
+            return false;
+        }
+        if (version !== current + 1) {
+            console.log(`Participants version gap (${current} -> ${version}), requesting sync`);
+            participantsVersionRef.current = null;
+            sendWebSocketMessage({ type: 'sync' });
+            return false;
+        }
+        participantsVersionRef.current = version;
+        return true;
+    };
+
     const handleWebSocketMessage = (data) => {
         console.log('Handling WebSocket message:', data);
         switch (data.type) {
             case 'participants':
                 if (Array.isArray(data.participants)) {
                     setParticipants(data.participants);
+                    participantsVersionRef.current = data.version ?? null;
                 }
                 break;
             case 'participant_joined':
-                if (data.participant) {
-                    setParticipants(prev => [...prev, data.participant]);
+                if (data.participant && acceptParticipantsVersion(data.version)) {
+                    setParticipants(prev => [...prev.filter(p => p.id !== data.participant.id), data.participant]);
                 }
                 break;
             case 'participant_left':
-                if (data.userId) {
+                if (data.userId && acceptParticipantsVersion(data.version)) {
                     setParticipants(prev => prev.filter(p => p.id !== data.userId));
                 }
                 break;
+            case 'participant_state':
+                if (data.participant && acceptParticipantsVersion(data.version)) {
+                    setParticipants(prev => prev.map(p =>
+                        p.id === data.participant.id ? { ...p, ...data.participant } : p
+                    ));
+                }
+                break;
+            case 'speaking':
+                setParticipants(prev => prev.map(p =>
+                    p.id === data.userId ? { ...p, isSpeaking: data.speaking } : p
+                ));
+                break;
             case 'audio':
                 console.log('Получено аудио-сообщение:', data);
                 if (!isDeafened && data.data && data.channel_id === channelId) {
@@ -511,15 +606,8 @@ const VoiceChannel = ({ channelId }) => {
                     for (let i = 0; i < pcmData.length; i++) {
                         view.setInt16(i * 2, pcmData[i], true);
                     }
-                    const base64Data = btoa(String.fromCharCode.apply(null, new Uint8Array(buffer)));
-                    console.log('Отправка аудио пакета', pcmData.length, wsRef.current?.readyState);
                     try {
-                        wsRef.current.send(JSON.stringify({
-                            type: 'audio',
-                            data: base64Data,
-                            channel_id: channelId,
-                            timestamp: Date.now()
-                        }));
+                        wsRef.current.send(encodeVoiceFrame(audioSequenceRef.current++, buffer));
                     } catch (error) {
                         console.error('Error sending audio data:', error);
                     }
@@ -643,12 +731,16 @@ const VoiceChannel = ({ channelId }) => {
 
     const playAudio = async (audioData) => {
         try {
-            console.log('playAudio вызван, audioData:', audioData);
-            // Конвертируем base64 обратно в Int16Array
-            const binaryString = atob(audioData);
-            const bytes = new Uint8Array(binaryString.length);
-            for (let i = 0; i < binaryString.length; i++) {
-                bytes[i] = binaryString.charCodeAt(i);
+            let bytes;
+            if (typeof audioData === 'string') {
+                // Старый формат: base64 внутри JSON
+                const binaryString = atob(audioData);
+                bytes = new Uint8Array(binaryString.length);
+                for (let i = 0; i < binaryString.length; i++) {
+                    bytes[i] = binaryString.charCodeAt(i);
+                }
+            } else {
+                bytes = new Uint8Array(audioData);
             }
             const int16Data = new Int16Array(bytes.buffer);
             const float32Data = new Float32Array(int16Data.length);
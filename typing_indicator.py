@@ -0,0 +1,96 @@
+"""
+Индикатор набора текста в каналах.
+
+Сигналы typing_start/typing_stop приходят через шлюз и хранятся только в памяти.
+Изменения списка печатающих в канале собираются и рассылаются одним событием TYPING_UPDATE
+не чаще раза в TYPING_BROADCAST_INTERVAL; повторный typing_start того же пользователя
+лишь продлевает срок, без рассылки. Пользователь, не приславший сигнал за TYPING_TIMEOUT,
+убирается из списка автоматически.
+"""
+import asyncio
+from typing import Dict
+
+import config
+from gateway import gateway, channel_topic
+
+class TypingTracker:
+    def __init__(
+        self,
+        interval: float = config.TYPING_BROADCAST_INTERVAL,
+        timeout: float = config.TYPING_TIMEOUT
+    ):
+        self.interval = interval
+        self.timeout = timeout
+        self.channels: Dict[int, Dict[int, float]] = {}  # channel_id -> {user_id: время истечения}
+        self._dirty = set()           # каналы с неразосланными изменениями
+        self._timers = {}             # channel_id -> asyncio.TimerHandle
+        self._last_broadcast = {}     # channel_id -> время последней рассылки
+        self.signals = 0
+        self.broadcasts = 0
+
+    def start(self, channel_id: int, user_id: int):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        self.signals += 1
+        typers = self.channels.setdefault(channel_id, {})
+        is_new = user_id not in typers
+        typers[user_id] = now + self.timeout
+        if is_new:
+            self._changed(channel_id, now)
+        else:
+            self._arm(channel_id, typers[user_id])
+
+    def stop(self, channel_id: int, user_id: int):
+        typers = self.channels.get(channel_id)
+        if not typers or typers.pop(user_id, None) is None:
+            return
+        self.signals += 1
+        self._changed(channel_id, asyncio.get_running_loop().time())
+
+    def _changed(self, channel_id: int, now: float):
+        self._dirty.add(channel_id)
+        last = self._last_broadcast.get(channel_id)
+        self._arm(channel_id, now if last is None else max(now, last + self.interval))
+
+    def _arm(self, channel_id: int, when: float):
+        """Одна отметка на канал: переносится, только если нужно сработать раньше"""
+        timer = self._timers.get(channel_id)
+        if timer is not None:
+            if timer.when() <= when:
+                return
+            timer.cancel()
+        self._timers[channel_id] = asyncio.get_running_loop().call_at(when, self._tick, channel_id)
+
+    def _tick(self, channel_id: int):
+        self._timers.pop(channel_id, None)
+        now = asyncio.get_running_loop().time()
+        typers = self.channels.get(channel_id, {})
+        for user_id in [user_id for user_id, expires in typers.items() if expires <= now]:
+            del typers[user_id]
+            self._dirty.add(channel_id)
+        if channel_id in self._dirty:
+            last = self._last_broadcast.get(channel_id)
+            if last is not None and now < last + self.interval:
+                self._arm(channel_id, last + self.interval)
+                return
+            self._dirty.discard(channel_id)
+            self._last_broadcast[channel_id] = now
+            self.broadcasts += 1
+            gateway.dispatch(channel_topic(channel_id), 'TYPING_UPDATE', {
+                'channel_id': channel_id,
+                'user_ids': list(typers)
+            }, replay=False)
+        if typers:
+            self._arm(channel_id, min(typers.values()))
+        else:
+            self.channels.pop(channel_id, None)
+
+    def get_stats(self) -> dict:
+        return {
+            'channels': len(self.channels),
+            'typing': sum(len(typers) for typers in self.channels.values()),
+            'signals': self.signals,
+            'broadcasts': self.broadcasts
+        }
+
+typing_tracker = TypingTracker()
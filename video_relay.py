@@ -0,0 +1,85 @@
+from typing import List, Optional, Tuple
+
+import config
+
+class VideoRelay:
+    """Пересылка видео и демонстрации экрана в одном голосовом канале.
+
+    Поток отправителя — пара (sender_id, kind), где kind — 'video' или 'screen'.
+    Кадр может быть:
+    - keyframe=True — ключевой кадр кодека, после него декодер восстанавливает картинку;
+    - keyframe=False — промежуточный кадр, без предыдущих кадров бесполезен;
+    - keyframe=None — самостоятельный полный кадр (например, JPEG-снимок).
+    Последний ключевой или полный кадр каждого потока кэшируется и сразу отдается
+    новому участнику. Для каждого получателя частота кадров ограничивается max_fps,
+    а если его очередь отправки переполнена, промежуточные кадры пропускаются
+    до следующего ключевого.
+    """
+
+    def __init__(
+        self,
+        max_fps: float = config.VOICE_VIDEO_MAX_FPS,
+        slow_queue_depth: int = config.VOICE_VIDEO_SLOW_QUEUE_DEPTH
+    ):
+        self.min_interval = 1 / max_fps if max_fps else 0.0
+        self.slow_queue_depth = slow_queue_depth
+        self.keyframes = {}    # (sender_id, kind) -> (сериализованное сообщение, keyframe)
+        self._recipients = {}  # (recipient_id, sender_id, kind) -> [время отправки, ждет ключевой кадр]
+        self.forwarded = 0
+        self.dropped = 0
+
+    def update(self, sender_id, kind: str, payload, keyframe: Optional[bool]):
+        if keyframe is not False:
+            self.keyframes[(sender_id, kind)] = (payload, keyframe)
+
+    def should_send(self, recipient_id, sender_id, kind: str, keyframe: Optional[bool],
+                    queue_depth: int, now: float) -> bool:
+        """Решает, отправлять ли кадр получателю; now — time.monotonic()"""
+        key = (recipient_id, sender_id, kind)
+        state = self._recipients.get(key)
+        if state is None:
+            state = self._recipients[key] = [0.0, keyframe is False]
+        if keyframe:
+            # Ключевой кадр всегда отправляется: с него получатель восстанавливает поток
+            state[0], state[1] = now, False
+            self.forwarded += 1
+            return True
+        if state[1] or now - state[0] < self.min_interval or queue_depth >= self.slow_queue_depth:
+            # Пропущенный промежуточный кадр ломает следующие, поэтому ждем ключевой
+            state[1] = keyframe is False
+            self.dropped += 1
+            return False
+        state[0] = now
+        self.forwarded += 1
+        return True
+
+    def join(self, recipient_id, now: float) -> List[Tuple[object, str, object]]:
+        """Кэшированные кадры для нового участника: (sender_id, kind, payload)"""
+        frames = []
+        for (sender_id, kind), (payload, _) in self.keyframes.items():
+            key = (recipient_id, sender_id, kind)
+            if sender_id == recipient_id or key in self._recipients:
+                # Свой поток или получатель уже получает этот поток
+                continue
+            self._recipients[key] = [now, False]
+            frames.append((sender_id, kind, payload))
+        return frames
+
+    def remove_stream(self, sender_id, kind: str):
+        self.keyframes.pop((sender_id, kind), None)
+        for key in [key for key in self._recipients if key[1] == sender_id and key[2] == kind]:
+            del self._recipients[key]
+
+    def remove_user(self, user_id):
+        """Убирает потоки пользователя и его состояние как получателя"""
+        for kind in ('video', 'screen'):
+            self.keyframes.pop((user_id, kind), None)
+        for key in [key for key in self._recipients if key[0] == user_id or key[1] == user_id]:
+            del self._recipients[key]
+
+    def get_stats(self) -> dict:
+        return {
+            'cached_keyframes': len(self.keyframes),
+            'forwarded': self.forwarded,
+            'dropped': self.dropped
+        }
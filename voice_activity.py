@@ -0,0 +1,89 @@
+import math
+from array import array
+from typing import Optional, Tuple
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+import config
+from voice_protocol import VoiceFrame, CODEC_PCM16, CODEC_OPUS, FLAG_DTX
+
+def pcm_energy_and_zcr(pcm: bytes) -> Tuple[float, float]:
+    """RMS и доля пересечений нуля для PCM s16le"""
+    if len(pcm) < 4:
+        return 0.0, 0.0
+    if np is not None:
+        samples = np.frombuffer(pcm[:len(pcm) - len(pcm) % 2], dtype=np.int16).astype(np.int64)
+        rms = math.sqrt(float(np.dot(samples, samples)) / len(samples))
+        zcr = float(np.count_nonzero(np.diff(np.signbit(samples)))) / (len(samples) - 1)
+        return rms, zcr
+    samples = array('h')
+    samples.frombytes(pcm[:len(pcm) - len(pcm) % 2])
+    rms = math.sqrt(sum(x * x for x in samples) / len(samples))
+    crossings = sum(1 for a, b in zip(samples, samples[1:]) if (a < 0) != (b < 0))
+    return rms, crossings / (len(samples) - 1)
+
+class VoiceActivityDetector:
+    """Детектор речи одного отправителя для подавления тишины на сервере.
+
+    Кадр считается речью, если:
+    - PCM: энергия выше порога, а доля пересечений нуля не похожа на шум;
+    - Opus: пакет длиннее DTX/comfort-noise пакета (1-3 байта);
+    - клиент не пометил кадр флагом FLAG_DTX.
+    WebM-чанки без декодирования и данные старых клиентов с необъявленным кодеком
+    не анализируются и считаются речью.
+    После окончания речи еще hangover кадров пропускаются, чтобы не обрезать концы слов.
+    """
+
+    def __init__(
+        self,
+        energy_threshold: float = config.VOICE_VAD_ENERGY_THRESHOLD,
+        zcr_max: float = config.VOICE_VAD_ZCR_MAX,
+        hangover: int = config.VOICE_VAD_HANGOVER_FRAMES,
+        opus_dtx_bytes: int = config.VOICE_VAD_OPUS_DTX_BYTES
+    ):
+        self.energy_threshold = energy_threshold
+        self.zcr_max = zcr_max
+        self.hangover = hangover
+        self.opus_dtx_bytes = opus_dtx_bytes
+        self.speaking = False
+        self._silent_frames = 0
+        self.forwarded = 0
+        self.suppressed = 0
+
+    def is_voiced(self, frame: VoiceFrame) -> bool:
+        if frame.flags & FLAG_DTX:
+            return False
+        if frame.codec == CODEC_PCM16:
+            rms, zcr = pcm_energy_and_zcr(frame.payload)
+            return rms >= self.energy_threshold and zcr <= self.zcr_max
+        if frame.codec == CODEC_OPUS:
+            return len(frame.payload) > self.opus_dtx_bytes
+        return True
+
+    def update(self, frame: VoiceFrame) -> Tuple[bool, Optional[bool]]:
+        """Возвращает (пересылать ли кадр, новое состояние speaking или None, если не изменилось)"""
+        changed = None
+        if self.is_voiced(frame):
+            self._silent_frames = 0
+            if not self.speaking:
+                self.speaking = changed = True
+        else:
+            self._silent_frames += 1
+            if self.speaking and self._silent_frames > self.hangover:
+                self.speaking = changed = False
+
+        if self.speaking:
+            self.forwarded += 1
+        else:
+            self.suppressed += 1
+        return self.speaking, changed
+
+    def get_stats(self) -> dict:
+        return {
+            'speaking': self.speaking,
+            'forwarded': self.forwarded,
+            'suppressed': self.suppressed
+        }
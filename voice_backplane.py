@@ -0,0 +1,408 @@
+"""
+Шина между воркерами голосового сервера.
+
+Участники одного канала могут быть подключены к разным процессам uvicorn или хостам.
+Каждый воркер подписывается на каналы, в которых у него есть локальные участники,
+и пересылает через шину кадры и сообщения для участников на других воркерах.
+
+Реализации:
+- memory — внутри одного процесса (по умолчанию, один воркер);
+- unix:///path/to.sock — локальный брокер на Unix-сокете, запускается отдельно:
+      python voice_backplane.py --socket /tmp/meow-voice.sock
+- redis://host:port/db — Redis Pub/Sub (нужен пакет redis).
+
+Воркер раз в VOICE_BACKPLANE_HEARTBEAT_INTERVAL публикует heartbeat в каждом своем канале.
+Воркер, от которого ничего не приходило VOICE_BACKPLANE_WORKER_TIMEOUT секунд (упал или потерял
+связь с брокером), считается потерянным, и его участники убираются из каналов; если он снова
+появится, его участники запрашиваются заново.
+"""
+import argparse
+import asyncio
+import hashlib
+import struct
+import time
+from typing import Callable, Dict, Iterable, Optional, Set
+
+try:
+    import redis.asyncio as aioredis
+except ImportError:  # Redis нужен только для шины redis://
+    aioredis = None
+
+import config
+
+# Типы сообщений шины
+MESSAGE_AUDIO = b'A'      # Голосовой кадр в формате voice_protocol
+MESSAGE_CONTROL = b'C'    # Сериализованное сообщение для локальных участников канала
+MESSAGE_DROPPABLE = b'D'  # То же, но его можно потерять
+MESSAGE_UPSERT = b'U'     # Участники воркера подключились или изменили состояние (JSON-список)
+MESSAGE_LEAVE = b'L'      # Участник воркера покинул канал (JSON)
+MESSAGE_HELLO = b'H'      # Воркер подписался на канал и просит прислать участников
+MESSAGE_VIDEO = b'V'      # Кадр видео или экрана: VIDEO_HEADER + сериализованное сообщение
+MESSAGE_HEARTBEAT = b'B'  # Воркер жив; обрабатывается самой шиной
+
+# Заголовок кадра видео: отправитель, b'v' или b's', ключевой кадр (0 — полный, 1 — нет, 2 — да)
+VIDEO_HEADER = struct.Struct('!IcB')
+
+# Конверт: тип, длина id воркера-отправителя, id воркера, полезная нагрузка
+ENVELOPE = struct.Struct('!cB')
+# Кадр протокола брокера: операция, канал, длина данных
+BROKER_FRAME = struct.Struct('!cqI')
+BROKER_SUBSCRIBE = b'S'
+BROKER_UNSUBSCRIBE = b'U'
+BROKER_PUBLISH = b'P'
+
+Handler = Callable[[int, str, bytes, bytes], None]
+WorkerLostHandler = Callable[[str], None]
+
+def rendezvous_owner(channel_id, workers: Iterable[str]) -> Optional[str]:
+    """Воркер-владелец канала по rendezvous (HRW) хешированию.
+
+    При добавлении или удалении воркера переезжают только каналы этого воркера.
+    """
+    best, best_score = None, -1
+    for worker in workers:
+        digest = hashlib.blake2b(f"{worker}:{channel_id}".encode(), digest_size=8).digest()
+        score = int.from_bytes(digest, 'big')
+        if score > best_score:
+            best, best_score = worker, score
+    return best
+
+class Backplane:
+    """Базовая шина: подписка на каналы и неблокирующая публикация.
+
+    handler(channel_id, source_worker, kind, payload) вызывается в event loop
+    для сообщений других воркеров; собственные сообщения отфильтровываются.
+    on_worker_lost(source_worker) вызывается, когда воркер перестал присылать heartbeat.
+    """
+
+    def __init__(
+        self,
+        worker_id: str = config.VOICE_WORKER_ID,
+        heartbeat_interval: float = config.VOICE_BACKPLANE_HEARTBEAT_INTERVAL,
+        worker_timeout: float = config.VOICE_BACKPLANE_WORKER_TIMEOUT
+    ):
+        self.worker_id = worker_id
+        self._worker_bytes = worker_id.encode()
+        self._handler: Optional[Handler] = None
+        self._on_worker_lost: Optional[WorkerLostHandler] = None
+        self.channels: Set[int] = set()
+        self.heartbeat_interval = heartbeat_interval
+        self.worker_timeout = worker_timeout
+        self.workers: Dict[str, float] = {}  # worker_id -> время последнего сообщения
+        self._lost: Set[str] = set()
+        self._heartbeat_task = None
+        self.published = 0
+        self.received = 0
+        self.dropped = 0
+        self.workers_lost = 0
+
+    async def start(self, handler: Handler, on_worker_lost: Optional[WorkerLostHandler] = None):
+        self._handler = handler
+        self._on_worker_lost = on_worker_lost
+        self._heartbeat_task = asyncio.create_task(self._heartbeat_loop())
+
+    async def _heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                for channel_id in list(self.channels):
+                    self.publish(channel_id, MESSAGE_HEARTBEAT, b'')
+                self._expire_workers(time.monotonic())
+            except Exception as e:
+                print(f"[BACKPLANE] Error in heartbeat loop: {e}")
+
+    def _expire_workers(self, now: float):
+        for worker_id, last_seen in list(self.workers.items()):
+            if now - last_seen < self.worker_timeout:
+                continue
+            del self.workers[worker_id]
+            self._lost.add(worker_id)
+            self.workers_lost += 1
+            print(f"[BACKPLANE] Worker {worker_id} timed out")
+            if self._on_worker_lost:
+                self._on_worker_lost(worker_id)
+
+    async def subscribe(self, channel_id):
+        self.channels.add(channel_id)
+
+    async def unsubscribe(self, channel_id):
+        self.channels.discard(channel_id)
+
+    def publish(self, channel_id, kind: bytes, payload: bytes):
+        """Отправляет сообщение воркерам канала, не дожидаясь доставки"""
+        self.published += 1
+        self._publish(channel_id, ENVELOPE.pack(kind, len(self._worker_bytes)) + self._worker_bytes + payload)
+
+    def _publish(self, channel_id, data: bytes):
+        raise NotImplementedError
+
+    def _receive(self, channel_id, data: bytes):
+        kind, length = ENVELOPE.unpack_from(data)
+        source = data[ENVELOPE.size:ENVELOPE.size + length].decode()
+        if source == self.worker_id or channel_id not in self.channels:
+            return
+        self.received += 1
+        self.workers[source] = time.monotonic()
+        if source in self._lost:
+            # Воркер вернулся после таймаута: его участники были убраны, запрашиваем их снова
+            self._lost.discard(source)
+            for subscribed in list(self.channels):
+                self.publish(subscribed, MESSAGE_HELLO, b'')
+        if kind == MESSAGE_HEARTBEAT:
+            return
+        try:
+            self._handler(channel_id, source, kind, data[ENVELOPE.size + length:])
+        except Exception as e:
+            print(f"[BACKPLANE] Error handling message for channel {channel_id}: {e}")
+
+    async def close(self):
+        if self._heartbeat_task:
+            self._heartbeat_task.cancel()
+            self._heartbeat_task = None
+        self.channels.clear()
+
+    def get_stats(self) -> dict:
+        return {
+            'backend': type(self).__name__,
+            'worker_id': self.worker_id,
+            'channels': len(self.channels),
+            'workers': len(self.workers),
+            'workers_lost': self.workers_lost,
+            'published': self.published,
+            'received': self.received,
+            'dropped': self.dropped
+        }
+
+class InProcessBackplane(Backplane):
+    """Шина внутри одного процесса: несколько менеджеров в одном event loop"""
+
+    _subscribers: Dict[int, Set['InProcessBackplane']] = {}
+
+    async def subscribe(self, channel_id):
+        await super().subscribe(channel_id)
+        self._subscribers.setdefault(channel_id, set()).add(self)
+
+    async def unsubscribe(self, channel_id):
+        await super().unsubscribe(channel_id)
+        subscribers = self._subscribers.get(channel_id)
+        if subscribers is not None:
+            subscribers.discard(self)
+            if not subscribers:
+                del self._subscribers[channel_id]
+
+    def _publish(self, channel_id, data: bytes):
+        for backplane in self._subscribers.get(channel_id, ()):
+            if backplane is not self:
+                backplane._receive(channel_id, data)
+
+    async def close(self):
+        for channel_id in list(self.channels):
+            await self.unsubscribe(channel_id)
+        await super().close()
+
+class UnixSocketBackplane(Backplane):
+    """Клиент локального брокера (см. run_broker); после потери брокера переподключается"""
+
+    def __init__(self, path: str, worker_id: str = config.VOICE_WORKER_ID,
+                 max_buffer: int = config.VOICE_BACKPLANE_MAX_BUFFER,
+                 reconnect_max_delay: float = config.VOICE_BACKPLANE_RECONNECT_MAX_DELAY):
+        super().__init__(worker_id)
+        self.path = path
+        self.max_buffer = max_buffer
+        self.reconnect_max_delay = reconnect_max_delay
+        self._reader = None
+        self._writer = None
+        self._task = None
+        self.reconnects = 0
+
+    async def start(self, handler: Handler, on_worker_lost: Optional[WorkerLostHandler] = None):
+        await super().start(handler, on_worker_lost)
+        self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+        self._task = asyncio.create_task(self._run())
+
+    def _send(self, op: bytes, channel_id, data: bytes = b''):
+        if self._writer is None or self._writer.is_closing():
+            self.dropped += 1
+            return
+        self._writer.write(BROKER_FRAME.pack(op, channel_id, len(data)) + data)
+
+    async def subscribe(self, channel_id):
+        await super().subscribe(channel_id)
+        self._send(BROKER_SUBSCRIBE, channel_id)
+
+    async def unsubscribe(self, channel_id):
+        await super().unsubscribe(channel_id)
+        self._send(BROKER_UNSUBSCRIBE, channel_id)
+
+    def _publish(self, channel_id, data: bytes):
+        if self._writer is not None and self._writer.transport.get_write_buffer_size() > self.max_buffer:
+            # Брокер не успевает читать — теряем сообщение, а не память
+            self.dropped += 1
+            return
+        self._send(BROKER_PUBLISH, channel_id, data)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._read_loop()
+            except (asyncio.IncompleteReadError, ConnectionError, OSError):
+                print("[BACKPLANE] Broker connection closed")
+            self._writer.close()
+            self._writer = None
+            await self._reconnect()
+
+    async def _read_loop(self):
+        while True:
+            header = await self._reader.readexactly(BROKER_FRAME.size)
+            _, channel_id, length = BROKER_FRAME.unpack(header)
+            self._receive(channel_id, await self._reader.readexactly(length))
+
+    async def _reconnect(self):
+        """Подключается к брокеру заново с экспоненциальной паузой и восстанавливает подписки"""
+        delay = 0.5
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                self._reader, self._writer = await asyncio.open_unix_connection(self.path)
+                break
+            except OSError as e:
+                print(f"[BACKPLANE] Broker reconnect failed, retrying in {delay:.1f}s: {e}")
+                delay = min(delay * 2, self.reconnect_max_delay)
+        self.reconnects += 1
+        print(f"[BACKPLANE] Reconnected to broker {self.path}")
+        for channel_id in self.channels:
+            self._send(BROKER_SUBSCRIBE, channel_id)
+            # Пока связи не было, участники других воркеров могли смениться
+            self.publish(channel_id, MESSAGE_HELLO, b'')
+
+    async def close(self):
+        await super().close()
+        if self._task:
+            self._task.cancel()
+        if self._writer:
+            self._writer.close()
+
+    def get_stats(self) -> dict:
+        stats = super().get_stats()
+        stats['reconnects'] = self.reconnects
+        return stats
+
+class RedisBackplane(Backplane):
+    """Шина на Redis Pub/Sub; публикация идет через ограниченную очередь"""
+
+    def __init__(self, url: str, worker_id: str = config.VOICE_WORKER_ID,
+                 queue_size: int = config.VOICE_BACKPLANE_QUEUE_SIZE):
+        if aioredis is None:
+            raise RuntimeError("The redis package is required for the redis:// voice backplane")
+        super().__init__(worker_id)
+        self.url = url
+        self._client = aioredis.from_url(url)
+        self._pubsub = self._client.pubsub()
+        self._queue = asyncio.Queue(maxsize=queue_size)
+        self._tasks = []
+
+    @staticmethod
+    def _topic(channel_id) -> str:
+        return f"meow:voice:{channel_id}"
+
+    async def start(self, handler: Handler, on_worker_lost: Optional[WorkerLostHandler] = None):
+        await super().start(handler, on_worker_lost)
+        self._tasks = [
+            asyncio.create_task(self._publish_loop()),
+            asyncio.create_task(self._read_loop())
+        ]
+
+    async def subscribe(self, channel_id):
+        await super().subscribe(channel_id)
+        await self._pubsub.subscribe(self._topic(channel_id))
+
+    async def unsubscribe(self, channel_id):
+        await super().unsubscribe(channel_id)
+        await self._pubsub.unsubscribe(self._topic(channel_id))
+
+    def _publish(self, channel_id, data: bytes):
+        try:
+            self._queue.put_nowait((self._topic(channel_id), data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _publish_loop(self):
+        while True:
+            topic, data = await self._queue.get()
+            try:
+                await self._client.publish(topic, data)
+            except Exception as e:
+                self.dropped += 1
+                print(f"[BACKPLANE] Redis publish failed: {e}")
+
+    async def _read_loop(self):
+        while True:
+            if not self._pubsub.subscribed:
+                await asyncio.sleep(0.1)
+                continue
+            try:
+                message = await self._pubsub.get_message(ignore_subscribe_messages=True, timeout=1.0)
+            except Exception as e:
+                print(f"[BACKPLANE] Redis read failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            if message and message['type'] == 'message':
+                topic = message['channel'].decode()
+                self._receive(int(topic.rsplit(':', 1)[1]), message['data'])
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await super().close()
+        await self._pubsub.close()
+        await self._client.close()
+
+def create_backplane(url: str = config.VOICE_BACKPLANE_URL, worker_id: str = config.VOICE_WORKER_ID) -> Backplane:
+    if url == "memory":
+        return InProcessBackplane(worker_id)
+    if url.startswith("unix://"):
+        return UnixSocketBackplane(url[len("unix://"):], worker_id)
+    if url.startswith(("redis://", "rediss://")):
+        return RedisBackplane(url, worker_id)
+    raise ValueError(f"Unknown voice backplane: {url}")
+
+async def run_broker(path: str, max_buffer: int = config.VOICE_BACKPLANE_MAX_BUFFER):
+    """Брокер для шины unix://: пересылает публикации подписчикам канала, кроме автора"""
+    subscribers: Dict[int, Set[asyncio.StreamWriter]] = {}
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        channels = set()
+        try:
+            while True:
+                header = await reader.readexactly(BROKER_FRAME.size)
+                op, channel_id, length = BROKER_FRAME.unpack(header)
+                data = await reader.readexactly(length) if length else b''
+                if op == BROKER_SUBSCRIBE:
+                    subscribers.setdefault(channel_id, set()).add(writer)
+                    channels.add(channel_id)
+                elif op == BROKER_UNSUBSCRIBE:
+                    subscribers.get(channel_id, set()).discard(writer)
+                    channels.discard(channel_id)
+                elif op == BROKER_PUBLISH:
+                    frame = header + data
+                    for subscriber in subscribers.get(channel_id, ()):
+                        if subscriber is writer or subscriber.transport.get_write_buffer_size() > max_buffer:
+                            continue
+                        subscriber.write(frame)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for channel_id in channels:
+                subscribers.get(channel_id, set()).discard(writer)
+            writer.close()
+
+    server = await asyncio.start_unix_server(handle, path=path)
+    print(f"[BACKPLANE] Broker listening on {path}")
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Local voice backplane broker")
+    parser.add_argument("--socket", default="/tmp/meow-voice.sock")
+    args = parser.parse_args()
+    asyncio.run(run_broker(args.socket))
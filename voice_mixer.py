@@ -0,0 +1,156 @@
+import threading
+from typing import Dict, Iterable
+
+try:
+    import numpy as np
+except ImportError:  # Без NumPy сведение недоступно, каналы работают в режиме relay
+    np = None
+
+import config
+from audio_handler import StreamDecoder, StreamEncoder
+from voice_protocol import VoiceFrame, CODEC_PCM16, CODEC_WEBM
+
+def mixing_available() -> bool:
+    return np is not None
+
+class ChannelMixer:
+    """Микшер одного голосового канала (режим MCU).
+
+    Кадры участников декодируются в PCM и копятся в буферах. Раз в frame_ms из каждого буфера
+    берется по одному кадру, выбираются top_k самых громких говорящих, и каждому слушателю
+    отдается сумма без его собственного голоса (mix-minus). Слушатели, которые сейчас не говорят,
+    получают один и тот же общий микс, поэтому различных миксов не больше top_k + 1.
+    """
+
+    def __init__(
+        self,
+        rate: int = 48000,
+        channels: int = 1,
+        frame_ms: int = config.VOICE_MIX_FRAME_MS,
+        top_k: int = config.VOICE_MIX_TOP_K,
+        max_buffer_ms: int = config.VOICE_MIX_MAX_BUFFER_MS,
+        codec: str = config.VOICE_MIX_CODEC
+    ):
+        if np is None:
+            raise RuntimeError("NumPy is required for voice mixing")
+        self.rate = rate
+        self.channels = channels
+        self.frame_ms = frame_ms
+        self.top_k = max(1, top_k)
+        self.frame_bytes = rate * frame_ms // 1000 * channels * 2
+        self.codec = CODEC_WEBM if codec == "webm" else CODEC_PCM16
+        self._max_buffer = rate * max_buffer_ms // 1000 * channels * 2
+        self._buffers = {}   # user_id -> bytearray PCM
+        self._decoders = {}  # user_id -> StreamDecoder (для WebM/Opus)
+        self._encoders = {}  # listener_id -> StreamEncoder (только для codec="webm")
+        self._lock = threading.Lock()
+        self.closed = False  # mix() выполняется в потоке и может завершаться уже после close()
+        self.sequence = 0
+        self.active_speakers = []
+
+    def push(self, user_id, frame: VoiceFrame):
+        """Принимает кадр участника (вызывается из event loop, не блокирует)"""
+        if frame.codec == CODEC_PCM16:
+            self._append(user_id, frame.payload)
+            return
+        decoder = self._decoders.get(user_id)
+        if decoder is None:
+            decoder = StreamDecoder(self.rate, self.channels)
+            self._decoders[user_id] = decoder
+        decoder.feed(frame.payload)
+
+    def _append(self, user_id, pcm: bytes):
+        if not pcm:
+            return
+        with self._lock:
+            buffer = self._buffers.setdefault(user_id, bytearray())
+            buffer.extend(pcm)
+            # Ограничиваем задержку: старые сэмплы отбрасываются
+            overflow = len(buffer) - self._max_buffer
+            if overflow > 0:
+                del buffer[:overflow + (overflow % 2)]
+
+    def remove(self, user_id):
+        with self._lock:
+            self._buffers.pop(user_id, None)
+            encoder = self._encoders.pop(user_id, None)
+        decoder = self._decoders.pop(user_id, None)
+        if decoder:
+            decoder.close()
+        if encoder:
+            encoder.close()
+
+    def _take_frames(self):
+        for user_id, decoder in list(self._decoders.items()):
+            self._append(user_id, decoder.read())
+        speakers = []
+        rows = []
+        with self._lock:
+            for user_id, buffer in self._buffers.items():
+                if len(buffer) >= self.frame_bytes:
+                    rows.append(bytes(buffer[:self.frame_bytes]))
+                    del buffer[:self.frame_bytes]
+                    speakers.append(user_id)
+        return speakers, rows
+
+    def mix(self, listeners: Iterable) -> Dict[object, bytes]:
+        """Сводит один кадр. Возвращает listener_id -> полезная нагрузка в кодеке self.codec.
+
+        Вызывается из пула потоков: NumPy-операции не держат event loop.
+        """
+        if self.closed:
+            return {}
+        self.sequence += 1
+        speakers, rows = self._take_frames()
+        self.active_speakers = speakers
+        if not rows:
+            return {}
+
+        frames = np.frombuffer(b''.join(rows), dtype=np.int16).reshape(len(rows), -1).astype(np.int32)
+        if len(speakers) > self.top_k:
+            # Оставляем только top_k самых громких говорящих
+            energy = np.einsum('ij,ij->i', frames, frames, dtype=np.int64)
+            keep = np.argpartition(energy, -self.top_k)[-self.top_k:]
+            frames = frames[keep]
+            speakers = [speakers[i] for i in keep]
+            self.active_speakers = speakers
+
+        total = frames.sum(axis=0)
+        full_mix = np.clip(total, -32768, 32767).astype(np.int16).tobytes()
+        speaker_index = {user_id: i for i, user_id in enumerate(speakers)}
+
+        result = {}
+        for listener in listeners:
+            i = speaker_index.get(listener)
+            if i is None:
+                pcm = full_mix
+            elif len(speakers) == 1:
+                # Слушатель — единственный говорящий, свой голос ему не отправляем
+                continue
+            else:
+                pcm = np.clip(total - frames[i], -32768, 32767).astype(np.int16).tobytes()
+            payload = self._encode(listener, pcm)
+            if payload:
+                result[listener] = payload
+        return result
+
+    def _encode(self, listener, pcm: bytes) -> bytes:
+        if self.codec == CODEC_PCM16:
+            return pcm
+        # У кодировщика Opus есть состояние, поэтому он свой у каждого слушателя
+        with self._lock:
+            if self.closed:
+                # Кодировщик, созданный после close(), никто бы уже не закрыл
+                return b''
+            encoder = self._encoders.get(listener)
+            if encoder is None:
+                encoder = StreamEncoder(self.rate, self.channels)
+                self._encoders[listener] = encoder
+        encoder.feed(pcm)
+        return encoder.read()
+
+    def close(self):
+        with self._lock:
+            self.closed = True
+        for user_id in set(self._buffers) | set(self._decoders) | set(self._encoders):
+            self.remove(user_id)
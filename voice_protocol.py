@@ -0,0 +1,66 @@
+import struct
+from typing import NamedTuple, Optional
+
+# Бинарный формат голосового кадра:
+#   magic (1) | version (1) | kind (1) | flags (1) | sender_id (4) | sequence (4) | timestamp_ms (8) | payload
+# Все поля заголовка в сетевом порядке байт. Клиент может передать sender_id = 0 — сервер подставит свой.
+FRAME_MAGIC = 0x4D  # 'M'
+FRAME_VERSION = 1
+HEADER = struct.Struct('!BBBBIIQ')
+HEADER_SIZE = HEADER.size
+
+# Тип кадра
+KIND_AUDIO = 1
+
+# Младшие 4 бита flags — кодек полезной нагрузки
+CODEC_MASK = 0x0F
+CODEC_UNKNOWN = 0x00  # Кодек не объявлен клиентом (данные старых клиентов без заголовка)
+CODEC_PCM16 = 0x01  # Сырой PCM s16le
+CODEC_OPUS = 0x02   # Пакеты Opus без контейнера
+CODEC_WEBM = 0x03   # Opus в WebM (MediaRecorder)
+
+# Старшие биты flags
+FLAG_MIXED = 0x10   # Кадр сведен сервером из нескольких говорящих (sender_id = 0)
+FLAG_DTX = 0x20     # Клиент пометил кадр как тишину (собственный VAD / Opus DTX)
+
+SEQUENCE_MODULO = 1 << 32
+
+# Сигнатуры WebM/Matroska: EBML-заголовок и начало кластера
+WEBM_SIGNATURES = (b'\x1a\x45\xdf\xa3', b'\x1f\x43\xb6\x75')
+
+class VoiceFrame(NamedTuple):
+    kind: int
+    flags: int
+    sender_id: int
+    sequence: int
+    timestamp: int  # миллисекунды
+    payload: bytes
+
+    @property
+    def codec(self) -> int:
+        return self.flags & CODEC_MASK
+
+def encode_frame(sender_id: int, sequence: int, timestamp: int, payload: bytes,
+                 flags: int = CODEC_OPUS, kind: int = KIND_AUDIO) -> bytes:
+    header = HEADER.pack(FRAME_MAGIC, FRAME_VERSION, kind, flags,
+                         sender_id, sequence % SEQUENCE_MODULO, timestamp)
+    return header + payload
+
+def decode_frame(data: bytes) -> Optional[VoiceFrame]:
+    """Разбирает бинарный кадр. Возвращает None, если данные не в формате кадра (старые клиенты)."""
+    if len(data) < HEADER_SIZE or data[0] != FRAME_MAGIC or data[1] != FRAME_VERSION:
+        return None
+    _, _, kind, flags, sender_id, sequence, timestamp = HEADER.unpack_from(data)
+    return VoiceFrame(kind, flags, sender_id, sequence, timestamp, bytes(data[HEADER_SIZE:]))
+
+def sequence_diff(a: int, b: int) -> int:
+    """a - b с учетом переполнения 32-битного счетчика кадров"""
+    return (a - b + (SEQUENCE_MODULO >> 1)) % SEQUENCE_MODULO - (SEQUENCE_MODULO >> 1)
+
+def guess_codec(payload: bytes) -> int:
+    """Кодек для нефреймированных данных старых клиентов.
+
+    Узнать можно только WebM по сигнатуре; остальное может быть и PCM, и сжатыми данными,
+    поэтому PCM16 не предполагается — его объявляет только заголовок бинарного кадра.
+    """
+    return CODEC_WEBM if payload.startswith(WEBM_SIGNATURES) else CODEC_UNKNOWN
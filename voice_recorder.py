@@ -0,0 +1,256 @@
+"""
+Запись голосового канала.
+
+Во время записи кадры участников (после фильтров mute и VAD) копируются из пути пересылки
+в ограниченную очередь и в отдельном потоке пишутся на диск, по файлу на сегмент участника:
+- PCM s16le — непрерывная дорожка, короткие паузы заполняются тишиной по меткам времени кадров;
+- WebM/Opus — чанки как есть.
+Пауза длиннее VOICE_RECORDING_MAX_GAP или новый WebM-поток начинают новый сегмент со своим
+смещением от начала сессии. Открыт только текущий сегмент каждого участника, а список сегментов
+пишется в файл segments.tsv, поэтому многочасовая запись занимает постоянную память.
+После остановки сегменты каждого участника по очереди склеиваются в одну дорожку PCM
+(паузы между ними заполняются тишиной), и ffmpeg сводит дорожки (adelay + amix) в один файл
+Ogg/Opus — по одному входу на участника, сколько бы сегментов ни было.
+"""
+import os
+import queue
+import shutil
+import subprocess
+import threading
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+
+import config
+from voice_protocol import VoiceFrame, CODEC_PCM16, CODEC_WEBM
+
+RATE = 48000
+BYTES_PER_MS = RATE * 2 // 1000
+EBML_MAGIC = b'\x1a\x45\xdf\xa3'
+_SILENCE = bytes(BYTES_PER_MS * 1000)
+
+def _write_silence(file, size: int):
+    size -= size % 2
+    while size > 0:
+        chunk = _SILENCE[:min(size, len(_SILENCE))]
+        file.write(chunk)
+        size -= len(chunk)
+
+class _Segment:
+    """Непрерывный кусок записи одного участника"""
+
+    def __init__(self, path: str, codec: int, offset_ms: int, first_timestamp: int):
+        self.path = path
+        self.codec = codec
+        self.offset_ms = offset_ms
+        self.first_timestamp = first_timestamp
+        self.last_timestamp = first_timestamp
+        self.position = 0  # байт PCM, записанных в сегмент
+        self.file = open(path, 'wb')
+
+    def write(self, frame: VoiceFrame):
+        if self.codec == CODEC_PCM16:
+            # Кадры, пропущенные детектором речи, заменяются тишиной
+            gap = (frame.timestamp - self.first_timestamp) * BYTES_PER_MS - self.position
+            if gap > 0:
+                gap -= gap % 2
+                _write_silence(self.file, gap)
+                self.position += gap
+            self.position += len(frame.payload)
+        self.file.write(frame.payload)
+        self.last_timestamp = frame.timestamp
+
+    def close(self):
+        self.file.close()
+
+class VoiceRecorder:
+    """Одна сессия записи канала"""
+
+    def __init__(
+        self,
+        channel_id,
+        started_by,
+        directory: str = config.VOICE_RECORDING_TRACKS_DIR,
+        queue_size: int = config.VOICE_RECORDING_QUEUE_SIZE,
+        max_gap: float = config.VOICE_RECORDING_MAX_GAP
+    ):
+        self.channel_id = channel_id
+        self.started_by = started_by
+        self.session_id = uuid.uuid4().hex
+        self.directory = os.path.join(directory, self.session_id)
+        self.max_gap_ms = int(max_gap * 1000)
+        self.started_at = time.time()
+        self.stopped_at = None
+        self.status = 'recording'
+        self.output_path = None
+        self.media_id = None
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._current = {}  # user_id -> _Segment
+        self._manifest = None  # segments.tsv: участник, кодек, смещение, файл
+        self.segments = 0
+        self.frames = 0
+        self.dropped = 0
+        self.skipped = 0  # кадры, которые нельзя записать без декодирования (Opus без контейнера) или с неизвестным кодеком
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._manifest = open(os.path.join(self.directory, 'segments.tsv'), 'w')
+        self._thread = threading.Thread(target=self._run, daemon=True, name=f"recorder-{self.session_id[:8]}")
+        self._thread.start()
+
+    def tap(self, sender_id, frame: VoiceFrame):
+        """Копия кадра из пути пересылки; не блокирует event loop"""
+        if self.status != 'recording':
+            return
+        try:
+            self._queue.put_nowait((sender_id, frame, int(time.time() * 1000)))
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            try:
+                self._write(*item)
+            except Exception as e:
+                print(f"[RECORDER] Error writing frame for session {self.session_id}: {e}")
+        for segment in self._current.values():
+            segment.close()
+        self._current.clear()
+        self._manifest.close()
+
+    def _write(self, sender_id, frame: VoiceFrame, arrived_ms: int):
+        if frame.codec not in (CODEC_PCM16, CODEC_WEBM):
+            self.skipped += 1
+            return
+        segment = self._current.get(sender_id)
+        new_segment = (
+            segment is None
+            or segment.codec != frame.codec
+            or frame.timestamp - segment.last_timestamp > self.max_gap_ms
+            or frame.timestamp < segment.last_timestamp
+            or (frame.codec == CODEC_WEBM and frame.payload[:4] == EBML_MAGIC)
+        )
+        if new_segment:
+            if segment is not None and frame.timestamp > segment.last_timestamp:
+                # Часы отправителя те же: смещение точнее считать по его меткам времени
+                offset_ms = segment.offset_ms + frame.timestamp - segment.first_timestamp
+            else:
+                offset_ms = max(0, arrived_ms - int(self.started_at * 1000))
+            if segment is not None:
+                segment.close()
+            extension = 'pcm' if frame.codec == CODEC_PCM16 else 'webm'
+            path = os.path.join(self.directory, f"{sender_id}-{self.segments}.{extension}")
+            segment = _Segment(path, frame.codec, offset_ms, frame.timestamp)
+            self._current[sender_id] = segment
+            self.segments += 1
+            self._manifest.write(f"{sender_id}\t{frame.codec}\t{offset_ms}\t{os.path.basename(path)}\n")
+        segment.write(frame)
+        self.frames += 1
+
+    def stop(self):
+        """Прекращает прием кадров и дописывает очередь на диск (блокирует)"""
+        if self.status != 'recording':
+            return
+        self.status = 'processing'
+        self.stopped_at = time.time()
+        self._queue.put(None)
+        if self._thread:
+            self._thread.join()
+
+    @property
+    def duration(self) -> int:
+        return int((self.stopped_at or time.time()) - self.started_at)
+
+    def _read_manifest(self) -> Dict[str, List[Tuple[int, int, str]]]:
+        """Сегменты каждого участника в порядке записи: (кодек, смещение, путь)"""
+        tracks = {}
+        with open(os.path.join(self.directory, 'segments.tsv')) as f:
+            for line in f:
+                sender_id, codec, offset_ms, name = line.rstrip('\n').split('\t')
+                tracks.setdefault(sender_id, []).append((int(codec), int(offset_ms), os.path.join(self.directory, name)))
+        return tracks
+
+    def _render_track(self, sender_id: str, segments: List[Tuple[int, int, str]]) -> Tuple[str, int]:
+        """Склеивает сегменты участника в одну дорожку PCM. Возвращает путь и смещение ее начала"""
+        track_offset = segments[0][1]
+        path = os.path.join(self.directory, f"track-{sender_id}.pcm")
+        with open(path, 'wb') as track:
+            for codec, offset_ms, segment_path in segments:
+                position = track.tell()
+                _write_silence(track, (offset_ms - track_offset) * BYTES_PER_MS - position)
+                if codec == CODEC_PCM16:
+                    with open(segment_path, 'rb') as segment:
+                        shutil.copyfileobj(segment, track)
+                else:
+                    track.flush()
+                    try:
+                        subprocess.run(
+                            ['ffmpeg', '-loglevel', 'error', '-i', segment_path,
+                             '-f', 's16le', '-ar', str(RATE), '-ac', '1', '-'],
+                            check=True, stdin=subprocess.DEVNULL, stdout=track, stderr=subprocess.PIPE
+                        )
+                    except subprocess.CalledProcessError as e:
+                        # Поврежденный сегмент не должен лишать запись остальных
+                        print(f"[RECORDER] Skipping segment {segment_path}: {e.stderr.decode(errors='replace').strip()}")
+                        track.seek(position)
+                        track.truncate()
+                        continue
+                os.remove(segment_path)
+        return path, track_offset
+
+    def _ffmpeg_command(self, tracks: List[Tuple[str, int]], output_path: str) -> List[str]:
+        command = ['ffmpeg', '-loglevel', 'error', '-y']
+        filters = []
+        for i, (path, offset_ms) in enumerate(tracks):
+            command += ['-f', 's16le', '-ar', str(RATE), '-ac', '1', '-i', path]
+            filters.append(f"[{i}:a]adelay={offset_ms}:all=1[a{i}];")
+        inputs = ''.join(f"[a{i}]" for i in range(len(tracks)))
+        filters.append(f"{inputs}amix=inputs={len(tracks)}:duration=longest:normalize=0[out]")
+        return command + [
+            '-filter_complex', ''.join(filters), '-map', '[out]',
+            '-c:a', 'libopus', '-b:a', config.VOICE_RECORDING_BITRATE, output_path
+        ]
+
+    def finish(self, output_dir: str = config.VOICE_RECORDING_DIR) -> Optional[str]:
+        """Останавливает запись и сводит дорожки в Ogg/Opus. Возвращает путь к файлу или None"""
+        self.stop()
+        if not self.segments:
+            self.status = 'empty'
+            shutil.rmtree(self.directory, ignore_errors=True)
+            return None
+        os.makedirs(output_dir, exist_ok=True)
+        output_path = os.path.join(output_dir, f"{self.session_id}.ogg")
+        try:
+            # Дорожки собираются по одной: одновременно открыты не больше двух файлов
+            tracks = [
+                self._render_track(sender_id, segments)
+                for sender_id, segments in self._read_manifest().items()
+            ]
+            subprocess.run(self._ffmpeg_command(tracks, output_path), check=True, stdin=subprocess.DEVNULL, capture_output=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            # Дорожки остаются на диске, чтобы запись можно было свести вручную
+            self.status = 'failed'
+            print(f"[RECORDER] Mixdown failed for session {self.session_id}: {e}")
+            return None
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.output_path = output_path
+        self.status = 'done'
+        return output_path
+
+    def get_stats(self) -> dict:
+        return {
+            'session_id': self.session_id,
+            'channel_id': self.channel_id,
+            'status': self.status,
+            'duration': self.duration,
+            'frames': self.frames,
+            'segments': self.segments,
+            'queue_depth': self._queue.qsize(),
+            'dropped': self.dropped,
+            'skipped': self.skipped,
+            'media_id': self.media_id
+        }
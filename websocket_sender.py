@@ -0,0 +1,121 @@
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+import config
+
+class WebSocketSender:
+    """Исходящая очередь одного WebSocket-клиента с собственной задачей-писателем.
+
+    Рассылка только ставит сообщения в очередь и не ждет сокет, поэтому медленный клиент
+    не задерживает остальных. Управляющие сообщения отправляются раньше медиа-кадров,
+    медиа-кадры при переполнении или устаревании отбрасываются.
+    """
+
+    def __init__(
+        self,
+        websocket,
+        on_error: Optional[Callable[[], Awaitable[None]]] = None,
+        high_water_mark: int = config.VOICE_SEND_HIGH_WATER_MARK,
+        control_limit: int = config.VOICE_SEND_CONTROL_LIMIT,
+        max_media_age: float = config.VOICE_AUDIO_MAX_AGE,
+        log_tag: str = "VOICE"
+    ):
+        self.websocket = websocket
+        self.log_tag = log_tag  # Очередь общая для голоса, шлюза и /ws; тег показывает, чей это клиент
+        self.high_water_mark = high_water_mark
+        self.control_limit = control_limit
+        self.max_media_age = max_media_age
+        self._on_error = on_error
+        self._control = deque()  # (enqueued_at, message)
+        self._media = deque(maxlen=high_water_mark)  # (enqueued_at, message)
+        self._wakeup = asyncio.Event()
+        self._task = None
+        self.closed = False
+        self.sent = 0
+        self.dropped = 0
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    def send(self, message, droppable: bool = False) -> bool:
+        """Ставит сообщение в очередь без ожидания.
+
+        droppable=True для кадров, которые можно потерять (аудио, видео).
+        """
+        if self.closed:
+            return False
+        if droppable:
+            if len(self._media) == self._media.maxlen:
+                # deque с maxlen сам вытеснит самый старый кадр
+                self.dropped += 1
+            self._media.append((time.monotonic(), message))
+        else:
+            if len(self._control) >= self.control_limit:
+                # Клиент не успевает даже за управляющими сообщениями — отключаем его
+                print(f"[{self.log_tag}] Send queue overflow, closing slow client")
+                self._fail()
+                return False
+            self._control.append((time.monotonic(), message))
+        self._wakeup.set()
+        return True
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._control) + len(self._media)
+
+    def _next_message(self):
+        if self._control:
+            return self._control.popleft()[1]
+        now = time.monotonic()
+        while self._media:
+            enqueued_at, message = self._media.popleft()
+            if now - enqueued_at <= self.max_media_age:
+                return message
+            self.dropped += 1
+        return None
+
+    async def _run(self):
+        try:
+            while not self.closed:
+                message = self._next_message()
+                if message is None:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                if isinstance(message, bytes):
+                    await self.websocket.send_bytes(message)
+                elif isinstance(message, str):
+                    await self.websocket.send_text(message)
+                else:
+                    await self.websocket.send_json(message)
+                self.sent += 1
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            print(f"[{self.log_tag}] Error sending to client: {e}")
+            self._fail()
+
+    def _fail(self):
+        if self.closed:
+            return
+        self.close()
+        if self._on_error:
+            asyncio.create_task(self._on_error())
+
+    def close(self):
+        self.closed = True
+        self._control.clear()
+        self._media.clear()
+        self._wakeup.set()
+        if self._task and self._task is not asyncio.current_task():
+            self._task.cancel()
+
+    def get_stats(self) -> dict:
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'dropped': self.dropped
+        }